@@ -0,0 +1,54 @@
+"""
+Encode and decode throughput of the packet codecs
+
+    python -m benchmarks.codec [--count 20000] [--size 100]
+
+"json" is the protocol v1 codec, "binary" is the protocol v2 codec.
+"framed" numbers include encryption with AESCryptor and the length header, as sent on the wire
+"""
+import argparse
+import time
+
+from chat_bridge_universal.core.network import network_utils
+from chat_bridge_universal.core.network.codec import JSON_CODEC, BINARY_CODEC
+from chat_bridge_universal.core.network.cryptor import AESCryptor
+from chat_bridge_universal.core.network.protocal import ChatPacket, ChatPayload
+
+
+def measure(func, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=100, help='chat message length')
+    args = parser.parse_args()
+
+    cryptor = AESCryptor('BenchmarkKey')
+    packet = ChatPacket(
+        sender='survival', receivers=['creative', 'mirror'], broadcast=False,
+        payload=ChatPayload(author='Steve', message='x' * args.size).serialize()
+    )
+    print('{:>8} {:>8} {:>14} {:>14} {:>8} {:>14} {:>14}'.format(
+        'codec', 'bytes', 'encode/s', 'decode/s', 'framed', 'framed enc/s', 'framed dec/s'
+    ))
+    for name, codec in (('json', JSON_CODEC), ('binary', BINARY_CODEC)):
+        data = codec.encode(packet)
+        frame = network_utils.encode_packet(cryptor, packet, codec)
+        body = frame[codec.header.size:]
+        print('{:>8} {:>8} {:>14.0f} {:>14.0f} {:>8} {:>14.0f} {:>14.0f}'.format(
+            name, len(data),
+            measure(lambda: codec.encode(packet), args.count),
+            measure(lambda: codec.decode(data, ChatPacket), args.count),
+            len(frame),
+            measure(lambda: network_utils.encode_packet(cryptor, packet, codec), args.count),
+            measure(lambda: network_utils.decode_packet(cryptor, body, ChatPacket, codec), args.count),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Bytes per message and messages per second of the cryptors
+
+    python -m benchmarks.cryptor [--count 20000] [--sizes 64,512,4096]
+
+aes_cbc is the hex encoded AES-CBC AESCryptor, aes_ctr_hmac is the raw binary AESCTRCryptor
+"""
+import argparse
+import time
+
+from chat_bridge_universal.core.network.cryptor import AESCryptor, AESCTRCryptor
+
+
+def measure(func, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--sizes', default='64,512,4096,65536', help='comma separated plaintext sizes')
+    args = parser.parse_args()
+
+    print('{:>12} {:>8} {:>10} {:>14} {:>14}'.format('cipher', 'size', 'bytes/msg', 'encrypt/s', 'decrypt/s'))
+    for size in map(int, args.sizes.split(',')):
+        data = b'x' * size
+        for cryptor in (AESCryptor('BenchmarkKey'), AESCTRCryptor('BenchmarkKey')):
+            encrypted = cryptor.encrypt_bytes(data)
+            print('{:>12} {:>8} {:>10} {:>14.0f} {:>14.0f}'.format(
+                cryptor.name, size, len(encrypted),
+                measure(lambda: cryptor.encrypt_bytes(data), args.count),
+                measure(lambda: cryptor.decrypt_bytes(encrypted), args.count)
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Broadcast fan-out cost of CBUServer.process_packet, per recipient
+
+    python -m benchmarks.fanout [--clients 1,10,100] [--messages 2000] [--size 100]
+
+"legacy" scans every connection and encodes the packet again for every recipient like the server used to do,
+"indexed" is the current CBUServer.process_packet, encoding once and reading the recipients from the routing index
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import List
+
+from chat_bridge_universal.core.config import ClientMeta
+from chat_bridge_universal.core.network import network_utils, codec, cryptor
+from chat_bridge_universal.core.network.protocal import ChatPacket, ChatPayload
+from chat_bridge_universal.core.server import CBUServer
+
+
+class SinkConnection:
+    def __init__(self, name: str, server: CBUServer):
+        self.config = ClientMeta(name=name, password='')
+        self.server = server
+        self.sent_bytes = 0
+
+    def is_online(self) -> bool:
+        return True
+
+    def is_peer(self) -> bool:
+        return False
+
+    def get_codec(self) -> codec.AbstractCodec:
+        return codec.JSON_CODEC
+
+    def get_cryptor(self) -> cryptor.AbstractCryptor:
+        return self.server._cryptor
+
+    def get_compressor(self):
+        return None
+
+    def get_chunk_size(self) -> int:
+        return 0
+
+    def send_data(self, data: bytes):
+        self.sent_bytes += len(data)
+
+    def send_frames(self, frames: List[bytes]):
+        for frame in frames:
+            self.send_data(frame)
+
+
+class LegacySinkConnection(SinkConnection):
+    def send_packet(self, packet: ChatPacket):
+        self.send_data(network_utils.encode_packet(self.server._cryptor, packet))
+
+
+def legacy_process_packet(server: CBUServer, packet: ChatPacket):
+    for connection in server._connections.values():
+        if connection.is_online():
+            if packet.broadcast or connection.config.name in packet.receivers:
+                if connection.config.name != packet.sender:
+                    connection.send_packet(packet)
+
+
+def create_server() -> CBUServer:
+    config_path = os.path.join(tempfile.mkdtemp(), 'server_config.json')
+    with open(config_path, 'w', encoding='utf8') as file:
+        json.dump({'aes_key': 'BenchmarkKey', 'clients': []}, file)
+    server = CBUServer(config_path)
+    server.logger.setLevel(logging.WARNING)
+    return server
+
+
+def run(client_count: int, message_count: int, message_size: int):
+    server = create_server()
+    packet = ChatPacket(sender='sender', receivers=[], broadcast=True, payload=ChatPayload(author='Steve', message='x' * message_size).serialize())
+    for name, func, connection_factory in (
+            ('legacy', legacy_process_packet, LegacySinkConnection),
+            ('indexed', CBUServer.process_packet, SinkConnection)
+    ):
+        server._connections = {'client{}'.format(i): connection_factory('client{}'.format(i), server) for i in range(client_count)}
+        for connection in server._connections.values():
+            server._update_routing(connection)
+        start = time.perf_counter()
+        for _ in range(message_count):
+            func(server, packet)
+        cost = time.perf_counter() - start
+        deliveries = client_count * message_count
+        print('{:>12} clients={:<5} {:8.2f} us/broadcast {:8.3f} us/client {:10.0f} deliveries/s'.format(
+            name, client_count, cost / message_count * 1e6, cost / deliveries * 1e6, deliveries / cost
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', default='1,10,100', help='comma separated client counts')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=100, help='chat message length')
+    args = parser.parse_args()
+    for client_count in map(int, args.clients.split(',')):
+        run(client_count, args.messages, args.size)
+
+
+if __name__ == '__main__':
+    main()
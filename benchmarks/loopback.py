@@ -0,0 +1,47 @@
+"""
+End-to-end loopback benchmark over engines and protocol options, with the same load as `cbu bench`
+
+    python -m benchmarks.loopback [--clients 10] [--duration 5] [--rate 1000] [--size 100] [--output results.json]
+
+Every combination runs in a fresh server, results of all of them are written to the output file
+"""
+import argparse
+import itertools
+import json
+
+from chat_bridge_universal.cli.bench import BenchConfig, run_bench, format_result
+
+MATRIX = {
+    'engine': ['thread', 'asyncio'],
+    'protocol_version': [1, 2],
+    'cipher': ['aes_cbc', 'aes_ctr_hmac'],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--rate', type=float, default=1000)
+    parser.add_argument('--size', type=int, default=100)
+    parser.add_argument('--targeted-ratio', type=float, default=0)
+    parser.add_argument('--output', default=None, help='json file to write the results to')
+    args = parser.parse_args()
+    results = []
+    for values in itertools.product(*MATRIX.values()):
+        options = dict(zip(MATRIX.keys(), values))
+        print('== {}'.format(', '.join('{}={}'.format(key, value) for key, value in options.items())))
+        config = BenchConfig.deserialize(dict(
+            clients=args.clients, duration=args.duration, rate=args.rate, size=args.size, targeted_ratio=args.targeted_ratio,
+            **options
+        ))
+        result = run_bench(config, log=lambda msg: None)
+        print(format_result(result))
+        results.append(result)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
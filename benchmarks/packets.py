@@ -0,0 +1,92 @@
+"""
+Cost of the packet classes themselves: slotted classes with generated serializers,
+against the same classes on the reflective Serializable the packets used before
+
+    python -m benchmarks.packets [--count 20000] [--size 100]
+
+"memory" is the bytes allocated for each chat packet with its payload, kept alive
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from typing import List
+
+from chat_bridge_universal.core.network.codec import BINARY_CODEC
+from chat_bridge_universal.core.network.protocal import ChatPacket, ChatPayload
+from chat_bridge_universal.utils.serializer import Serializable
+
+
+class LegacyChatPayload(Serializable):
+    author: str
+    message: str
+
+
+class LegacyChatPacket(Serializable):
+    sender: str
+    receivers: List[str]
+    payload: LegacyChatPayload
+    broadcast: bool
+    channel: str = ''
+    path: List[str] = []
+    origin_id: int = 0
+    sequence: int = 0
+
+
+def measure(func, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+
+def measure_memory(func, count: int) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [func() for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return size / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=100, help='chat message length')
+    args = parser.parse_args()
+    message = 'x' * args.size
+
+    print('{:>8} {:>12} {:>14} {:>14} {:>14} {:>14} {:>12}'.format(
+        'classes', 'construct/s', 'serialize/s', 'deserialize/s', 'json enc/s', 'json dec/s', 'memory'
+    ))
+    for name, packet_type, payload_type in (('legacy', LegacyChatPacket, LegacyChatPayload), ('slotted', ChatPacket, ChatPayload)):
+        def create():
+            return packet_type(
+                sender='survival', receivers=['creative', 'mirror'], broadcast=False,
+                payload=payload_type(author='Steve', message=message)
+            )
+        packet = create()
+        data = packet.serialize()
+        text = json.dumps(data)
+        print('{:>8} {:>12.0f} {:>14.0f} {:>14.0f} {:>14.0f} {:>14.0f} {:>11.0f}B'.format(
+            name,
+            measure(create, args.count),
+            measure(packet.serialize, args.count),
+            measure(lambda: packet_type.deserialize(data), args.count),
+            measure(lambda: json.dumps(packet.serialize()), args.count),
+            measure(lambda: packet_type.deserialize(json.loads(text)), args.count),
+            measure_memory(create, args.count),
+        ))
+
+    packet = ChatPacket(sender='survival', receivers=['creative', 'mirror'], broadcast=False, payload=ChatPayload(author='Steve', message=message))
+    data = BINARY_CODEC.encode(packet)
+    print()
+    print('binary codec: {:.0f} encode/s, {:.0f} decode/s'.format(
+        measure(lambda: BINARY_CODEC.encode(packet), args.count),
+        measure(lambda: BINARY_CODEC.decode(data, ChatPacket), args.count),
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Import time and cold start of the standalone cli, each measured in fresh interpreter processes
+
+    python -m benchmarks.startup [--runs 10] [--output results.json]
+
+"import" is the time to import a module in a new interpreter, next to the time of an interpreter importing nothing.
+"server cold start" is from launching `cbu server` to it answering a login,
+"client cold start" is from launching `cbu client` to it being online on a server started beforehand
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from chat_bridge_universal.core.basic import CBUBase
+from chat_bridge_universal.core.network import network_utils
+from chat_bridge_universal.core.network.cryptor import AESCryptor
+from chat_bridge_universal.core.network.protocal import LoginPacket, LoginResultPacket
+from chat_bridge_universal.core.server import CBUServer
+
+AES_KEY = 'BenchmarkKey'
+PASSWORD = 'BenchmarkPassword'
+MODULES = [
+    'chat_bridge_universal.cli.cli_entry',
+    'chat_bridge_universal.core.client',
+    'chat_bridge_universal.core.server',
+]
+CLI_COMMAND = [sys.executable, '-c', 'from chat_bridge_universal.cli.cli_entry import cli; cli()']
+START_TIMEOUT = 30
+
+
+def measure_import(module: str) -> dict:
+    code = 'import sys, time; t = time.perf_counter(); {}; print(time.perf_counter() - t, "mcdreforged" in sys.modules)'.format(
+        'import ' + module if module != '' else 'pass'
+    )
+    output = subprocess.check_output([sys.executable, '-c', code], text=True).split()
+    return {'seconds': float(output[0]), 'mcdreforged': output[1] == 'True'}
+
+
+def measure_process(command: list) -> float:
+    start = time.perf_counter()
+    subprocess.check_call(command, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_server_config(directory: str, port: int, file_name: str = 'server_config.json') -> str:
+    path = os.path.join(directory, file_name)
+    with open(path, 'w', encoding='utf8') as file:
+        json.dump({'hostname': '127.0.0.1', 'port': port, 'aes_key': AES_KEY, 'clients': [{'name': 'bench', 'password': PASSWORD}]}, file)
+    return path
+
+
+def try_login(port: int) -> bool:
+    cryptor = AESCryptor(AES_KEY)
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=1) as sock:
+            network_utils.send_packet(sock, cryptor, LoginPacket(name='bench', password=PASSWORD))
+            return network_utils.receive_packet(sock, cryptor, LoginResultPacket, timeout=1).success
+    except OSError:
+        return False
+
+
+def measure_server_cold_start(directory: str) -> float:
+    port = get_free_port()
+    config_path = write_server_config(directory, port, 'cold_server_config.json')
+    start = time.perf_counter()
+    process = subprocess.Popen(CLI_COMMAND + ['server', config_path], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, text=True)
+    try:
+        while not try_login(port):
+            if process.poll() is not None or time.perf_counter() - start > START_TIMEOUT:
+                raise RuntimeError('The server did not start')
+            time.sleep(0.001)
+        return time.perf_counter() - start
+    finally:
+        process.communicate('stop\n', timeout=START_TIMEOUT)
+
+
+def measure_client_cold_start(directory: str, server: CBUServer) -> float:
+    config_path = os.path.join(directory, 'client_config.json')
+    with open(config_path, 'w', encoding='utf8') as file:
+        json.dump({'name': 'bench', 'password': PASSWORD, 'aes_key': AES_KEY, 'server_hostname': '127.0.0.1', 'server_port': server.config.port}, file)
+    connection = server._connections['bench']
+    start = time.perf_counter()
+    process = subprocess.Popen(CLI_COMMAND + ['client', config_path], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, text=True)
+    try:
+        while not connection.is_online():
+            if process.poll() is not None or time.perf_counter() - start > START_TIMEOUT:
+                raise RuntimeError('The client did not log in')
+            time.sleep(0.001)
+        return time.perf_counter() - start
+    finally:
+        process.communicate('stop\n', timeout=START_TIMEOUT)
+        while connection.is_online():
+            time.sleep(0.01)
+
+
+def summarize(values: list) -> dict:
+    return {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', default=None, help='json file to write the results to')
+    args = parser.parse_args()
+    results = {}
+
+    print('{:<40} {:>10} {:>10} {:>10} {:>12}'.format('import', 'median', 'min', 'max', 'mcdreforged'))
+    for module in [''] + MODULES:
+        runs = [measure_import(module) for _ in range(args.runs)]
+        result = summarize([run['seconds'] for run in runs])
+        result['mcdreforged'] = any(run['mcdreforged'] for run in runs)
+        results['import ' + (module or '(nothing)')] = result
+        print('{:<40} {:>8.1f}ms {:>8.1f}ms {:>8.1f}ms {:>12}'.format(module or '(nothing)', result['median'] * 1000, result['min'] * 1000, result['max'] * 1000, str(result['mcdreforged'])))
+
+    print()
+    print('{:<40} {:>10} {:>10} {:>10}'.format('process', 'median', 'min', 'max'))
+    with tempfile.TemporaryDirectory() as directory:
+        server_port = get_free_port()
+        server = CBUServer(write_server_config(directory, server_port))
+        server.logger.setLevel(logging.WARNING)
+        for connection in server._connections.values():
+            connection.logger.setLevel(logging.ERROR)  # every cli client closing is fine
+        CBUBase.start(server)
+        try:
+            for name, func in (
+                    ('interpreter', lambda: measure_process([sys.executable, '-c', 'pass'])),
+                    ('cbu --help', lambda: measure_process(CLI_COMMAND + ['--help'])),
+                    ('server cold start', lambda: measure_server_cold_start(directory)),
+                    ('client cold start', lambda: measure_client_cold_start(directory, server)),
+            ):
+                result = summarize([func() for _ in range(args.runs)])
+                results[name] = result
+                print('{:<40} {:>8.1f}ms {:>8.1f}ms {:>8.1f}ms'.format(name, result['median'] * 1000, result['min'] * 1000, result['max'] * 1000))
+        finally:
+            server.stop()
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Scaling of the multi-process server with the worker count, with the same load as `cbu bench`
+
+    python -m benchmarks.workers [--workers 1,2,4] [--client-processes 4] [--clients 40] [--duration 5] [--rate 0] [--output results.json]
+
+The clients run in their own processes, which should be enough of them to saturate the server,
+so the delivery rate is bound by the server workers. A rate of 0 sends as fast as possible
+"""
+import argparse
+import json
+
+from chat_bridge_universal.cli.bench import BenchConfig, run_bench, format_result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts')
+    parser.add_argument('--client-processes', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=40)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--rate', type=float, default=0)
+    parser.add_argument('--size', type=int, default=100)
+    parser.add_argument('--targeted-ratio', type=float, default=0)
+    parser.add_argument('--engine', default='thread')
+    parser.add_argument('--output', default=None, help='json file to write the results to')
+    args = parser.parse_args()
+    results = []
+    base_rate = None
+    for workers in map(int, args.workers.split(',')):
+        print('== workers={}'.format(workers))
+        config = BenchConfig.deserialize(dict(
+            clients=args.clients, duration=args.duration, rate=args.rate, size=args.size, targeted_ratio=args.targeted_ratio,
+            engine=args.engine, workers=workers, client_processes=args.client_processes
+        ))
+        result = run_bench(config, log=lambda msg: None)
+        print(format_result(result))
+        if base_rate is None:
+            base_rate = result['delivery_rate']
+        if base_rate > 0:
+            print('Speedup {:.2f}x'.format(result['delivery_rate'] / base_rate))
+        results.append(result)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
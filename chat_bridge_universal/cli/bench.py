@@ -0,0 +1,338 @@
+"""
+Loopback load generator: a server and synthetic clients in the current process, driving chat traffic through real sockets
+
+The server and the clients share the process, so the cpu time and rss include both sides,
+unless the server runs in worker processes or the clients run in client processes
+"""
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+import time
+from threading import Lock, Barrier, BrokenBarrierError
+from typing import List, Optional, MutableSequence, Callable
+
+from chat_bridge_universal import constants
+from chat_bridge_universal.core.basic import CBUBase
+from chat_bridge_universal.core.client import CBUClient, CBUClientConfig
+from chat_bridge_universal.core.network.codec import LATEST_PROTOCOL_VERSION
+from chat_bridge_universal.core.network.cryptor import DEFAULT_CIPHERS
+from chat_bridge_universal.core.network.protocal import ChatPayload
+from chat_bridge_universal.core.server import CBUServer
+from chat_bridge_universal.utils.serializer import Serializable
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+BENCH_AES_KEY = 'BenchmarkKey'
+BENCH_PASSWORD = 'BenchmarkPassword'
+BARRIER_TIMEOUT = 60
+
+
+class BenchConfig(Serializable):
+    clients: int = 10
+    duration: float = 10  # seconds of sending
+    rate: float = 1000  # messages per second sent by all clients together, 0 for as fast as possible
+    size: int = 100  # chat message length
+    targeted_ratio: float = 0  # share of messages sent to explicit receivers instead of broadcast
+    receivers: int = 1  # receiver count of a targeted message
+    engine: str = 'thread'
+    protocol_version: int = LATEST_PROTOCOL_VERSION
+    cipher: str = DEFAULT_CIPHERS[0]
+    compression: bool = True
+    batch_window: float = 0
+    drain_timeout: float = 5  # seconds to wait for the messages in flight after sending
+    workers: int = 1  # server worker processes, more than 1 runs a CBUServerCluster
+    client_processes: int = 1  # processes sharing the clients and the rate, so the clients are not the bottleneck
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.latencies: List[int] = []  # in nanoseconds
+        self.__lock = Lock()
+
+    def record(self, latency: int):
+        with self.__lock:
+            self.latencies.append(latency)
+
+    def __len__(self):
+        return len(self.latencies)
+
+
+class BenchClient(CBUClient):
+    def __init__(self, config: CBUClientConfig, recorder: LatencyRecorder):
+        super().__init__(config)
+        self.__recorder = recorder
+
+    def on_chat(self, sender: str, payload: ChatPayload):
+        sent_time = int(payload.message.split('|', 1)[0])
+        self.__recorder.record(time.perf_counter_ns() - sent_time)
+
+
+def create_message(size: int) -> str:
+    """
+    The send time is carried in the message, for the end-to-end latency
+    """
+    message = '{}|'.format(time.perf_counter_ns())
+    return message + 'x' * max(0, size - len(message))
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get_max_rss() -> Optional[int]:
+    """
+    Peak resident set size of the process in bytes
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on linux
+
+
+def percentile(sorted_values: List[int], q: float) -> Optional[float]:
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))] / 1e6
+
+
+def create_server(config: BenchConfig, names: List[str]) -> CBUBase:
+    config_path = os.path.join(tempfile.mkdtemp(), 'server_config.json')
+    server_config = {
+        'hostname': '127.0.0.1', 'port': get_free_port(), 'aes_key': BENCH_AES_KEY,
+        'ciphers': [config.cipher], 'compression': config.compression,
+        'clients': [{'name': name, 'password': BENCH_PASSWORD} for name in names]
+    }
+    if config.workers > 1:
+        server_config['history_size'] = 0  # not supported with several workers
+    with open(config_path, 'w', encoding='utf8') as file:
+        json.dump(server_config, file)
+    if config.workers > 1:
+        from chat_bridge_universal.core.cluster import CBUServerCluster
+        cluster = CBUServerCluster(config_path, config.engine, config.workers, log_level=logging.WARNING)
+        cluster.logger.setLevel(logging.WARNING)
+        return cluster
+    if config.engine == 'asyncio':
+        from chat_bridge_universal.core.aio_server import CBUAsyncServer
+        server = CBUAsyncServer(config_path)
+    else:
+        server = CBUServer(config_path)
+    server.logger.setLevel(logging.WARNING)
+    for connection in server._connections.values():
+        connection.logger.setLevel(logging.WARNING)
+    return server
+
+
+def run_clients(config: BenchConfig, names: List[str], index: int, hostname: str, port: int,
+                barrier, expected_counts: MutableSequence[int], delivered_counts: MutableSequence[int], log=print,
+                before_stop: Callable[[], None] = lambda: None) -> dict:
+    """
+    Run the share of the clients of client process #index, sending its share of the rate
+    The client processes meet at the barrier before sending, after sending and before stopping,
+    and count the deliveries expected and done in the shared sequences
+    """
+    recorder = LatencyRecorder()
+    clients: List[BenchClient] = []
+    for name in names[index::config.client_processes]:
+        client = BenchClient(CBUClientConfig(
+            name=name, password=BENCH_PASSWORD, aes_key=BENCH_AES_KEY, server_hostname=hostname, server_port=port,
+            protocol_version=config.protocol_version, ciphers=[config.cipher], compression=config.compression,
+            batch_window=config.batch_window,
+            # server workers start listening a moment after the cluster starts
+            reconnect=config.workers > 1, reconnect_min_delay=0.1, reconnect_max_delay=0.5
+        ), recorder)
+        client.logger.setLevel(logging.WARNING)
+        clients.append(client)
+    try:
+        for client in clients:
+            client.start()
+        deadline = time.monotonic() + 10
+        while not all(client.is_online() for client in clients):
+            if time.monotonic() > deadline:
+                raise RuntimeError('Only {}/{} clients are online'.format(sum(client.is_online() for client in clients), len(clients)))
+            time.sleep(0.05)
+        barrier.wait(BARRIER_TIMEOUT)
+        log('{} clients online, sending for {}s'.format(len(names), config.duration))
+
+        rand = random.Random(index)
+        receiver_count = max(1, min(config.receivers, len(names) - 1))
+        interval = config.client_processes / config.rate if config.rate > 0 else 0
+        sent = expected = 0
+        cpu_start = time.process_time()
+        start = time.monotonic()
+        end = start + config.duration
+        next_time = start
+        while len(clients) > 0:
+            now = time.monotonic()
+            if now >= end:
+                break
+            if now < next_time:
+                time.sleep(next_time - now)
+            next_time += interval
+            client = clients[sent % len(clients)]
+            payload = ChatPayload(author='', message=create_message(config.size))
+            if len(names) > 1 and rand.random() < config.targeted_ratio:
+                client.send_to(rand.sample([name for name in names if name != client.config.name], receiver_count), payload)
+                expected += receiver_count
+            else:
+                client.send_to_all(payload)
+                expected += len(names) - 1
+            sent += 1
+        send_time = time.monotonic() - start
+        expected_counts[index] = expected
+        barrier.wait(BARRIER_TIMEOUT)
+        drain_deadline = time.monotonic() + config.drain_timeout
+        while sum(delivered_counts) < sum(expected_counts) and time.monotonic() < drain_deadline:
+            delivered_counts[index] = len(recorder)
+            time.sleep(0.01)
+        delivered_counts[index] = len(recorder)
+        total_time = time.monotonic() - start
+        cpu_time = time.process_time() - cpu_start
+        barrier.wait(BARRIER_TIMEOUT)  # the clients of other processes might still be receiving
+    finally:
+        # connections closed by the shutdown are expected
+        before_stop()
+        for client in clients:
+            client.logger.setLevel(logging.ERROR)
+            if client.is_running():
+                client.stop()
+    return {
+        'sent': sent, 'expected': expected, 'send_time': send_time, 'total_time': total_time,
+        'cpu_time': cpu_time, 'lifetime_cpu_time': time.process_time(), 'latencies': recorder.latencies,
+    }
+
+
+def _run_client_process(config_data: dict, names: List[str], index: int, hostname: str, port: int,
+                        barrier, expected_counts: MutableSequence[int], delivered_counts: MutableSequence[int], result_queue):
+    """
+    Entry of a client process, the result of run_clients is put into the result queue
+    """
+    try:
+        result = run_clients(BenchConfig.deserialize(config_data), names, index, hostname, port, barrier, expected_counts, delivered_counts, log=lambda msg: None)
+    except Exception as e:
+        barrier.abort()
+        result = {'error': '{}: {}'.format(type(e).__name__, e)}
+    result_queue.put(result)
+
+
+def get_children_cpu_time() -> Optional[float]:
+    """
+    Cpu time of the child processes that have exited
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_bench(config: BenchConfig, log=print) -> dict:
+    names = ['bench{}'.format(i) for i in range(config.clients)]
+    server = create_server(config, names)
+
+    def silence_server():
+        # connections closed by the shutdown are expected
+        if isinstance(server, CBUServer):
+            for connection in server._connections.values():
+                connection.logger.setLevel(logging.ERROR)
+
+    CBUBase.start(server)  # without the console loop
+    children_cpu_start = get_children_cpu_time()
+    try:
+        if config.client_processes <= 1:
+            results = [run_clients(config, names, 0, server.config.hostname, server.config.port, Barrier(1), [0], [0], log, silence_server)]
+        else:
+            context = multiprocessing.get_context('spawn')
+            barrier = context.Barrier(config.client_processes + 1)  # and this process, to know when the clients stop
+            expected_counts, delivered_counts = context.Array('q', config.client_processes), context.Array('q', config.client_processes)
+            result_queue = context.Queue()
+            processes = [
+                context.Process(target=_run_client_process, name='BenchClients#{}'.format(index), daemon=True, args=(
+                    config.serialize(), names, index, server.config.hostname, server.config.port,
+                    barrier, expected_counts, delivered_counts, result_queue
+                ))
+                for index in range(config.client_processes)
+            ]
+            log('Running {} clients in {} processes, sending for {}s'.format(len(names), len(processes), config.duration))
+            cpu_start = time.process_time()
+            for process in processes:
+                process.start()
+            try:
+                for _ in range(3):
+                    barrier.wait(BARRIER_TIMEOUT + config.duration + config.drain_timeout)
+            except BrokenBarrierError:
+                pass  # the client processes report the error
+            silence_server()
+            result_timeout = 10 + config.duration + config.drain_timeout + 3 * BARRIER_TIMEOUT
+            results = [result_queue.get(timeout=result_timeout) for _ in processes]
+            for process in processes:
+                process.join()
+            errors = [result['error'] for result in results if 'error' in result]
+            if len(errors) > 0:
+                raise RuntimeError('Client processes failed: {}'.format('; '.join(errors)))
+            # the in-process server, if any
+            results.append({'cpu_time': time.process_time() - cpu_start, 'lifetime_cpu_time': 0})
+    finally:
+        silence_server()
+        server.stop()
+
+    worker_cpu_time = None
+    children_cpu_end = get_children_cpu_time()
+    if config.workers > 1 and children_cpu_start is not None:
+        client_processes_cpu_time = sum(result['lifetime_cpu_time'] for result in results) if config.client_processes > 1 else 0
+        worker_cpu_time = children_cpu_end - children_cpu_start - client_processes_cpu_time
+    latencies = sorted(latency for result in results for latency in result.get('latencies', ()))
+    sent = sum(result.get('sent', 0) for result in results)
+    expected = sum(result.get('expected', 0) for result in results)
+    send_time = max(result.get('send_time', 0) for result in results)
+    total_time = max(result.get('total_time', 0) for result in results)
+    cpu_time = sum(result['cpu_time'] for result in results)
+    return {
+        'name': constants.NAME,
+        'version': constants.VERSION,
+        'config': config.serialize(),
+        'sent': sent,
+        'expected_deliveries': expected,
+        'deliveries': len(latencies),
+        'lost': max(0, expected - len(latencies)),
+        'send_time': send_time,
+        'send_rate': sent / send_time if send_time > 0 else 0,
+        'delivery_rate': len(latencies) / total_time if total_time > 0 else 0,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'p999': percentile(latencies, 0.999),
+            'max': latencies[-1] / 1e6 if len(latencies) > 0 else None,
+            'mean': sum(latencies) / len(latencies) / 1e6 if len(latencies) > 0 else None,
+        },
+        # of the processes running the clients, and the server if it's not in worker processes
+        'cpu_time': cpu_time,
+        'cpu_usage': cpu_time / total_time if total_time > 0 else 0,  # 1.0 means a whole core
+        'worker_cpu_time': worker_cpu_time,  # of the server worker processes during their whole lifetime
+        'max_rss': get_max_rss(),
+    }
+
+
+def format_result(result: dict) -> str:
+    latency = result['latency_ms']
+
+    def ms(value: Optional[float]) -> str:
+        return '{:.2f}ms'.format(value) if value is not None else 'n/a'
+
+    return '\n'.join([
+        'Sent {} messages in {:.1f}s ({:.0f} msg/s)'.format(result['sent'], result['send_time'], result['send_rate']),
+        'Delivered {}/{} ({:.0f} deliveries/s), lost {}'.format(result['deliveries'], result['expected_deliveries'], result['delivery_rate'], result['lost']),
+        'Latency p50 {} p99 {} p999 {} max {}'.format(ms(latency['p50']), ms(latency['p99']), ms(latency['p999']), ms(latency['max'])),
+        'CPU time {:.2f}s ({:.0%} of a core), max RSS {}'.format(
+            result['cpu_time'], result['cpu_usage'],
+            '{:.1f}MiB'.format(result['max_rss'] / 1024 / 1024) if result['max_rss'] is not None else 'n/a'
+        ),
+    ] + ([
+        'Server workers CPU time {:.2f}s'.format(result['worker_cpu_time'])
+    ] if result['worker_cpu_time'] is not None else []))
@@ -1,8 +1,13 @@
+import json
+from typing import Optional
+
 import click
 
 from chat_bridge_universal import constants
-from chat_bridge_universal.core.server import CBUServer
-from chat_bridge_universal.impl.cli.cli_client import CliClient
+from chat_bridge_universal.core import auth
+from chat_bridge_universal.core.config import load_config
+from chat_bridge_universal.core.network.codec import LATEST_PROTOCOL_VERSION
+from chat_bridge_universal.core.network.cryptor import CIPHERS, DEFAULT_CIPHERS
 
 
 @click.group()
@@ -12,10 +17,26 @@ def cli():
 
 @cli.command()
 @click.argument('config_path', default='./server_config.json')
-def server(config_path: str):
+@click.option('--engine', type=click.Choice(['thread', 'asyncio']), default='thread', show_default=True,
+              help='thread: a thread for each client connection; asyncio: all connections on a single event loop')
+@click.option('--workers', type=click.IntRange(min=1), default=None, help='Worker processes sharing the port, overriding the config')
+def server(config_path: str, engine: str, workers: Optional[int]):
     print('{} v{} server is starting up'.format(constants.NAME, constants.VERSION))
     print('Config file: {}'.format(config_path))
-    CBUServer(config_path).start()
+    print('Engine: {}'.format(engine))
+    # the server modules are imported by the commands using them, so the other commands start faster
+    from chat_bridge_universal.core.server import CBUServer, CBUServerConfig
+    if workers is None:
+        workers = load_config(config_path, CBUServerConfig).workers
+    if workers > 1:
+        from chat_bridge_universal.core.cluster import CBUServerCluster
+        print('Workers: {}'.format(workers))
+        CBUServerCluster(config_path, engine, workers).start()
+    elif engine == 'asyncio':
+        from chat_bridge_universal.core.aio_server import CBUAsyncServer
+        CBUAsyncServer(config_path).start()
+    else:
+        CBUServer(config_path).start()
 
 
 @cli.command()
@@ -23,4 +44,44 @@ def server(config_path: str):
 def client(config_path: str):
     print('{} v{} cli client is starting up'.format(constants.NAME, constants.VERSION))
     print('Config file: {}'.format(config_path))
+    from chat_bridge_universal.impl.cli.cli_client import CliClient
     CliClient(config_path).start()
+
+
+@cli.command('hash-password')
+@click.option('--iterations', type=click.IntRange(min=1), default=auth.DEFAULT_HASH_ITERATIONS, show_default=True)
+@click.password_option()
+def hash_password(iterations: int, password: str):
+    """
+    Hash a client password for the server config
+    """
+    print(auth.hash_password(password, iterations))
+
+
+@cli.command()
+@click.option('--clients', type=int, default=10, show_default=True, help='Amount of synthetic clients')
+@click.option('--duration', type=float, default=10, show_default=True, help='Seconds of sending')
+@click.option('--rate', type=float, default=1000, show_default=True, help='Messages per second of all clients together, 0 for as fast as possible')
+@click.option('--size', type=int, default=100, show_default=True, help='Chat message length')
+@click.option('--targeted-ratio', type=click.FloatRange(0, 1), default=0, show_default=True, help='Share of messages sent to explicit receivers instead of broadcast')
+@click.option('--receivers', type=int, default=1, show_default=True, help='Receiver count of a targeted message')
+@click.option('--engine', type=click.Choice(['thread', 'asyncio']), default='thread', show_default=True)
+@click.option('--protocol-version', type=int, default=LATEST_PROTOCOL_VERSION, show_default=True)
+@click.option('--cipher', type=click.Choice(list(CIPHERS.keys())), default=DEFAULT_CIPHERS[0], show_default=True)
+@click.option('--compression/--no-compression', default=True, show_default=True)
+@click.option('--batch-window', type=float, default=0, show_default=True, help='Batch window of the clients in seconds')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True, help='Server worker processes')
+@click.option('--client-processes', type=click.IntRange(min=1), default=1, show_default=True, help='Processes running the synthetic clients')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), default=None, help='Write the results as json to this file')
+def bench(output: Optional[str], **kwargs):
+    """
+    Benchmark a server and synthetic clients on loopback
+    """
+    from chat_bridge_universal.cli.bench import BenchConfig, run_bench, format_result
+    print('{} v{} benchmark'.format(constants.NAME, constants.VERSION))
+    result = run_bench(BenchConfig.deserialize(kwargs))
+    print(format_result(result))
+    if output is not None:
+        with open(output, 'w', encoding='utf8') as file:
+            json.dump(result, file, indent=4)
+        print('Results written to {}'.format(output))
@@ -0,0 +1,369 @@
+import asyncio
+import time
+from typing import Optional, List, Set
+
+from chat_bridge_universal.core.client import CBUClientConfig, LoginRejected, get_reconnect_delay
+from chat_bridge_universal.core.metrics import REGISTRY, ConnectionMetrics, or_nan
+from chat_bridge_universal.core.network import network_utils, codec, cryptor, compressor, streaming
+from chat_bridge_universal.core.network.codec import PROTOCOL_VERSION_BINARY
+from chat_bridge_universal.core.network.compressor import Compressor
+from chat_bridge_universal.core.network.heartbeat import Heartbeat, create_heartbeat
+from chat_bridge_universal.core.network.streaming import StreamAssembler
+from chat_bridge_universal.core.network.protocal import LoginPacket, LoginResultPacket, ChatPacket, ChatPayload, \
+    AbstractPayload, AbstractPacket, BatchPacket, PingPacket, PongPacket, ChannelPacket, TicketPacket
+from chat_bridge_universal.utils.logger import CBULogger, Lazy
+
+DEFAULT_INBOX_SIZE = 1024
+
+
+class AsyncCBUClient:
+    """
+    The asyncio counterpart of CBUClient, speaking the same protocol, for bots and integrations running on an event loop
+    Any amount of them can share a loop. All methods are supposed to be invoked on that loop
+
+        async with AsyncCBUClient(config) as client:
+            await client.send_chat('hello')
+            async for packet in client:
+                print(packet.sender, packet.payload.formatted_str)
+
+    Chats received wait in an inbox of inbox_size chats, and the connection is not read while it's full,
+    so a slow consumer pushes back on the server instead of piling up memory. Pings are still sent meanwhile,
+    and the silence of the server isn't taken as a dead connection. Sending waits for the chat
+    to be written to the socket, and while reconnecting waits for the connection to be online again,
+    up to outbox_max_age seconds. batch_window and outbox_size of the config are not used
+    """
+    def __init__(self, config: CBUClientConfig, *, inbox_size: int = DEFAULT_INBOX_SIZE):
+        self.config = config
+        self.logger = CBULogger('AsyncClient.{}'.format(config.name))
+        self.__inbox_size = inbox_size
+        self.__inbox: Optional['asyncio.Queue[Optional[ChatPacket]]'] = None
+        self.__waiting_consumer = False  # the receive loop waits for the consumer to take a chat from the full inbox
+        self.__reader: Optional[asyncio.StreamReader] = None
+        self.__writer: Optional[asyncio.StreamWriter] = None
+        self.__send_lock: Optional[asyncio.Lock] = None
+        self.__online_event: Optional[asyncio.Event] = None
+        self.__run_task: Optional[asyncio.Task] = None
+        self.__closed = False
+        self.__codec: codec.AbstractCodec = codec.JSON_CODEC
+        self.__cryptor: cryptor.AbstractCryptor = cryptor.AESCryptor(config.aes_key)
+        self.__compressor: Optional[Compressor] = None
+        self.__compression_dictionary: Optional[bytes] = compressor.load_dictionary(config.compression_dictionary)
+        self.__heartbeat: Optional[Heartbeat] = None
+        self.__channels: Set[str] = set(config.channels)
+        self.__last_sequence = 0
+        self.__ticket = ''
+        self.__ticket_renew_time: Optional[float] = None
+        self.__chunking = False
+        self.metrics = ConnectionMetrics('client', config.name)
+        self.__assembler = StreamAssembler(config.max_stream_size, config.max_stream_memory, self.logger, self.metrics.labels)
+        self.reconnects = REGISTRY.counter('cbu_reconnects_total', 'Reconnect attempts of clients', self.metrics.labels)
+        REGISTRY.gauge('cbu_online', 'Whether the connection is online', self.metrics.labels, lambda: int(self.is_online()))
+        REGISTRY.gauge('cbu_rtt_seconds', 'Latest round trip time measured by heartbeats', self.metrics.labels, lambda: or_nan(self.get_rtt()))
+        REGISTRY.gauge('cbu_inbox_size', 'Chats received and waiting to be taken', self.metrics.labels, self.get_inbox_size)
+
+    # -------------------
+    #      Lifecycle
+    # -------------------
+
+    async def connect(self):
+        """
+        Connect and login to the server, then keep the connection in the background till close() is called
+        Raises LoginRejected if the server refuses the login, or OSError if the server can't be reached
+        Later connection losses are reconnected if reconnect is enabled in the config
+        """
+        if self.__run_task is not None:
+            raise RuntimeError('Already running')
+        self.__closed = False
+        self.__inbox = asyncio.Queue(max(1, self.__inbox_size))
+        self.__send_lock = asyncio.Lock()
+        self.__online_event = asyncio.Event()
+        await self.__connect_and_login()
+        self.__run_task = asyncio.ensure_future(self.__run())
+
+    async def close(self):
+        """
+        Disconnect, and end the iteration over the chats after the ones received already are taken
+        """
+        task, self.__run_task = self.__run_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.__shutdown()
+
+    def __shutdown(self):
+        self.__closed = True
+        self.__run_task = None
+        self.__go_offline()
+        if self.__inbox is not None:
+            try:
+                self.__inbox.put_nowait(None)
+            except asyncio.QueueFull:  # receive() checks __closed once it's drained
+                pass
+        self.logger.info('bye')
+
+    async def __aenter__(self) -> 'AsyncCBUClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def is_online(self) -> bool:
+        return self.__writer is not None
+
+    def get_rtt(self) -> Optional[float]:
+        heartbeat = self.__heartbeat
+        return heartbeat.rtt if heartbeat is not None else None
+
+    def get_last_sequence(self) -> int:
+        return self.__last_sequence
+
+    def get_inbox_size(self) -> int:
+        return self.__inbox.qsize() if self.__inbox is not None else 0
+
+    async def __connect_and_login(self):
+        address = self.config.server_address
+        self.logger.info('Connecting to {}'.format(address))
+        reader, writer = await asyncio.open_connection(address.hostname, address.port)
+        try:
+            login_cryptor = cryptor.AESCryptor(self.config.aes_key)
+            writer.write(network_utils.encode_packet(login_cryptor, LoginPacket(
+                name=self.config.name, password=self.config.password,
+                protocol_version=self.config.protocol_version, ciphers=self.config.ciphers,
+                compressions=compressor.get_supported_compressions(self.__compression_dictionary) if self.config.compression else [],
+                channels=sorted(self.__channels), last_sequence=self.__last_sequence if self.config.catch_up else 0, ticket=self.__ticket, chunking=True
+            )))
+            await writer.drain()
+            result = await asyncio.wait_for(
+                network_utils.receive_packet_async(reader, login_cryptor, LoginResultPacket, max_frame_size=self.config.max_frame_size),
+                timeout=network_utils.RECEIVE_TIMEOUT
+            )
+            if not result.success:
+                self.__ticket = ''
+                raise LoginRejected(result.message)
+        except BaseException:
+            writer.close()
+            raise
+        self.logger.info('Logged in to the server')
+        self.__codec = codec.get_codec(result.protocol_version)
+        self.__cryptor = cryptor.create_cryptor(result.cipher, self.config.aes_key)
+        self.__compressor = compressor.create_compressor(
+            result.compression, self.__compression_dictionary, threshold=self.config.compression_threshold,
+            level=self.config.compression_level, max_size=self.config.max_frame_size
+        )
+        self.__chunking = result.chunking
+        self.__assembler.reset()
+        self.logger.debug('Using protocol version {}, cipher {}, compression {}'.format(self.__codec.version, self.__cryptor.name, result.compression or 'none'))
+        self.__set_ticket(result.ticket, result.ticket_lifetime)
+        # pings and ticket renewals are v1 incompatible, since v1 frames carry no packet type
+        self.__heartbeat = create_heartbeat(self.config.heartbeat_interval, self.config.heartbeat_max_missed) \
+            if self.__codec.version >= PROTOCOL_VERSION_BINARY else None
+        self.__reader, self.__writer = reader, writer
+        self.__online_event.set()
+
+    def __go_offline(self):
+        writer, self.__writer = self.__writer, None
+        if self.__online_event is not None:
+            self.__online_event.clear()
+        if writer is not None:
+            writer.close()
+
+    async def __run(self):
+        attempt = 0
+        while True:
+            keepalive_task = asyncio.ensure_future(self.__keepalive_loop(self.__writer))
+            try:
+                await self.__receive_loop(self.__reader)
+            except (ConnectionError, network_utils.EmptyContent, network_utils.FrameTooLarge) as e:
+                self.logger.warning('Connection closed: {}'.format(e))
+            except Exception as e:
+                self.logger.exception('Error receiving from the server: {}'.format(e))
+            finally:
+                keepalive_task.cancel()
+                self.__go_offline()
+            while True:
+                if not self.config.reconnect:
+                    self.__shutdown()
+                    return
+                delay = get_reconnect_delay(attempt, self.config.reconnect_min_delay, self.config.reconnect_max_delay)
+                attempt += 1
+                self.reconnects.inc()
+                self.logger.info('Reconnecting in {:.1f}s'.format(delay))
+                await asyncio.sleep(delay)
+                try:
+                    await self.__connect_and_login()
+                except LoginRejected as e:
+                    self.logger.error('Failed to login to the server: {}'.format(e))
+                    self.__shutdown()
+                    return
+                except Exception as e:
+                    self.logger.error('Failed to connect {}: {}'.format(self.config.server_address, e))
+                else:
+                    attempt = 0
+                    break
+
+    async def __receive_loop(self, reader: asyncio.StreamReader):
+        # v1 frames carry no packet type, so only chat packets can be sent after login
+        packet_type = AbstractPacket if self.__codec.version >= PROTOCOL_VERSION_BINARY else ChatPacket
+        while True:
+            frame = await network_utils.read_frame_async(reader, self.__codec.header, self.config.max_frame_size)
+            self.metrics.on_received(self.__codec.header.size + len(frame))
+            packet = network_utils.decode_packet(self.__cryptor, frame, packet_type, self.__codec, self.__compressor)
+            self.logger.debug(Lazy(lambda: 'Received {} : {}'.format(type(packet).__name__, packet.serialize())))
+            if self.__heartbeat is not None:
+                self.__heartbeat.on_received()
+            packet = self.__assembler.assemble(packet, self.__codec, packet_type)
+            if packet is None:
+                pass
+            elif isinstance(packet, PingPacket):
+                await self.send_packet(PongPacket(timestamp=packet.timestamp))
+            elif isinstance(packet, PongPacket):
+                if self.__heartbeat is not None:
+                    self.__heartbeat.on_pong(packet)
+            elif isinstance(packet, TicketPacket):
+                self.__set_ticket(packet.ticket, packet.lifetime)
+            elif isinstance(packet, BatchPacket):
+                for chat_packet in packet.packets:
+                    await self.__on_chat_packet(chat_packet)
+            elif isinstance(packet, ChatPacket):
+                await self.__on_chat_packet(packet)
+
+    async def __on_chat_packet(self, packet: ChatPacket):
+        self.__last_sequence = max(self.__last_sequence, packet.sequence)
+        if not self.__inbox.full():
+            self.__inbox.put_nowait(packet)
+            return
+        # waits while the inbox is full, which stops reading from the server. The frames the server sends
+        # meanwhile wait in the socket, so the heartbeat doesn't count the wait as silence
+        self.__waiting_consumer = True
+        try:
+            await self.__inbox.put(packet)
+        finally:
+            self.__waiting_consumer = False
+            if self.__heartbeat is not None:
+                self.__heartbeat.on_received()
+
+    async def __keepalive_loop(self, writer: asyncio.StreamWriter):
+        heartbeat = self.__heartbeat
+        while True:
+            await asyncio.sleep(heartbeat.poll_interval if heartbeat is not None else 1)
+            if heartbeat is not None:
+                if heartbeat.is_dead() and not self.__waiting_consumer:
+                    self.logger.warning('No data received in {} heartbeat intervals, disconnecting'.format(heartbeat.max_missed))
+                    if self.__writer is writer:
+                        self.__go_offline()
+                    else:
+                        writer.close()
+                    return
+                ping = heartbeat.poll_ping()
+                if ping is not None:
+                    await self.send_packet(ping)
+            if self.__ticket_renew_time is not None and time.monotonic() >= self.__ticket_renew_time:
+                self.__ticket_renew_time = None
+                await self.send_packet(TicketPacket())
+
+    def __set_ticket(self, ticket: str, lifetime: float):
+        self.__ticket = ticket
+        # renewed halfway through its lifetime, like CBUClient does
+        if ticket != '' and lifetime > 0 and self.__codec.version >= PROTOCOL_VERSION_BINARY:
+            self.__ticket_renew_time = time.monotonic() + lifetime / 2
+        else:
+            self.__ticket_renew_time = None
+
+    # -------------------
+    #      Receiving
+    # -------------------
+
+    async def receive(self) -> Optional[ChatPacket]:
+        """
+        Wait for the next chat packet, None if the client is closed and every chat received has been taken
+        """
+        if self.__inbox is None or (self.__closed and self.__inbox.empty()):
+            return None
+        return await self.__inbox.get()
+
+    def __aiter__(self) -> 'AsyncCBUClient':
+        return self
+
+    async def __anext__(self) -> ChatPacket:
+        packet = await self.receive()
+        if packet is None:
+            raise StopAsyncIteration
+        return packet
+
+    # -------------------
+    #       Sending
+    # -------------------
+
+    async def send_packet(self, packet: AbstractPacket):
+        """
+        Send the packet on the current connection, waiting till the socket buffer has room for it
+        Raises ConnectionError if the client is not online
+        """
+        writer = self.__writer
+        if writer is None:
+            raise ConnectionError('Not online')
+        chunk_size = self.config.chunk_size if self.__chunking and self.__codec.version >= PROTOCOL_VERSION_BINARY else 0
+        # the chunks of a large packet are sent one by one, so other tasks can send their frames in between
+        for data in streaming.encode_frames(self.__cryptor, packet, self.__codec, self.__compressor, chunk_size):
+            async with self.__send_lock:
+                writer.write(data)
+                self.metrics.on_sent(len(data))
+                await writer.drain()
+
+    async def __send_chat_packet(self, packet: ChatPacket):
+        deadline = time.monotonic() + self.config.outbox_max_age
+        while True:
+            if not self.is_online():
+                if self.__closed or self.__online_event is None:
+                    raise ConnectionError('Client is closed')
+                try:
+                    await asyncio.wait_for(self.__online_event.wait(), timeout=max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    raise ConnectionError('Not online in {}s'.format(self.config.outbox_max_age)) from None
+            try:
+                await self.send_packet(packet)
+                return
+            except ConnectionError as e:
+                if self.__closed or time.monotonic() >= deadline:
+                    raise
+                self.logger.warning('Failed to send chat packet, retrying after reconnecting: {}'.format(e))
+                self.__go_offline()
+
+    async def send_chat(self, message: str, author: str = ''):
+        await self.send_to_all(ChatPayload(author=author, message=message))
+
+    async def send_to_all(self, payload: AbstractPayload):
+        await self.__send_chat_packet(ChatPacket(sender=self.config.name, receivers=[], broadcast=True, payload=payload))
+
+    async def send_to_channel(self, channel: str, payload: AbstractPayload):
+        await self.__send_chat_packet(ChatPacket(sender=self.config.name, receivers=[], broadcast=False, payload=payload, channel=channel))
+
+    async def send_to(self, receivers: List[str], payload: AbstractPayload):
+        await self.__send_chat_packet(ChatPacket(sender=self.config.name, receivers=receivers, broadcast=False, payload=payload))
+
+    def get_channels(self) -> List[str]:
+        return sorted(self.__channels)
+
+    async def join_channel(self, channel: str):
+        """
+        Receive chats sent to the channel. With protocol v1 it takes effect since the next login
+        """
+        await self.__update_channel(channel, True)
+
+    async def leave_channel(self, channel: str):
+        await self.__update_channel(channel, False)
+
+    async def __update_channel(self, channel: str, join: bool):
+        if join:
+            self.__channels.add(channel)
+        else:
+            self.__channels.discard(channel)
+        if self.is_online() and self.__codec.version >= PROTOCOL_VERSION_BINARY:
+            try:
+                await self.send_packet(ChannelPacket(join=[channel]) if join else ChannelPacket(leave=[channel]))
+            except ConnectionError as e:
+                self.logger.warning('Failed to send channel update: {}'.format(e))
@@ -0,0 +1,322 @@
+import asyncio
+from typing import Optional, Callable, List
+
+from chat_bridge_universal.core.basic import Address
+from chat_bridge_universal.core.config import ClientMeta
+from chat_bridge_universal.core.metrics import REGISTRY, ConnectionMetrics, or_nan
+from chat_bridge_universal.core.network import network_utils, codec, cryptor, streaming
+from chat_bridge_universal.core.network.admission import MAX_LOGIN_FRAME_SIZE
+from chat_bridge_universal.core.network.compressor import Compressor
+from chat_bridge_universal.core.network.heartbeat import Heartbeat, create_heartbeat
+from chat_bridge_universal.core.network.outbound import OutboundBuffer
+from chat_bridge_universal.core.network.streaming import StreamAssembler
+from chat_bridge_universal.core.network.protocal import LoginPacket, ChatPacket, AbstractPacket, LoginResultPacket, \
+    BatchPacket, PingPacket, PongPacket, ChannelPacket, TicketPacket
+from chat_bridge_universal.core.server import CBUServer, CBUServerState
+from chat_bridge_universal.utils.logger import CBULogger, Lazy
+
+
+class AsyncClientConnection:
+    """
+    The asyncio engine counterpart of ClientConnection
+    All methods are supposed to be invoked on the event loop thread of the server
+    """
+    def __init__(self, server: 'CBUAsyncServer', meta: ClientMeta):
+        self.config = meta
+        self.logger = CBULogger('Server.{}'.format(meta.name))
+        self.__server = server
+        self.__writer: Optional[asyncio.StreamWriter] = None
+        self.__outbound: Optional[OutboundBuffer] = None
+        self.__outbound_event: Optional[asyncio.Event] = None
+        self.__codec: codec.AbstractCodec = codec.JSON_CODEC
+        self.__cryptor: cryptor.AbstractCryptor = cryptor.AESCryptor(server.config.aes_key)
+        self.__compressor: Optional[Compressor] = None
+        self.__heartbeat: Optional[Heartbeat] = None
+        self.__chunking = False
+        self.metrics = ConnectionMetrics('server', meta.name)
+        self.__assembler = StreamAssembler(server.config.max_stream_size, server.config.max_stream_memory, self.logger, self.metrics.labels)
+        REGISTRY.gauge('cbu_online', 'Whether the connection is online', self.metrics.labels, lambda: int(self.is_online()))
+        REGISTRY.gauge('cbu_rtt_seconds', 'Latest round trip time measured by heartbeats', self.metrics.labels, lambda: or_nan(self.get_rtt()))
+        REGISTRY.gauge('cbu_outbound_queue_depth', 'Frames waiting to be sent to the client', self.metrics.labels, self.get_outbound_queue_depth)
+        REGISTRY.gauge('cbu_outbound_queue_bytes', 'Bytes of the frames waiting to be sent to the client', self.metrics.labels, self.get_outbound_queue_bytes)
+        REGISTRY.gauge('cbu_outbound_dropped', 'Frames dropped because the outbound queue is full', self.metrics.labels, self.get_outbound_dropped_count)
+
+    def is_online(self) -> bool:
+        return self.__writer is not None
+
+    def is_peer(self) -> bool:
+        return self.config.peer
+
+    def get_codec(self) -> codec.AbstractCodec:
+        return self.__codec
+
+    def get_cryptor(self) -> cryptor.AbstractCryptor:
+        return self.__cryptor
+
+    def get_compressor(self) -> Optional[Compressor]:
+        return self.__compressor
+
+    def get_chunk_size(self) -> int:
+        return self.__server.config.chunk_size if self.__chunking and self.__codec.version >= codec.PROTOCOL_VERSION_BINARY else 0
+
+    def get_rtt(self) -> Optional[float]:
+        heartbeat = self.__heartbeat
+        return heartbeat.rtt if heartbeat is not None else None
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, login_result: LoginResultPacket):
+        if self.is_online():
+            raise RuntimeError('Already running')
+        self.__writer = writer
+        self.__codec = codec.get_codec(login_result.protocol_version)
+        self.__cryptor = cryptor.create_cryptor(login_result.cipher, self.__server.config.aes_key)
+        self.__compressor = self.__server._create_compressor(login_result.compression)
+        self.__chunking = login_result.chunking
+        self.__assembler.reset()
+        self.__outbound = OutboundBuffer(
+            self.__server.config.outbound_queue_size, self.__server.config.outbound_overflow_policy, self.__server.config.outbound_queue_bytes
+        )
+        self.__outbound_event = asyncio.Event()
+        write_task = asyncio.ensure_future(self.__write_loop(writer, self.__outbound, self.__outbound_event))
+        heartbeat_task = None
+        # v1 frames carry no packet type, so only chat packets can be sent after login
+        packet_type = ChatPacket
+        self.__heartbeat = None
+        if self.__codec.version >= codec.PROTOCOL_VERSION_BINARY:
+            packet_type = AbstractPacket
+            self.__heartbeat = create_heartbeat(self.__server.config.heartbeat_interval, self.__server.config.heartbeat_max_missed)
+            if self.__heartbeat is not None:
+                heartbeat_task = asyncio.ensure_future(self.__heartbeat_loop(writer, self.__heartbeat))
+        try:
+            # reading the history log touches files, which is kept off the event loop
+            logged = await asyncio.get_event_loop().run_in_executor(None, self.__server._read_logged_history, self)
+            self.__server._update_routing(self, logged)
+            while True:
+                frame = await network_utils.read_frame_async(reader, self.__codec.header, self.__server.config.max_frame_size)
+                self.metrics.on_received(self.__codec.header.size + len(frame))
+                packet = network_utils.decode_packet(self.__cryptor, frame, packet_type, self.__codec, self.__compressor)
+                self.logger.debug(Lazy(lambda: 'Received {} : {}'.format(type(packet).__name__, packet.serialize())))
+                if self.__heartbeat is not None:
+                    self.__heartbeat.on_received()
+                packet = self.__assembler.assemble(packet, self.__codec, packet_type)
+                try:
+                    if packet is None:
+                        pass
+                    elif isinstance(packet, PingPacket):
+                        self.send_packet(PongPacket(timestamp=packet.timestamp))
+                    elif isinstance(packet, PongPacket):
+                        if self.__heartbeat is not None:
+                            self.__heartbeat.on_pong(packet)
+                    elif isinstance(packet, TicketPacket):
+                        self.send_packet(self.__server._issue_ticket(self.config.name))
+                    elif isinstance(packet, (ChatPacket, BatchPacket)):
+                        chat_packets = [p for p in packet.packets if isinstance(p, ChatPacket)] if isinstance(packet, BatchPacket) else [packet]
+                        chat_packets, delay = self.__server._check_ingress(self.config.name, chat_packets)
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                        self.__server._process_chats(self.config.name, chat_packets, self.config.peer)
+                    elif isinstance(packet, ChannelPacket) and not self.config.peer:
+                        self.__server.update_channels(self.config.name, packet.join, packet.leave)
+                except Exception as e:
+                    self.logger.exception('Fail to process packet {}: {}'.format(packet, e))
+        except (ConnectionError, network_utils.EmptyContent, network_utils.FrameTooLarge) as e:
+            self.logger.warning('Connection closed: {}'.format(e))
+        except Exception as e:
+            self.logger.exception('Error ticking client connection: {}'.format(e))
+        finally:
+            self.__writer = None
+            self.__server._update_routing(self)
+            write_task.cancel()
+            if heartbeat_task is not None:
+                heartbeat_task.cancel()
+            writer.close()
+        self.logger.info('bye')
+
+    async def __heartbeat_loop(self, writer: asyncio.StreamWriter, heartbeat: Heartbeat):
+        while True:
+            await asyncio.sleep(heartbeat.poll_interval)
+            if heartbeat.is_dead():
+                self.logger.warning('No data received in {} heartbeat intervals, disconnecting'.format(heartbeat.max_missed))
+                writer.close()
+                return
+            ping = heartbeat.poll_ping()
+            if ping is not None:
+                self.send_packet(ping)
+
+    async def __write_loop(self, writer: asyncio.StreamWriter, outbound: OutboundBuffer, outbound_event: asyncio.Event):
+        try:
+            while True:
+                await outbound_event.wait()
+                outbound_event.clear()
+                data = outbound.poll()
+                while data is not None:
+                    writer.write(data)
+                    self.metrics.on_sent(len(data))
+                    # returns at once unless the transport buffer is full, so the chunks of a large packet
+                    # don't all sit in the transport buffer ahead of the frames queued after them
+                    await writer.drain()
+                    data = outbound.poll()
+        except ConnectionError as e:
+            self.logger.warning('Failed to send data: {}'.format(e))
+            writer.close()
+
+    def send_packet(self, packet: AbstractPacket):
+        self.send_frames(streaming.encode_frames(self.__cryptor, packet, self.__codec, self.__compressor, self.get_chunk_size()))
+
+    def send_frames(self, frames: List[bytes]):
+        """
+        Queue the frames of a packet, the chunks of a large packet are sent after the other frames queued meanwhile
+        """
+        if len(frames) == 1:
+            self.send_data(frames[0])
+        elif self.__writer is not None:
+            self.__on_offered(self.__outbound.offer_stream(frames))
+
+    def send_data(self, data: bytes):
+        """
+        Queue already framed bytes for the writer task, it never blocks
+        """
+        if self.__writer is not None:
+            self.__on_offered(self.__outbound.offer(data))
+
+    def __on_offered(self, accepted: bool):
+        if accepted:
+            self.__outbound_event.set()
+        else:
+            self.logger.warning('Outbound queue is full ({} frames), disconnecting the slow client'.format(len(self.__outbound)))
+            self.__writer.close()
+
+    def get_outbound_queue_depth(self) -> int:
+        return len(self.__outbound) if self.__outbound is not None else 0
+
+    def get_outbound_queue_bytes(self) -> int:
+        return self.__outbound.size_bytes if self.__outbound is not None else 0
+
+    def get_outbound_dropped_count(self) -> int:
+        return self.__outbound.dropped if self.__outbound is not None else 0
+
+    def close(self):
+        if self.__writer is not None:
+            self.__writer.close()
+
+
+class CBUAsyncServer(CBUServer):
+    """
+    A CBUServer that handles every connection on a single asyncio event loop,
+    instead of a thread for each client connection
+
+    Login check and packet routing are shared with CBUServer, and it speaks exactly the same protocol
+    """
+    def __init__(self, config_path: str, *, history: bool = True):
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__stop_event: Optional[asyncio.Event] = None
+        self.__pending_handshakes = 0
+        super().__init__(config_path, history=history)
+
+    def _create_connection(self, meta: ClientMeta) -> AsyncClientConnection:
+        return AsyncClientConnection(self, meta)
+
+    def _run_in_loop(self, function: Callable, *args):
+        loop = self.__loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(function, *args)
+            except RuntimeError:  # the loop is closed
+                pass
+
+    def _get_pending_handshake_count(self) -> int:
+        return self.__pending_handshakes
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = Address(*writer.get_extra_info('peername')[:2])
+        if not self._admit(address):
+            writer.close()
+            return
+        if self.__pending_handshakes >= self.config.max_pending_handshakes:
+            self.logger.debug('Refused connection from {}: too many pending handshakes'.format(address))
+            self._count_handshake('busy')
+            writer.close()
+            return
+        self.logger.info('New connection from {}'.format(address))
+        self.__pending_handshakes += 1
+        try:
+            login_packet = await asyncio.wait_for(
+                network_utils.receive_packet_async(
+                    reader, self._cryptor, LoginPacket, max_frame_size=min(self.config.max_frame_size, MAX_LOGIN_FRAME_SIZE)
+                ),
+                timeout=self.config.login_timeout
+            )
+        except asyncio.TimeoutError:
+            self.logger.warning('Connection from {} sent no login packet in {}s'.format(address, self.config.login_timeout))
+            self._count_handshake('timeout')
+            writer.close()
+            return
+        except Exception as e:
+            self.logger.warning('Failed to receive login packet from {}: {}'.format(address, e))
+            self._count_handshake('error')
+            writer.close()
+            return
+        finally:
+            self.__pending_handshakes -= 1
+        self._count_handshake('login')
+        try:
+            await self.__login(reader, writer, login_packet, address)
+        except Exception as e:
+            self.logger.exception('Error handling login from {}: {}'.format(address, e))
+        finally:
+            # also closes the writer when the task is cancelled while the login is checked
+            writer.close()
+
+    async def __login(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, login_packet: LoginPacket, address: Address):
+        if self._is_login_check_slow(login_packet):
+            # hashing a password takes a while, don't hold up the other connections
+            connection, result = await self.__loop.run_in_executor(None, self._check_login, login_packet, address)
+        else:
+            connection, result = self._check_login(login_packet, address)
+        if result is not None:
+            writer.write(network_utils.encode_packet(self._cryptor, result))
+        if connection is not None:
+            try:
+                await connection.serve(reader, writer, result)
+            except RuntimeError as e:
+                self.logger.warning('Cannot open connection for {}: {}'.format(connection.config.name, e))
+
+    async def __serve(self):
+        self.__stop_event = asyncio.Event()
+        try:
+            server = await asyncio.start_server(
+                self.__handle_connection, self.config.hostname, self.config.port,
+                backlog=self.config.listen_backlog, reuse_port=self._reuse_port or None
+            )
+        except OSError:
+            self.logger.error('Failed to bind {}'.format(self.config.address))
+            return
+        self.logger.info('Server started @ {}'.format(self.config.address))
+        self.logger.info('Waiting for connections')
+        self._set_state(CBUServerState.RUNNING)
+        self._start_metrics_server()
+        self._start_links()
+        await self.__stop_event.wait()
+        server.close()
+        for connection in self._connections.values():
+            connection.close()
+        await server.wait_closed()
+
+    def _main_loop(self):
+        self.assert_state(CBUServerState.STOPPED)
+        self._set_state(CBUServerState.STARTING)
+        self.__loop = asyncio.new_event_loop()
+        try:
+            self.__loop.run_until_complete(self.__serve())
+        except Exception as e:
+            self.logger.exception('Error running event loop: {}'.format(e))
+        finally:
+            self.__loop.close()
+            self.__loop = None
+            self._stop()
+        self.logger.info('bye')
+
+    def _stop(self):
+        loop, stop_event = self.__loop, self.__stop_event
+        if loop is not None and stop_event is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(stop_event.set)
+        super()._stop()
@@ -0,0 +1,67 @@
+"""
+Credentials of the clients configured on the server, and resumption tickets
+
+A password in the server config is either plain text or a pbkdf2 hash made by `hash-password`.
+Hashes are slow to check on purpose, so a client logging in gets a ticket, and presents it when reconnecting
+to skip the password check. Tickets are signed with a key derived from the stored credential of the client,
+so they are valid for every worker of a cluster and after restarts, until they expire or the password is changed
+"""
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+HASH_ALGORITHM = 'pbkdf2_sha256'
+DEFAULT_HASH_ITERATIONS = 100000
+_SALT_SIZE = 16
+
+
+def hash_password(password: str, iterations: int = DEFAULT_HASH_ITERATIONS) -> str:
+    salt = os.urandom(_SALT_SIZE)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf8'), salt, iterations)
+    return '{}${}${}${}'.format(HASH_ALGORITHM, iterations, base64.b64encode(salt).decode(), base64.b64encode(digest).decode())
+
+
+def is_hashed(credential: str) -> bool:
+    return credential.startswith(HASH_ALGORITHM + '$')
+
+
+def verify_password(credential: str, password: str) -> bool:
+    """
+    :param credential: the password in the server config, plain text or hashed
+    """
+    if not is_hashed(credential):
+        return hmac.compare_digest(credential.encode('utf8'), password.encode('utf8'))
+    try:
+        _, iterations, salt, digest = credential.split('$')
+        expected = base64.b64decode(digest)
+        actual = hashlib.pbkdf2_hmac('sha256', password.encode('utf8'), base64.b64decode(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected, actual)
+
+
+def _sign_ticket(server_name: str, name: str, credential: str, expiry: int) -> str:
+    key = hashlib.sha256('cbu-ticket\0{}\0{}'.format(server_name, credential).encode('utf8')).digest()
+    return hmac.new(key, '{}\0{}'.format(name, expiry).encode('utf8'), hashlib.sha256).hexdigest()
+
+
+def issue_ticket(server_name: str, name: str, credential: str, lifetime: float) -> str:
+    expiry = int(time.time() + lifetime)
+    return '{}:{}'.format(expiry, _sign_ticket(server_name, name, credential, expiry))
+
+
+def verify_ticket(server_name: str, name: str, credential: str, ticket: str, lifetime: float) -> bool:
+    """
+    :param lifetime: the current ticket lifetime of the server, tickets given with a longer one before are accepted only that long
+    """
+    try:
+        expiry_str, signature = ticket.split(':')
+        expiry = int(expiry_str)
+    except ValueError:
+        return False
+    now = time.time()
+    if not now <= expiry <= now + lifetime:
+        return False
+    return hmac.compare_digest(signature.encode('utf8'), _sign_ticket(server_name, name, credential, expiry).encode('utf8'))
@@ -1,13 +1,17 @@
 import socket
-from threading import Thread, current_thread
-from typing import Callable, Optional, NamedTuple, Collection, Union, TypeVar, Type
+from threading import Thread, current_thread, Lock
+from typing import Callable, Optional, NamedTuple, Collection, Union, TypeVar, Type, List
 
 from chat_bridge_universal.core.config import CBUConfigBase
+from chat_bridge_universal.core.metrics import REGISTRY
 from chat_bridge_universal.core.network import network_utils
-from chat_bridge_universal.core.network.cryptor import AESCryptor
-from chat_bridge_universal.core.network.protocal import AbstractPacket
+from chat_bridge_universal.core.network import codec, cryptor, compressor, streaming
+from chat_bridge_universal.core.network.codec import AbstractCodec, JSON_CODEC
+from chat_bridge_universal.core.network.compressor import Compressor
+from chat_bridge_universal.core.network.cryptor import AbstractCryptor, AESCryptor
+from chat_bridge_universal.core.network.protocal import AbstractPacket, LoginResultPacket
 from chat_bridge_universal.core.state import CBUStateBase
-from chat_bridge_universal.utils.logger import CBULogger
+from chat_bridge_universal.utils.logger import CBULogger, LOG_CATEGORY_CHAT
 
 
 class Address(NamedTuple):
@@ -20,25 +24,42 @@ class Address(NamedTuple):
 
 class CBUBase:
     def __init__(self, config: CBUConfigBase):
-        self.logger = CBULogger(self._get_logger_name())
+        self.logger = self._create_logger()
         self.config = config
         self._state: CBUStateBase
         self.__main_thread: Optional[Thread] = None
         self._sock: socket.socket = socket.socket()
-        self._cryptor = AESCryptor(self.config.aes_key)
+        self._reader: Optional[network_utils.FrameReader] = None
+        self._send_lock = Lock()
+        self._codec: AbstractCodec = JSON_CODEC
+        self._cryptor: AbstractCryptor = AESCryptor(self.config.aes_key)
+        self._compressor: Optional[Compressor] = None
+        self._chunking = False  # whether the peer agreed on chunking
+        self._compression_dictionary: Optional[bytes] = compressor.load_dictionary(self.config.compression_dictionary)
 
     def _get_logger_name(self):
         return self.__class__.__name__
 
+    def _create_logger(self) -> CBULogger:
+        return CBULogger(self._get_logger_name())
+
     def _get_main_loop_thread_name(self):
         return self.__class__.__name__ + 'Thread'
 
+    def apply_log_config(self):
+        """
+        Apply the logging settings of the config to all loggers of the process
+        """
+        type(self.logger).set_async_all(self.config.log_async, self.config.log_queue_size)
+        CBULogger.set_rate_limit(LOG_CATEGORY_CHAT, self.config.chat_log_rate)
+
     def in_state(self, state: Union[CBUStateBase, Collection[CBUStateBase]]):
         return self._state.in_state(state)
 
     def _set_state(self, state: CBUStateBase):
         self.logger.debug('Set state to {}'.format(state))
         self._state = state
+        REGISTRY.counter('cbu_state_changes_total', 'State changes of servers and clients', {'component': self.logger.name, 'state': state.name}).inc()
 
     def assert_state(self, state: Union[CBUStateBase, Collection[CBUStateBase]]):
         if not self.in_state(state):
@@ -53,13 +74,85 @@ class CBUBase:
     def _main_loop(self):
         pass
 
+    def get_codec(self) -> AbstractCodec:
+        return self._codec
+
+    def _set_codec(self, codec: AbstractCodec):
+        self.logger.debug('Using protocol version {}'.format(codec.version))
+        self._codec = codec
+        if self._reader is not None:
+            self._reader.header = codec.header
+
+    def get_cryptor(self) -> AbstractCryptor:
+        return self._cryptor
+
+    def get_compressor(self) -> Optional[Compressor]:
+        return self._compressor
+
+    def get_chunk_size(self) -> int:
+        """
+        The size of the chunks large packets are sent in, 0 if they are sent in a single frame
+        """
+        return self.config.chunk_size if self._chunking and self._codec.version >= codec.PROTOCOL_VERSION_BINARY else 0
+
+    def _get_supported_compressions(self) -> List[str]:
+        if not self.config.compression:
+            return []
+        return compressor.get_supported_compressions(self._compression_dictionary)
+
+    def _create_compressor(self, name: str) -> Optional[Compressor]:
+        return compressor.create_compressor(
+            name, self._compression_dictionary, threshold=self.config.compression_threshold,
+            level=self.config.compression_level, max_size=self.config.max_frame_size
+        )
+
+    def _reset_session(self):
+        """
+        Go back to what peers speak before login: protocol v1 with aes_cbc and no compression
+        """
+        self._set_codec(JSON_CODEC)
+        self._cryptor = AESCryptor(self.config.aes_key)
+        self._compressor = None
+        self._chunking = False
+
+    def _apply_login_result(self, result: LoginResultPacket):
+        """
+        Switch to the protocol version and the cipher agreed during login
+        """
+        self._set_codec(codec.get_codec(result.protocol_version))
+        self._cryptor = cryptor.create_cryptor(result.cipher, self.config.aes_key)
+        self._compressor = self._create_compressor(result.compression)
+        self._chunking = result.chunking
+        self.logger.debug('Using cipher {}, compression {}'.format(self._cryptor.name, result.compression or 'none'))
+
     def send_packet(self, packet: AbstractPacket):
-        network_utils.send_packet(self._sock, self._cryptor, packet)
+        # the chunks of a large packet are sent one by one, so other threads can send their frames in between
+        for frame in streaming.encode_frames(self._cryptor, packet, self._codec, self._compressor, self.get_chunk_size()):
+            self.send_data(frame)
+
+    def send_data(self, data: bytes):
+        """
+        Send bytes that have already been framed by network_utils.encode_packet
+        """
+        with self._send_lock:
+            self._sock.sendall(data)
+        self._on_frame_sent(len(data))
+
+    def _on_frame_sent(self, size: int):
+        pass
+
+    def _on_frame_received(self, size: int):
+        pass
 
     T = TypeVar('T', bound=AbstractPacket)
 
+    def _create_reader(self, sock: socket.socket) -> network_utils.FrameReader:
+        return network_utils.FrameReader(sock, max_frame_size=self.config.max_frame_size)
+
     def receive_packet(self, packet_type: Type[T]) -> T:
-        return network_utils.receive_packet(self._sock, self._cryptor, packet_type)
+        frame = self._reader.read_frame()
+        self._on_frame_received(self._codec.header.size + len(frame))
+        return network_utils.decode_packet(self._cryptor, frame, packet_type, self._codec, self._compressor)
 
     def start(self):
         def func():
@@ -1,13 +1,23 @@
+import collections
+import random
 import socket
+import time
 from enum import auto, unique
-from typing import cast
+from threading import Event, Lock
+from typing import cast, Optional, List, Type, Deque, Tuple, Set
 
 from chat_bridge_universal.core.basic import CBUBase, Address
 from chat_bridge_universal.core.config import CBUConfigBase, ClientMeta
+from chat_bridge_universal.core.metrics import REGISTRY, ConnectionMetrics, or_nan
 from chat_bridge_universal.core.network import network_utils
+from chat_bridge_universal.core.network.batcher import Batcher
+from chat_bridge_universal.core.network.codec import PROTOCOL_VERSION_BINARY
+from chat_bridge_universal.core.network.heartbeat import Heartbeat, HeartbeatTimeout, create_heartbeat
+from chat_bridge_universal.core.network.streaming import StreamAssembler
 from chat_bridge_universal.core.network.protocal import LoginPacket, LoginResultPacket, ChatPacket, ChatPayload, \
-    AbstractPayload
+    AbstractPayload, AbstractPacket, BatchPacket, PingPacket, PongPacket, ChannelPacket, TicketPacket
 from chat_bridge_universal.core.state import CBUStateBase
+from chat_bridge_universal.utils.logger import Lazy
 
 
 class CBUClientConfig(CBUConfigBase):
@@ -15,6 +25,20 @@ class CBUClientConfig(CBUConfigBase):
     password: str = 'MyClientPassword'
     server_hostname: str = '127.0.0.1'
     server_port: int = 30001
+    # chats sent within batch_window seconds are sent together in a single frame, up to batch_max_size chats
+    # 0 window sends every chat immediately
+    batch_window: float = 0.0
+    batch_max_size: int = 64
+    # reconnect with exponential backoff and jitter when the connection is lost
+    reconnect: bool = True
+    reconnect_min_delay: float = 1.0
+    reconnect_max_delay: float = 60.0
+    # chats sent while offline are kept and sent after logging in again, if they are not older than outbox_max_age seconds
+    # 0 size disables the outbox
+    outbox_size: int = 256
+    outbox_max_age: float = 120.0
+    channels: List[str] = []  # channels to join at login
+    catch_up: bool = True  # get the chats missed while reconnecting from the history of the server
 
     @property
     def client_meta(self) -> ClientMeta:
@@ -35,11 +59,52 @@ class CBUClientState(CBUStateBase):
     STOPPING = auto()
 
 
+class LoginRejected(Exception):
+    pass
+
+
+def get_reconnect_delay(attempt: int, min_delay: float, max_delay: float) -> float:
+    """
+    Exponential backoff with jitter, so clients dropped together by a server restart don't come back all at once
+    """
+    delay = min(max_delay, min_delay * (2 ** min(attempt, 32)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
 class CBUClient(CBUBase):
     def __init__(self, config: CBUClientConfig):
         super().__init__(config)
         self.config = cast(CBUClientConfig, self.config)
         self._state = CBUClientState.STOPPED
+        self.__batcher: Optional[Batcher[ChatPacket]] = None
+        self.__heartbeat: Optional[Heartbeat] = None
+        self.__stop_event = Event()
+        self.__outbox: Deque[Tuple[float, ChatPacket]] = collections.deque()
+        self.__outbox_lock = Lock()
+        self.outbox_dropped = 0
+        self.__channels: Set[str] = set(self.config.channels)
+        self.__last_sequence = 0
+        self.__ticket = ''  # presented in the next login to skip the password check
+        self.__ticket_renew_time: Optional[float] = None
+        self.metrics = ConnectionMetrics(self._get_metrics_role(), self.config.name)
+        self._assembler = StreamAssembler(self.config.max_stream_size, self.config.max_stream_memory, self.logger, self.metrics.labels)
+        self.reconnects = REGISTRY.counter('cbu_reconnects_total', 'Reconnect attempts of clients', self.metrics.labels)
+        REGISTRY.gauge('cbu_online', 'Whether the connection is online', self.metrics.labels, lambda: int(self.is_online()))
+        REGISTRY.gauge('cbu_rtt_seconds', 'Latest round trip time measured by heartbeats', self.metrics.labels, lambda: or_nan(self.get_rtt()))
+        self._register_metrics()
+
+    def _get_metrics_role(self) -> str:
+        return 'client'
+
+    def _register_metrics(self):
+        REGISTRY.gauge('cbu_outbox_size', 'Chats waiting in the offline outbox', self.metrics.labels, self.get_outbox_size)
+        REGISTRY.gauge('cbu_outbox_dropped', 'Chats dropped from the offline outbox', self.metrics.labels, lambda: self.outbox_dropped)
+
+    def _on_frame_sent(self, size: int):
+        self.metrics.on_sent(size)
+
+    def _on_frame_received(self, size: int):
+        self.metrics.on_received(size)
 
     def _get_logger_name(self):
         return 'Client'
@@ -48,31 +113,62 @@ class CBUClient(CBUBase):
         return 'ClientThread'
 
     def _main_loop(self):
+        attempt = 0
         try:
-            self._connect_and_login()
-            self._set_state(CBUClientState.ONLINE)
-        except Exception as e:
-            self.logger.error('Failed to connect {}: {}'.format(self.config.server_address, e))
-        else:
-            while self.is_online():
+            while not self.__stop_event.is_set():
                 try:
-                    self._tick_connection()
-                except (ConnectionResetError, network_utils.EmptyContent) as e:
-                    self.logger.warning('Connection closed: {}'.format(e))
-                    break
-                except socket.error:
-                    self.logger.exception('Failed to receive data, stopping client now')
+                    self._connect_and_login()
+                except LoginRejected as e:
+                    self.logger.error('Failed to login to the server: {}'.format(e))
                     break
                 except Exception as e:
-                    self.logger.exception('Error ticking client connection: {}'.format(e))
+                    self.logger.error('Failed to connect {}: {}'.format(self.config.server_address, e))
+                else:
+                    attempt = 0
+                    self.__go_online()
+                    self.__receive_loop()
+                if self.__stop_event.is_set() or not self._should_reconnect():
+                    break
+                with self.__outbox_lock:  # chats sent from now on wait in the outbox till the next login
+                    self._set_state(CBUClientState.STARTING)
+                delay = get_reconnect_delay(attempt, self.config.reconnect_min_delay, self.config.reconnect_max_delay)
+                attempt += 1
+                self.reconnects.inc()
+                self.logger.info('Reconnecting in {:.1f}s'.format(delay))
+                if self.__stop_event.wait(delay):
                     break
         finally:
             self._stop()
         self.logger.info('bye')
 
+    def __receive_loop(self):
+        while self.is_online():
+            try:
+                self._tick_connection()
+            except (ConnectionResetError, network_utils.EmptyContent, network_utils.FrameTooLarge, HeartbeatTimeout) as e:
+                self.logger.warning('Connection closed: {}'.format(e))
+                break
+            except socket.error:
+                if self.__stop_event.is_set():
+                    break
+                self.logger.exception('Failed to receive data')
+                break
+            except Exception as e:
+                self.logger.exception('Error ticking client connection: {}'.format(e))
+                break
+
+    def _should_reconnect(self) -> bool:
+        return self.config.reconnect
+
     def start(self):
         self.logger.debug('Starting client')
+        self.__stop_event.clear()
         self._set_state(CBUClientState.STARTING)
+        if self.config.batch_window > 0:
+            self.__batcher = Batcher(
+                self.__send_batch, window=self.config.batch_window, max_size=self.config.batch_max_size,
+                logger=self.logger, thread_name=self._get_main_loop_thread_name() + '.Batcher'
+            )
         super().start()
 
     def _is_stopped(self) -> bool:
@@ -89,33 +185,128 @@ class CBUClient(CBUBase):
         self._set_state(CBUClientState.CONNECTING)
         assert self.config.server_address is not None
         self.logger.info('Connecting to {}'.format(self.config.server_address))
+        self._sock.close()
+        self._sock = socket.socket()
         self._sock.connect(address)
+        self._reader = self._create_reader(self._sock)
+        self._reset_session()
         self._set_state(CBUClientState.CONNECTED)
 
     def _connect_and_login(self):
         self._connect(self.config.server_address)
         self.assert_state(CBUClientState.CONNECTED)
-        self.send_packet(LoginPacket(name=self.config.name, password=self.config.password))
+        self.send_packet(LoginPacket(
+            name=self.config.name, password=self.config.password,
+            protocol_version=self.config.protocol_version, ciphers=self.config.ciphers,
+            compressions=self._get_supported_compressions(), channels=sorted(self.__channels),
+            last_sequence=self.__last_sequence if self.config.catch_up else 0, ticket=self.__ticket, chunking=True
+        ))
         result = self.receive_packet(LoginResultPacket)
         if result.success:
             self.logger.info('Logged in to the server')
+            self._apply_login_result(result)
+            self.__set_ticket(result.ticket, result.ticket_lifetime)
         else:
-            self.logger.error('Failed to login to the server: {}'.format(result.message))
-            self._stop()
+            self.__set_ticket('', 0)
+            raise LoginRejected(result.message)
+
+    def _apply_login_result(self, result: LoginResultPacket):
+        super()._apply_login_result(result)
+        self._assembler.reset()
+
+    def __set_ticket(self, ticket: str, lifetime: float):
+        self.__ticket = ticket
+        # renewed halfway through its lifetime, so it's still valid for a while when the connection drops
+        # the renewal needs typed frames, on v1 connections the ticket lasts till it expires
+        if ticket != '' and lifetime > 0 and self._codec.version >= PROTOCOL_VERSION_BINARY:
+            self.__ticket_renew_time = time.monotonic() + lifetime / 2
+        else:
+            self.__ticket_renew_time = None
+
+    def __go_online(self):
+        # pings are v1 incompatible, since v1 frames carry no packet type
+        self.__heartbeat = None
+        if self._codec.version >= PROTOCOL_VERSION_BINARY:
+            self.__heartbeat = create_heartbeat(self.config.heartbeat_interval, self.config.heartbeat_max_missed)
+            if self.__heartbeat is not None:
+                self._sock.settimeout(self.__heartbeat.poll_interval)
+        with self.__outbox_lock:
+            self._set_state(CBUClientState.ONLINE)
+            now = time.monotonic()
+            packets = [packet for timestamp, packet in self.__outbox if now - timestamp <= self.config.outbox_max_age]
+            expired = len(self.__outbox) - len(packets)
+            self.__outbox.clear()
+            if expired > 0:
+                self.outbox_dropped += expired
+                self.logger.warning('Dropped {} expired chats in the outbox'.format(expired))
+            if len(packets) > 0:
+                self.logger.info('Sending {} chats in the outbox'.format(len(packets)))
+            for i, packet in enumerate(packets):
+                if not self.__send_online(packet):
+                    self.__outbox.extend((now, p) for p in packets[i:])
+                    break
+
+    def _get_incoming_packet_type(self) -> Type[AbstractPacket]:
+        # v1 frames carry no packet type, so only chat packets can be sent after login
+        return AbstractPacket if self._codec.version >= PROTOCOL_VERSION_BINARY else ChatPacket
 
     def _tick_connection(self):
         try:
-            packet = self.receive_packet(ChatPacket)
+            packet_type = self._get_incoming_packet_type()
+            packet = self.receive_packet(packet_type)
         except socket.timeout:
             pass
         else:
-            self.logger.debug('Received chat packet : {}'.format(packet.serialize()))
-            try:
-                self._on_packet(packet)
-            except Exception as e:
-                self.logger.exception('Fail to process packet {}: {}'.format(packet, e))
+            self.logger.debug(Lazy(lambda: 'Received {} : {}'.format(type(packet).__name__, packet.serialize())))
+            if self.__heartbeat is not None:
+                self.__heartbeat.on_received()
+            packet = self._assembler.assemble(packet, self._codec, packet_type)
+            if packet is None:
+                pass
+            elif isinstance(packet, PingPacket):
+                self.send_packet(PongPacket(timestamp=packet.timestamp))
+            elif isinstance(packet, PongPacket):
+                if self.__heartbeat is not None:
+                    self.__heartbeat.on_pong(packet)
+            else:
+                try:
+                    self._on_packet(packet)
+                except Exception as e:
+                    self.logger.exception('Fail to process packet {}: {}'.format(packet, e))
+        if self.__heartbeat is not None:
+            self.__heartbeat.check_dead()
+            ping = self.__heartbeat.poll_ping()
+            if ping is not None:
+                self.send_packet(ping)
+        if self.__ticket_renew_time is not None and time.monotonic() >= self.__ticket_renew_time:
+            self.__ticket_renew_time = None
+            self.send_packet(TicketPacket())
+
+    def get_rtt(self) -> Optional[float]:
+        """
+        The latest round trip time in seconds measured by heartbeats, None if unknown
+        """
+        heartbeat = self.__heartbeat
+        return heartbeat.rtt if heartbeat is not None else None
+
+    def _on_packet(self, packet: AbstractPacket):
+        if isinstance(packet, BatchPacket):
+            for chat_packet in packet.packets:
+                self.__last_sequence = max(self.__last_sequence, chat_packet.sequence)
+                self._on_chat_packet(chat_packet)
+        elif isinstance(packet, ChatPacket):
+            self.__last_sequence = max(self.__last_sequence, packet.sequence)
+            self._on_chat_packet(packet)
+        elif isinstance(packet, TicketPacket):
+            self.__set_ticket(packet.ticket, packet.lifetime)
+
+    def get_last_sequence(self) -> int:
+        """
+        Sequence of the latest chat received, given by the server
+        """
+        return self.__last_sequence
 
-    def _on_packet(self, packet: ChatPacket):
+    def _on_chat_packet(self, packet: ChatPacket):
         self.on_chat(packet.sender, packet.payload)
 
     def on_chat(self, sender: str, payload: ChatPayload):
@@ -125,14 +316,125 @@ class CBUClient(CBUBase):
         self.send_to_all(ChatPayload(author=author, message=message))
 
     def send_to_all(self, payload: AbstractPayload):
-        self.send_packet(ChatPacket(
+        self._send_chat_packet(ChatPacket(
             sender=self.config.name,
             receivers=[],
             broadcast=True,
-            payload=payload.serialize()
+            payload=payload
+        ))
+
+    def get_channels(self) -> List[str]:
+        return sorted(self.__channels)
+
+    def join_channel(self, channel: str):
+        """
+        Receive chats sent to the channel. With protocol v1 it takes effect since the next login
+        """
+        self.__update_channel(channel, True)
+
+    def leave_channel(self, channel: str):
+        self.__update_channel(channel, False)
+
+    def __update_channel(self, channel: str, join: bool):
+        if join:
+            self.__channels.add(channel)
+        else:
+            self.__channels.discard(channel)
+        if self.is_online() and self._codec.version >= PROTOCOL_VERSION_BINARY:
+            try:
+                self.send_packet(ChannelPacket(join=[channel]) if join else ChannelPacket(leave=[channel]))
+            except socket.error as e:
+                self.logger.warning('Failed to send channel update: {}'.format(e))
+
+    def send_to_channel(self, channel: str, payload: AbstractPayload):
+        self._send_chat_packet(ChatPacket(
+            sender=self.config.name,
+            receivers=[],
+            broadcast=False,
+            payload=payload,
+            channel=channel
         ))
 
+    def send_to(self, receivers: List[str], payload: AbstractPayload):
+        self._send_chat_packet(ChatPacket(
+            sender=self.config.name,
+            receivers=receivers,
+            broadcast=False,
+            payload=payload
+        ))
+
+    def _send_chat_packet(self, packet: ChatPacket):
+        with self.__outbox_lock:
+            if not self.is_online():
+                self.__put_outbox(packet)
+                return
+        if not self.__send_online(packet):
+            with self.__outbox_lock:
+                self.__put_outbox(packet)
+
+    def __send_online(self, packet: ChatPacket) -> bool:
+        """
+        :return: False if the packet cannot be sent due to a network error
+        """
+        batcher = self.__batcher
+        try:
+            # the batcher is closed while stopping, where the packet is sent on its own
+            if batcher is None or self._codec.version < PROTOCOL_VERSION_BINARY or not batcher.add(packet):
+                self.send_packet(packet)
+        except socket.error as e:
+            self.logger.warning('Failed to send chat packet: {}'.format(e))
+            return False
+        return True
+
+    def __put_outbox(self, packet: ChatPacket):
+        if self.config.outbox_size <= 0 or not self.is_running():
+            self.outbox_dropped += 1
+            return
+        if len(self.__outbox) >= self.config.outbox_size:
+            self.__outbox.popleft()
+            self.outbox_dropped += 1
+        self.__outbox.append((time.monotonic(), packet))
+
+    def get_outbox_size(self) -> int:
+        return len(self.__outbox)
+
+    def __send_batch(self, packets: List[ChatPacket]):
+        # the state leaves online with the outbox lock held, so a batch is never written
+        # to a connection which is still logging in, but waits in the outbox for __go_online
+        with self.__outbox_lock:
+            if not self.is_online():
+                for packet in packets:
+                    self.__put_outbox(packet)
+                return
+            try:
+                if len(packets) == 1:
+                    self.send_packet(packets[0])
+                elif self._codec.version >= PROTOCOL_VERSION_BINARY:
+                    self.send_packet(BatchPacket(packets=packets))
+                else:  # reconnected with a server speaking v1
+                    for packet in packets:
+                        self.send_packet(packet)
+            except socket.error as e:
+                self.logger.warning('Failed to send {} batched chat packets: {}'.format(len(packets), e))
+                for packet in packets:
+                    self.__put_outbox(packet)
+
+    def stop(self):
+        self.__stop_event.set()
+        self.__close_batcher()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)  # wake up the blocking receive
+        except socket.error:
+            pass
+        super().stop()
+
+    def __close_batcher(self):
+        batcher, self.__batcher = self.__batcher, None
+        if batcher is not None:
+            batcher.close()
+
     def _stop(self):
+        self.__close_batcher()
         super()._stop()
         self._set_state(CBUClientState.STOPPED)
 
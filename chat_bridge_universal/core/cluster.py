@@ -0,0 +1,310 @@
+"""
+Multi-process server: several worker processes serving the same port, each running its own CBUServer
+
+The kernel spreads incoming connections over the workers with SO_REUSEPORT. Chats routed by a worker are
+published to the relay in the supervisor process, which passes them on to the other workers so they reach
+the clients there too. Workers also announce the clients going online and offline to the relay,
+so a client is online on a single worker at once like it is with a single server
+
+History is not supported: chats sent to some clients only are relayed to the workers of those clients only,
+and every worker numbers its chats on its own, so a client reconnecting to another worker would catch up
+with gaps or duplicates. The workers always run without it, whatever the config says
+"""
+import multiprocessing
+import socket
+import struct
+import time
+from multiprocessing.connection import Connection, wait
+from threading import Lock, current_thread
+from typing import cast, Dict, List, Optional
+
+from chat_bridge_universal.core.basic import CBUBase
+from chat_bridge_universal.core.config import load_config
+from chat_bridge_universal.core.network.codec import BINARY_CODEC
+from chat_bridge_universal.core.network.protocal import ChatPacket, BatchPacket
+from chat_bridge_universal.core.server import CBUServer, CBUServerConfig, CBUServerState
+
+# relay messages, the first byte is the message type
+_MESSAGE_CHAT = 1  # header, receiver names joined by \n (empty for all workers), and a binary BatchPacket
+_MESSAGE_ONLINE = 2  # client name
+_MESSAGE_OFFLINE = 3  # client name
+_MESSAGE_KICK = 4  # client name, which is online on another worker already
+_MESSAGE_COMMAND = 5  # console command
+_CHAT_HEADER = struct.Struct('!BI')  # message type, length of the receiver names
+
+WORKER_STOP_TIMEOUT = 10
+
+
+def is_supported() -> bool:
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+def _encode_name_message(message_type: int, name: str) -> bytes:
+    return bytes((message_type,)) + name.encode('utf8')
+
+
+def _encode_chat_message(packets: List[ChatPacket]) -> Optional[bytes]:
+    """
+    :return: the message, or None if none of the packets has any recipient
+    """
+    receivers: Dict[str, None] = {}
+    for packet in packets:
+        if packet.broadcast or packet.channel != '':
+            receivers = {}
+            break
+        receivers.update(dict.fromkeys(packet.receivers))
+    else:
+        if len(receivers) == 0:
+            return None
+    names = '\n'.join(receivers).encode('utf8')
+    return _CHAT_HEADER.pack(_MESSAGE_CHAT, len(names)) + names + BINARY_CODEC.encode(BatchPacket(packets=packets))
+
+
+class RelayClient:
+    """
+    The worker side of the relay
+    """
+    def __init__(self, server: CBUServer, connection: Connection, index: int):
+        self.index = index
+        self.__server = server
+        self.__connection = connection
+        self.__send_lock = Lock()
+
+    def __send(self, data: bytes):
+        try:
+            with self.__send_lock:
+                self.__connection.send_bytes(data)
+        except (OSError, EOFError) as e:
+            self.__server.logger.error('Failed to send to the relay: {}'.format(e))
+
+    def publish(self, packets: List[ChatPacket]):
+        data = _encode_chat_message(packets)
+        if data is not None:
+            self.__send(data)
+
+    def announce(self, name: str, online: bool):
+        self.__send(_encode_name_message(_MESSAGE_ONLINE if online else _MESSAGE_OFFLINE, name))
+
+    def serve(self):
+        """
+        Handle the messages from the relay until the supervisor asks to stop or goes away, or the server stops
+        """
+        while True:
+            try:
+                if not self.__connection.poll(1):
+                    if self.__server.in_state(CBUServerState.STOPPED):
+                        return
+                    continue
+                data = self.__connection.recv_bytes()
+            except (OSError, EOFError):
+                self.__server.logger.warning('Relay closed')
+                return
+            message_type = data[0]
+            if message_type == _MESSAGE_CHAT:
+                _, length = _CHAT_HEADER.unpack_from(data)
+                batch = BINARY_CODEC.decode(data[_CHAT_HEADER.size + length:], BatchPacket)
+                self.__server._run_in_loop(self.__server.process_relayed, batch.packets)
+            elif message_type == _MESSAGE_KICK:
+                self.__server._run_in_loop(self.__kick, data[1:].decode('utf8'))
+            elif message_type == _MESSAGE_COMMAND:
+                command = data[1:].decode('utf8')
+                if command == 'stop':
+                    return
+                elif command == 'status':
+                    self.__server.logger.info('Worker #{}'.format(self.index))
+                    self.__server._run_in_loop(self.__server.show_status)
+                elif command == 'stats':
+                    self.__server._run_in_loop(self.__server.show_stats)
+
+    def __kick(self, name: str):
+        connection = self.__server._connections.get(name)
+        if connection is not None:
+            self.__server.logger.warning('Client {} is online on another worker, disconnecting'.format(name))
+            connection.close()
+
+
+def run_worker(config_path: str, engine: str, index: int, connection: Connection, log_level: Optional[int]):
+    """
+    Entry of a worker process
+    """
+    current_thread().name = 'Worker#{}'.format(index)
+    if engine == 'asyncio':
+        from chat_bridge_universal.core.aio_server import CBUAsyncServer
+        server = CBUAsyncServer(config_path, history=False)
+    else:
+        server = CBUServer(config_path, history=False)
+    if server.config.metrics_port > 0:
+        server.config.metrics_port += index
+    if log_level is not None:
+        for logger in [server.logger] + [conn.logger for conn in server._connections.values()]:
+            logger.setLevel(log_level)
+    server._reuse_port = True
+    relay = RelayClient(server, connection, index)
+    server.set_relay(relay)
+    CBUBase.start(server)  # without the console loop
+    try:
+        relay.serve()
+    except KeyboardInterrupt:  # the supervisor handles it
+        pass
+    finally:
+        if not server.in_state(CBUServerState.STOPPED):
+            server.stop()
+        connection.close()
+
+
+class _Worker:
+    def __init__(self, index: int, process: multiprocessing.Process, connection: Connection):
+        self.index = index
+        self.process = process
+        self.connection = connection
+
+
+class CBUServerCluster(CBUBase):
+    """
+    Supervisor of the worker processes, relaying the messages between them
+    """
+    def __init__(self, config_path: str, engine: str = 'thread', workers: Optional[int] = None, log_level: Optional[int] = None):
+        super().__init__(load_config(config_path, CBUServerConfig))
+        self.config: CBUServerConfig = cast(CBUServerConfig, self.config)
+        self._state = CBUServerState.STOPPED
+        self.apply_log_config()
+        self.__config_path = config_path
+        self.__engine = engine
+        self.__worker_count = workers if workers is not None else self.config.workers
+        self.__log_level = log_level
+        self.__workers: Dict[Connection, _Worker] = {}
+        self.__owners: Dict[str, _Worker] = {}  # client name -> the worker it's online on
+        self.__send_lock = Lock()  # console commands are sent from the console thread
+        self.__should_loop_console = True
+
+    def _get_logger_name(self):
+        return 'Cluster'
+
+    def _get_main_loop_thread_name(self):
+        return 'RelayThread'
+
+    def is_running(self):
+        return self.in_state(CBUServerState.RUNNING)
+
+    def get_worker_count(self) -> int:
+        return len(self.__workers)
+
+    def _main_loop(self):
+        self.assert_state(CBUServerState.STOPPED)
+        self._set_state(CBUServerState.STARTING)
+        if not is_supported():
+            self.logger.error('SO_REUSEPORT is not supported on this platform, use a single worker instead')
+            self._stop()
+            return
+        if len(self.config.peers) > 0 or any(client.peer for client in self.config.clients):
+            self.logger.error('Federation is not supported with several workers, use a single worker instead')
+            self._stop()
+            return
+        if self.config.history_size > 0 or self.config.history_log_dir != '':
+            self.logger.warning('History is not supported with several workers, clients won\'t catch up after reconnecting')
+        context = multiprocessing.get_context('spawn')  # workers should not inherit the threads of this process
+        for index in range(self.__worker_count):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(
+                target=run_worker, name='CBUWorker#{}'.format(index), daemon=True,
+                args=(self.__config_path, self.__engine, index, child_connection, self.__log_level)
+            )
+            process.start()
+            child_connection.close()  # so the parent gets an EOF when the worker exits
+            self.__workers[parent_connection] = _Worker(index, process, parent_connection)
+        self.logger.info('Started {} {} workers @ {}'.format(self.__worker_count, self.__engine, self.config.address))
+        self._set_state(CBUServerState.RUNNING)
+        try:
+            while self.is_running() and len(self.__workers) > 0:
+                for connection in wait(list(self.__workers.keys()), timeout=1):
+                    worker = self.__workers[connection]
+                    try:
+                        data = connection.recv_bytes()
+                    except (OSError, EOFError):
+                        self.__on_worker_exit(worker)
+                    else:
+                        self.__on_message(worker, data)
+            if len(self.__workers) == 0:
+                self.logger.error('All workers exited')
+        except Exception as e:
+            self.logger.exception('Error relaying: {}'.format(e))
+        finally:
+            self.__stop_workers()
+            self._stop()
+        self.logger.info('bye')
+
+    def __on_message(self, worker: _Worker, data: bytes):
+        message_type = data[0]
+        if message_type == _MESSAGE_CHAT:
+            _, length = _CHAT_HEADER.unpack_from(data)
+            if length == 0:
+                targets = [target for target in self.__workers.values() if target is not worker]
+            else:
+                names = data[_CHAT_HEADER.size:_CHAT_HEADER.size + length].decode('utf8').split('\n')
+                targets = list({id(target): target for target in map(self.__owners.get, names) if target is not None and target is not worker}.values())
+            for target in targets:
+                self.__send(target, data)
+        elif message_type == _MESSAGE_ONLINE:
+            name = data[1:].decode('utf8')
+            owner = self.__owners.get(name)
+            if owner is None:
+                self.__owners[name] = worker
+            elif owner is not worker:
+                self.__send(worker, _encode_name_message(_MESSAGE_KICK, name))
+        elif message_type == _MESSAGE_OFFLINE:
+            name = data[1:].decode('utf8')
+            if self.__owners.get(name) is worker:
+                del self.__owners[name]
+
+    def __send(self, worker: _Worker, data: bytes):
+        try:
+            with self.__send_lock:
+                worker.connection.send_bytes(data)
+        except (OSError, EOFError) as e:
+            self.logger.warning('Failed to relay to worker #{}: {}'.format(worker.index, e))
+
+    def __on_worker_exit(self, worker: _Worker):
+        if self.is_running():
+            self.logger.error('Worker #{} exited'.format(worker.index))
+        self.__workers.pop(worker.connection, None)
+        worker.connection.close()
+        for name in [name for name, owner in self.__owners.items() if owner is worker]:
+            del self.__owners[name]
+
+    def __broadcast_command(self, command: str):
+        for worker in list(self.__workers.values()):
+            self.__send(worker, _encode_name_message(_MESSAGE_COMMAND, command))
+
+    def __stop_workers(self):
+        self.__broadcast_command('stop')
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for worker in list(self.__workers.values()):
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                self.logger.warning('Worker #{} did not stop in time, terminating'.format(worker.index))
+                worker.process.terminate()
+                worker.process.join()
+            worker.connection.close()
+        self.__workers.clear()
+        self.__owners.clear()
+
+    def _stop(self):
+        if self.in_state(CBUServerState.RUNNING):
+            self._set_state(CBUServerState.STOPPING)  # the relay loop stops the workers and exits
+            return
+        super()._stop()
+        self._set_state(CBUServerState.STOPPED)
+        self.__should_loop_console = False
+
+    def start(self):
+        super().start()
+        self.console_loop()
+
+    def console_loop(self):
+        while self.__should_loop_console:
+            input_ = input()
+            if input_ == 'stop':
+                self.stop()
+            elif input_ in ('status', 'stats'):
+                self.logger.info('Online clients: {}, workers: {}'.format(len(self.__owners), len(self.__workers)))
+                self.__broadcast_command(input_)
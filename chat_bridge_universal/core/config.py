@@ -1,33 +1,71 @@
 import json
 import os
-from typing import TypeVar, Type
+from typing import TypeVar, Type, List
 
-from mcdreforged.utils.serializer import Serializable
+from chat_bridge_universal.utils.serializer import Serializable
+
+from chat_bridge_universal.core.network.codec import LATEST_PROTOCOL_VERSION
+from chat_bridge_universal.core.network.cryptor import DEFAULT_CIPHERS
+from chat_bridge_universal.core.network.network_utils import DEFAULT_MAX_FRAME_SIZE
 
 
 class CBUConfigBase(Serializable):
     aes_key: str = 'ThisIsSecret'
+    max_frame_size: int = DEFAULT_MAX_FRAME_SIZE  # frames announcing a larger length drop the connection
+    protocol_version: int = LATEST_PROTOCOL_VERSION  # the highest protocol version to use, 1 for json only
+    ciphers: List[str] = DEFAULT_CIPHERS  # ciphers allowed after login in preference order, aes_cbc is the fallback
+    compression: bool = True  # compress large frames if the peer agrees
+    compression_threshold: int = 256  # frames with a smaller plaintext are sent uncompressed
+    compression_level: int = 6
+    compression_dictionary: str = ''  # path of a shared zlib dictionary file, used only if the peer has the same one
+    heartbeat_interval: float = 10  # seconds between pings on protocol v2 connections, 0 to disable
+    heartbeat_max_missed: int = 3  # drop the connection after this many intervals without receiving anything
+    log_async: bool = False  # write logs to the console in a background thread instead of the network threads
+    log_queue_size: int = 10000  # logs waiting for the background thread, new ones are dropped when it's full
+    chat_log_rate: float = 0  # max logs of chat messages per second, 0 for no limit
+    # packets encoded larger than chunk_size are sent in chunks of that size on protocol v2, so other frames are sent
+    # between them and the peer buffers them in bounded pieces. 0 to send every packet in a single frame
+    chunk_size: int = 64 * 1024
+    max_stream_size: int = 16 * 1024 * 1024  # the largest packet taken in chunks
+    max_stream_memory: int = 32 * 1024 * 1024  # chunks of unfinished packets buffered for a connection
 
 
 class ClientMeta(Serializable):
     name: str
-    password: str
+    password: str  # plain text, or a hash made by the hash-password command so the config doesn't reveal it
+    channels: List[str] = []  # channels the client is always in, besides the ones it joins by itself
+    peer: bool = False  # another server of the federation, logging in with its server name
+    chat_rate: float = 0  # chats per second the client can send on average, 0 for no limit
+    chat_burst: int = 20  # chats the client can send at once
+
+
+class PeerMeta(Serializable):
+    """
+    A server of the federation to link to, this server logs in to it as a client with its own server name
+    """
+    name: str  # the server name of the peer
+    hostname: str
+    port: int
+    password: str  # of this server, in the clients of the peer
 
 
 T = TypeVar('T', bound=CBUConfigBase)
 
 
 def load_config(config_path: str, config_class: Type[T]) -> T:
-    config = config_class.get_default()
+    """
+    Load the config file, or generate one with the default values if it's missing
+    An existing file is never written, the fields missing in it simply take their default values
+    """
     if not os.path.isfile(config_path):
-        print('Configure file not found!'.format(config_path))
-        with open(config_path, 'w', encoding='utf8') as file:
-            json.dump(config.serialize(), file, ensure_ascii=False, indent=4)
-        print('Default example configure generated'.format(config_path))
-        return load_config(config_path, config_class)
-    else:
-        with open(config_path, encoding='utf8') as file:
-            config.update_from(json.load(file))
-        with open(config_path, 'w', encoding='utf8') as file:
+        print('Configure file not found!')
+        config = config_class.get_default()
+        # replaced at once, so processes loading the same file, e.g. server workers, never see it half written
+        temp_path = '{}.{}.tmp'.format(config_path, os.getpid())
+        with open(temp_path, 'w', encoding='utf8') as file:
             json.dump(config.serialize(), file, ensure_ascii=False, indent=4)
+        os.replace(temp_path, config_path)
+        print('Default example configure generated')
         return config
+    with open(config_path, encoding='utf8') as file:
+        return config_class.deserialize(json.load(file))
@@ -0,0 +1,70 @@
+"""
+Server federation: servers linked to each other share their chats, so every server serves its own clients nearby
+
+A server logs in to each of its peers as a client named after the server, and the peer lists it in its clients
+with peer enabled. Chats are forwarded over the links in both directions. Every chat remembers the servers
+it has passed and the id it got at the first one, so it's never sent back to a server it has been at,
+and a server takes it only once even if the links form a loop
+"""
+import collections
+from threading import Lock
+from typing import TYPE_CHECKING, Tuple
+
+from chat_bridge_universal.core.client import CBUClient, CBUClientConfig
+from chat_bridge_universal.core.config import CBUConfigBase, PeerMeta
+from chat_bridge_universal.core.network.protocal import ChatPacket
+
+if TYPE_CHECKING:
+    from chat_bridge_universal.core.server import CBUServer
+
+SEEN_CACHE_SIZE = 16384
+
+
+class SeenCache:
+    """
+    Ids of the chats taken recently, the oldest ones are forgotten first
+    """
+    def __init__(self, size: int = SEEN_CACHE_SIZE):
+        self.size = size
+        self.__seen = collections.OrderedDict()
+        self.__lock = Lock()
+
+    def add(self, key: Tuple[str, int]) -> bool:
+        """
+        :return: False if the key has been added already
+        """
+        with self.__lock:
+            if key in self.__seen:
+                return False
+            self.__seen[key] = None
+            if len(self.__seen) > self.size:
+                self.__seen.popitem(last=False)
+            return True
+
+
+class PeerLink(CBUClient):
+    """
+    The link from a server to one of its peers. Chats from the peer are handed to the server,
+    and chats forwarded to the peer wait in the outbox while the link is reconnecting
+    """
+    def __init__(self, server: 'CBUServer', peer: PeerMeta):
+        self.peer = peer
+        self.__server = server
+        base_config = {key: getattr(server.config, key) for key in CBUConfigBase.__annotations__.keys()}
+        super().__init__(CBUClientConfig(name=server.config.name, password=peer.password,
+                                         server_hostname=peer.hostname, server_port=peer.port, **base_config))
+
+    def _get_logger_name(self):
+        return 'Peer.{}'.format(self.peer.name)
+
+    def _get_main_loop_thread_name(self):
+        return 'PeerThread.' + self.peer.name
+
+    def _get_metrics_role(self) -> str:
+        return 'peer'
+
+    def _on_chat_packet(self, packet: ChatPacket):
+        self.__server._run_in_loop(self.__server.process_federated, packet, self.peer.name)
+
+    def forward(self, packet: ChatPacket):
+        self._send_chat_packet(packet)
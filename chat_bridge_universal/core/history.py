@@ -0,0 +1,199 @@
+"""
+Recent chats routed by the server, so clients reconnecting can catch up with what they missed
+
+Every routed chat gets a sequence number, which is the larger one of the last sequence + 1 and the current time
+in microseconds, so sequences keep growing after restarts even without a log, and stay close to each other
+among the workers of a cluster. Clients send the last sequence they received in their login packet,
+and get the chats after it that were meant for them
+"""
+import collections
+import mmap
+import os
+import struct
+import time
+from typing import Deque, List, Tuple, Optional, Iterator, Callable
+
+from chat_bridge_universal.core.network.codec import BINARY_CODEC
+from chat_bridge_universal.core.network.protocal import ChatPacket
+from chat_bridge_universal.utils.logger import CBULogger
+
+_RECORD_HEADER = struct.Struct('!qI')  # sequence, length of the packet encoded with the binary codec
+_SEGMENT_SUFFIX = '.log'
+
+
+class HistoryLog:
+    """
+    Append-only segment files of routed chats, named after the first sequence in them
+    Segments are read through memory mapping, the oldest ones are deleted when there are too many
+    """
+    def __init__(self, directory: str, segment_size: int, segment_count: int, logger: CBULogger):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_count = max(1, segment_count)
+        self.logger = logger
+        os.makedirs(directory, exist_ok=True)
+        self.__segments: List[Tuple[int, str]] = sorted(
+            (int(file_name[:-len(_SEGMENT_SUFFIX)]), os.path.join(directory, file_name))
+            for file_name in os.listdir(directory)
+            if file_name.endswith(_SEGMENT_SUFFIX) and file_name[:-len(_SEGMENT_SUFFIX)].isdigit()
+        )
+        self.__file = None
+        self.__file_size = 0
+        self.last_sequence = self.__recover()
+
+    def __recover(self) -> int:
+        """
+        :return: the last sequence in the log. A record partly written when the server died is cut off
+        """
+        if len(self.__segments) == 0:
+            return 0
+        path = self.__segments[-1][1]
+        last_sequence, end = 0, 0
+        for sequence, _, _, offset in self.__iterate_records(path):
+            last_sequence, end = sequence, offset
+        if end < os.path.getsize(path):
+            self.logger.warning('Cutting off an incomplete record at {} of history segment {}'.format(end, path))
+            with open(path, 'r+b') as file:
+                file.truncate(end)
+        return last_sequence
+
+    @staticmethod
+    def __iterate_records(path: str) -> Iterator[Tuple[int, mmap.mmap, int, int]]:
+        """
+        Records are not copied out of the mapped segment, only the ones decoded are read
+        :return: an iterator of the sequence, the mapped segment, and the offsets where the packet data starts and ends
+        """
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:  # deleted by a rotation since, so it's older than what's kept anyway
+            return
+        with file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + _RECORD_HEADER.size <= len(data):
+                    sequence, length = _RECORD_HEADER.unpack_from(data, offset)
+                    end = offset + _RECORD_HEADER.size + length
+                    if end > len(data):
+                        break
+                    yield sequence, data, offset + _RECORD_HEADER.size, end
+                    offset = end
+
+    def append(self, packet: ChatPacket):
+        data = BINARY_CODEC.encode(packet)
+        if self.__file is None or self.__file_size + _RECORD_HEADER.size + len(data) > self.segment_size:
+            self.__rotate(packet.sequence)
+        self.__file.write(_RECORD_HEADER.pack(packet.sequence, len(data)))
+        self.__file.write(data)
+        self.__file_size += _RECORD_HEADER.size + len(data)
+        self.last_sequence = packet.sequence
+
+    def __rotate(self, first_sequence: int):
+        if self.__file is not None:
+            self.__file.close()
+        path = os.path.join(self.directory, '{:020d}{}'.format(first_sequence, _SEGMENT_SUFFIX))
+        self.__file = open(path, 'ab')
+        self.__file_size = self.__file.tell()
+        self.__segments.append((first_sequence, path))
+        while len(self.__segments) > self.segment_count:
+            _, old_path = self.__segments.pop(0)
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                self.logger.warning('Failed to delete history segment {}: {}'.format(old_path, e))
+
+    def read(self, after: int, before: int, predicate: Callable[[ChatPacket], bool], limit: int) -> Iterator[ChatPacket]:
+        """
+        The latest limit chats with a sequence larger than after and smaller than before that match the predicate, in order
+        Segments are read from the newest one until enough chats are found, so a client far behind doesn't read the whole log
+        The segments to read are decided when it's called, so the iterator can be consumed without the history lock
+        as long as the chats are appended already
+        """
+        if self.__file is not None:
+            self.__file.flush()
+        return self.__read_segments(list(self.__segments), after, before, predicate, limit)
+
+    def __read_segments(self, segments: List[Tuple[int, str]], after: int, before: int, predicate: Callable[[ChatPacket], bool], limit: int) -> Iterator[ChatPacket]:
+        found: List[Deque[ChatPacket]] = []
+        count = 0
+        for first_sequence, path in reversed(segments):
+            if count >= limit:
+                break
+            if first_sequence >= before:
+                continue
+            packets = collections.deque(filter(predicate, self.__read_segment(path, after, before)), maxlen=limit - count)
+            found.append(packets)
+            count += len(packets)
+            if first_sequence <= after + 1:
+                break  # every record in the older segments is too old
+        for packets in reversed(found):
+            yield from packets
+
+    def __read_segment(self, path: str, after: int, before: int) -> Iterator[ChatPacket]:
+        for sequence, data, start, end in self.__iterate_records(path):
+            if sequence >= before:
+                break
+            if sequence > after:
+                packet = BINARY_CODEC.decode_from(data, start, end, ChatPacket)[0]
+                packet.sequence = sequence
+                yield packet
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+class History:
+    """
+    A ring of the latest chats, backed by an optional log for the older ones
+    Not thread safe, the server calls it with its history lock held
+    """
+    def __init__(self, size: int, log: Optional[HistoryLog] = None):
+        self.__ring: Deque[ChatPacket] = collections.deque(maxlen=max(0, size))
+        self.__log = log
+        self.__sequence = log.last_sequence if log is not None else 0
+
+    def append(self, packet: ChatPacket):
+        """
+        Give the packet the next sequence and keep it
+        """
+        self.__sequence = max(self.__sequence + 1, time.time_ns() // 1000)
+        packet.sequence = self.__sequence
+        if self.__ring.maxlen > 0:
+            self.__ring.append(packet)
+        if self.__log is not None:
+            self.__log.append(packet)
+
+    def get_last_sequence(self) -> int:
+        return self.__sequence
+
+    def get_oldest_sequence(self) -> int:
+        """
+        The oldest sequence in the ring, the chats before it are in the log only
+        """
+        ring = self.__ring
+        return ring[0].sequence if len(ring) > 0 else self.__sequence + 1
+
+    def read_log(self, after: int, before: int, predicate: Callable[[ChatPacket], bool], limit: int) -> Iterator[ChatPacket]:
+        """
+        The latest chats in the log between the sequences, see HistoryLog.read for reading them without the lock
+        """
+        if self.__log is None or before <= after + 1:
+            return iter(())
+        return self.__log.read(after, before, predicate, limit)
+
+    def since(self, sequence: int, predicate: Callable[[ChatPacket], bool], limit: int) -> List[ChatPacket]:
+        """
+        The latest limit chats after the sequence that match the predicate, in order
+        """
+        result: Deque[ChatPacket] = collections.deque(maxlen=max(0, limit))
+        # the ring doesn't go back far enough, e.g. it's filled again since a restart
+        result.extend(self.read_log(sequence, self.get_oldest_sequence(), predicate, limit))
+        result.extend(packet for packet in self.__ring if packet.sequence > sequence and predicate(packet))
+        return list(result)
+
+    def close(self):
+        if self.__log is not None:
+            self.__log.close()
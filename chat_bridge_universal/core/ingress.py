@@ -0,0 +1,133 @@
+"""
+Limits on the chats a single client can push into the server, so one spamming client can't make the server
+fan out unlimited chats to everyone else
+
+Each client has a token bucket of chats, and remembers the chats it sent recently to drop identical ones
+"""
+import collections
+import time
+from enum import Enum, unique
+from typing import List, Tuple, Optional, Hashable
+
+from chat_bridge_universal.core.network.protocal import ChatPacket, ChatPayload
+from chat_bridge_universal.utils.serializer import serialize
+
+DUPLICATE_CACHE_SIZE = 1024
+
+
+@unique
+class RateLimitPolicy(Enum):
+    drop = 'drop'  # discard the chats over the limit
+    delay = 'delay'  # stop reading from the client until the chats are within the limit, up to the max delay
+
+
+class TokenBucket:
+    """
+    Allows rate events per second on average and burst at once
+    Not thread safe
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.__tokens = self.burst
+        self.__time = time.monotonic()
+
+    def take(self, max_delay: float = 0) -> Optional[float]:
+        """
+        Take a token, borrowing from the future up to max_delay seconds if there's none left
+        :return: seconds to wait before the event is within the rate, or None if that's longer than max_delay
+        """
+        now = time.monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__time) * self.rate)
+        self.__time = now
+        delay = max(0.0, (1 - self.__tokens) / self.rate)
+        if delay > max_delay:
+            return None
+        self.__tokens -= 1
+        return delay
+
+
+class DuplicateCache:
+    """
+    Keys seen in the last window seconds, a key is remembered since the first time it's seen, not the latest
+    At most size keys are kept, the oldest ones are forgotten first
+    Not thread safe
+    """
+    def __init__(self, window: float, size: int = DUPLICATE_CACHE_SIZE):
+        self.window = window
+        self.size = max(1, size)
+        self.__seen: 'collections.OrderedDict[Hashable, float]' = collections.OrderedDict()
+
+    def add(self, key: Hashable) -> bool:
+        """
+        :return: False if the key has been seen in the window
+        """
+        now = time.monotonic()
+        seen = self.__seen
+        while len(seen) > 0:
+            oldest_key, oldest_time = next(iter(seen.items()))
+            if now - oldest_time < self.window:
+                break
+            del seen[oldest_key]
+        if key in seen:
+            return False
+        seen[key] = now
+        if len(seen) > self.size:
+            seen.popitem(last=False)
+        return True
+
+    def discard(self, key: Hashable):
+        self.__seen.pop(key, None)
+
+
+def get_duplicate_key(packet: ChatPacket) -> Hashable:
+    """
+    Chats with the same key have the same sender, recipients and payload
+    """
+    payload = packet.payload
+    if type(payload) is ChatPayload:
+        content = (payload.author, payload.message)
+    else:
+        content = repr(serialize(payload))
+    return packet.sender, packet.channel, packet.broadcast, tuple(packet.receivers), content
+
+
+class IngressLimiter:
+    """
+    The rate limit and the duplicate suppression of the chats from a client
+    Used by the thread reading from the client only
+    """
+    def __init__(self, rate: float, burst: float, policy: RateLimitPolicy, max_delay: float, duplicate_window: float, duplicate_cache_size: int = DUPLICATE_CACHE_SIZE):
+        self.policy = policy
+        self.max_delay = max_delay if policy == RateLimitPolicy.delay else 0
+        self.__bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.__duplicates = DuplicateCache(duplicate_window, duplicate_cache_size) if duplicate_window > 0 else None
+
+    def is_enabled(self) -> bool:
+        return self.__bucket is not None or self.__duplicates is not None
+
+    def check(self, packets: List[ChatPacket]) -> Tuple[List[ChatPacket], float, int, int]:
+        """
+        :return: the chats allowed, seconds to wait before processing them,
+        and the amounts of chats dropped for being over the rate and for being duplicated
+        """
+        allowed = []
+        delay = 0.0
+        rate_limited = duplicated = 0
+        for packet in packets:
+            key = None
+            if self.__duplicates is not None:
+                key = get_duplicate_key(packet)
+                if not self.__duplicates.add(key):
+                    duplicated += 1
+                    continue
+            if self.__bucket is not None:
+                packet_delay = self.__bucket.take(self.max_delay)
+                if packet_delay is None:
+                    if key is not None:  # it's not taken, so sending it again later is fine
+                        self.__duplicates.discard(key)
+                    rate_limited += 1
+                    continue
+                delay = max(delay, packet_delay)
+            allowed.append(packet)
+        return allowed, delay, rate_limited, duplicated
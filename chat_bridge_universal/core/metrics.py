@@ -0,0 +1,261 @@
+"""
+In-process metrics: counters, gauges and latency histograms, identified by a name and labels
+
+Everything registers to the process-wide REGISTRY, which can be rendered as plain text for the console
+or in the Prometheus text exposition format for scraping
+"""
+import bisect
+from threading import Lock, Thread
+from typing import Dict, Tuple, List, Optional, Callable, Iterable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from http.server import HTTPServer
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# seconds, from 10us to 10s
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+
+class Counter:
+    def __init__(self):
+        self.__value = 0
+        self.__lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self.__lock:
+            self.__value += amount
+
+    @property
+    def value(self) -> float:
+        return self.__value
+
+
+class Gauge:
+    """
+    A value that goes up and down, or is read from a function when collected
+    """
+    def __init__(self, function: Optional[Callable[[], float]] = None):
+        self.__value = 0
+        self.function = function
+
+    def set(self, value: float):
+        self.__value = value
+
+    @property
+    def value(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.__value
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets: List[float] = sorted(buckets)
+        self.__counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.__sum = 0.0
+        self.__count = 0
+        self.__lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__sum += value
+            self.__count += 1
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    @property
+    def sum(self) -> float:
+        return self.__sum
+
+    def get_cumulative_counts(self) -> List[int]:
+        with self.__lock:
+            counts = list(self.__counts)
+        result, total = [], 0
+        for count in counts:
+            total += count
+            result.append(total)
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimated by interpolating inside the bucket the quantile falls into
+        """
+        cumulative = self.get_cumulative_counts()
+        total = cumulative[-1]
+        if total == 0:
+            return None
+        rank = q * total
+        index = bisect.bisect_left(cumulative, rank)
+        if index >= len(self.buckets):
+            return self.buckets[-1]
+        lower = self.buckets[index - 1] if index > 0 else 0
+        previous = cumulative[index - 1] if index > 0 else 0
+        in_bucket = cumulative[index] - previous
+        if in_bucket == 0:
+            return self.buckets[index]
+        return lower + (self.buckets[index] - lower) * (rank - previous) / in_bucket
+
+
+class _Family:
+    def __init__(self, kind: str, documentation: str):
+        self.kind = kind
+        self.documentation = documentation
+        self.metrics: Dict[LabelKey, object] = {}
+
+
+def _format_labels(labels: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = labels + extra
+    if len(items) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in items) + '}'
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__families: Dict[str, _Family] = {}
+        self.__lock = Lock()
+
+    def __get(self, kind: str, name: str, documentation: str, labels: Optional[Dict[str, str]], factory: Callable[[], object]):
+        key: LabelKey = tuple(sorted((labels or {}).items()))
+        with self.__lock:
+            family = self.__families.get(name)
+            if family is None:
+                family = self.__families[name] = _Family(kind, documentation)
+            elif family.kind != kind:
+                raise ValueError('Metric {} is a {} instead of a {}'.format(name, family.kind, kind))
+            metric = family.metrics.get(key)
+            if metric is None:
+                metric = family.metrics[key] = factory()
+            return metric
+
+    def counter(self, name: str, documentation: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        return self.__get('counter', name, documentation, labels, Counter)
+
+    def gauge(self, name: str, documentation: str, labels: Optional[Dict[str, str]] = None, function: Optional[Callable[[], float]] = None) -> Gauge:
+        """
+        :param function: if given, the value is read from it, replacing the function of an existing gauge
+        """
+        gauge: Gauge = self.__get('gauge', name, documentation, labels, Gauge)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, documentation: str, labels: Optional[Dict[str, str]] = None, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.__get('histogram', name, documentation, labels, lambda: Histogram(buckets))
+
+    def __snapshot(self) -> List[Tuple[str, _Family, List[Tuple[LabelKey, object]]]]:
+        with self.__lock:
+            return [(name, family, sorted(family.metrics.items())) for name, family in sorted(self.__families.items())]
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, family, metrics in self.__snapshot():
+            lines.append('# HELP {} {}'.format(name, family.documentation))
+            lines.append('# TYPE {} {}'.format(name, family.kind))
+            for labels, metric in metrics:
+                if isinstance(metric, Histogram):
+                    for bound, count in zip(metric.buckets + [float('inf')], metric.get_cumulative_counts()):
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, (('le', _format_number(bound)),)), count))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_number(metric.sum)))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), metric.count))
+                else:
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_number(metric.value)))
+        return '\n'.join(lines) + '\n'
+
+    def render_text(self, prefix: str = '') -> List[str]:
+        """
+        Human readable lines of metrics whose name starts with the prefix, histograms are shown in milliseconds
+        """
+        lines = []
+        for name, family, metrics in self.__snapshot():
+            if not name.startswith(prefix):
+                continue
+            for labels, metric in metrics:
+                title = name + _format_labels(labels)
+                if isinstance(metric, Histogram):
+                    if metric.count == 0:
+                        lines.append('{}: no samples'.format(title))
+                    else:
+                        lines.append('{}: count {}, mean {:.3f}ms, p50 {:.3f}ms, p99 {:.3f}ms'.format(
+                            title, metric.count, metric.sum / metric.count * 1000,
+                            metric.quantile(0.5) * 1000, metric.quantile(0.99) * 1000
+                        ))
+                else:
+                    value = metric.value
+                    lines.append('{}: {}'.format(title, round(value, 3) if isinstance(value, float) else value))
+        return lines
+
+
+REGISTRY = MetricsRegistry()
+
+
+def or_nan(value: Optional[float]) -> float:
+    """
+    For gauges of values that might be unknown
+    """
+    return value if value is not None else float('nan')
+
+
+class ConnectionMetrics:
+    """
+    Traffic counters of a connection, role is "client" for CBUClient and "server" for the server side of a connection
+    """
+    def __init__(self, role: str, name: str, registry: MetricsRegistry = REGISTRY):
+        self.labels = {'role': role, 'name': name}
+        self.frames_sent = registry.counter('cbu_frames_sent_total', 'Frames written to the connection', self.labels)
+        self.bytes_sent = registry.counter('cbu_sent_bytes_total', 'Bytes written to the connection', self.labels)
+        self.frames_received = registry.counter('cbu_frames_received_total', 'Frames received from the connection', self.labels)
+        self.bytes_received = registry.counter('cbu_received_bytes_total', 'Bytes received from the connection', self.labels)
+
+    def on_sent(self, size: int):
+        self.frames_sent.inc()
+        self.bytes_sent.inc(size)
+
+    def on_received(self, size: int):
+        self.frames_received.inc()
+        self.bytes_received.inc(size)
+
+
+def start_http_server(hostname: str, port: int, registry: MetricsRegistry = REGISTRY) -> 'HTTPServer':
+    """
+    Serve the metrics in the Prometheus text format at /metrics in a daemon thread
+    """
+    # imported here, since most servers and every client never serve metrics
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((hostname, port), Handler)
+    Thread(target=server.serve_forever, name='MetricsHTTPServer', daemon=True).start()
+    return server
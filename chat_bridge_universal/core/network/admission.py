@@ -0,0 +1,96 @@
+"""
+Admission of new connections before they log in, so a crowd of clients reconnecting at once after a restart,
+or sockets that never send a login packet, can't pile up threads and memory on the server
+"""
+import collections
+import queue
+import time
+from threading import Thread, Lock
+from typing import Callable, Tuple
+
+MAX_LOGIN_FRAME_SIZE = 64 * 1024  # a login packet is way smaller, a larger frame is not a client of ours
+MAX_TRACKED_HOSTS = 4096
+
+
+class AcceptRateLimiter:
+    """
+    A token bucket for each remote host, allowing rate connections per second on average and burst at once
+    The least recently seen hosts are forgotten first, so a forgotten host starts with a full bucket again
+    Not thread safe, it's used by the accepting thread only
+    """
+    def __init__(self, rate: float, burst: float, max_hosts: int = MAX_TRACKED_HOSTS):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_hosts = max_hosts
+        self.__buckets: 'collections.OrderedDict[str, Tuple[float, float]]' = collections.OrderedDict()  # host -> tokens, time
+
+    def is_enabled(self) -> bool:
+        return self.rate > 0
+
+    def allow(self, host: str) -> bool:
+        if not self.is_enabled():
+            return True
+        now = time.monotonic()
+        tokens, last_time = self.__buckets.pop(host, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last_time) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.__buckets[host] = (tokens, now)
+        if len(self.__buckets) > self.max_hosts:
+            self.__buckets.popitem(last=False)
+        return allowed
+
+
+class HandshakePool:
+    """
+    A fixed amount of threads doing handshakes, fed by a bounded queue of accepted connections
+    Connections that don't fit into the queue are refused by submit, instead of getting a thread each
+    """
+    def __init__(self, workers: int, max_pending: int, handler: Callable, name: str = 'Handshake'):
+        self.__handler = handler
+        self.__queue: queue.Queue = queue.Queue(max(1, max_pending))
+        self.__busy = 0
+        self.__busy_lock = Lock()
+        self.__threads = [
+            Thread(target=self.__work, name='{}#{}'.format(name, i), daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self.__threads:
+            thread.start()
+
+    def submit(self, *args) -> bool:
+        """
+        :return: False if too many handshakes are pending, the handler will not be called with the args then
+        """
+        try:
+            self.__queue.put_nowait(args)
+        except queue.Full:
+            return False
+        return True
+
+    def get_pending_count(self) -> int:
+        """
+        The handshakes queued or in progress
+        """
+        return self.__queue.qsize() + self.__busy
+
+    def __work(self):
+        while True:
+            args = self.__queue.get()
+            if args is None:
+                break
+            with self.__busy_lock:
+                self.__busy += 1
+            try:
+                self.__handler(*args)
+            finally:
+                with self.__busy_lock:
+                    self.__busy -= 1
+
+    def stop(self):
+        """
+        Let the threads exit after the handshakes queued already are handled
+        """
+        for _ in self.__threads:
+            self.__queue.put(None)
@@ -0,0 +1,74 @@
+import time
+from logging import Logger
+from threading import Condition, Thread
+from typing import Callable, List, Generic, TypeVar
+
+T = TypeVar('T')
+
+
+class Batcher(Generic[T]):
+    """
+    Collect items for a short time window or up to a count, then hand them to the flush callback together
+
+    The window starts when the first item arrives, so a lone item waits at most one window.
+    Flush callbacks are invoked on the batcher thread, except the final one in close()
+    """
+    def __init__(self, flush_callback: Callable[[List[T]], None], *, window: float, max_size: int, logger: Logger, thread_name: str):
+        self.window = window
+        self.max_size = max(1, max_size)
+        self.__flush_callback = flush_callback
+        self.__logger = logger
+        self.__pending: List[T] = []
+        self.__first_time = 0.0
+        self.__condition = Condition()
+        self.__closed = False
+        self.__thread = Thread(target=self.__loop, name=thread_name, daemon=True)
+        self.__thread.start()
+
+    def add(self, item: T) -> bool:
+        """
+        :return: False if the batcher is closed, where the item is not taken
+        """
+        with self.__condition:
+            if self.__closed:
+                return False
+            if len(self.__pending) == 0:
+                self.__first_time = time.monotonic()
+            self.__pending.append(item)
+            self.__condition.notify()
+            return True
+
+    def __loop(self):
+        while True:
+            with self.__condition:
+                while len(self.__pending) == 0 and not self.__closed:
+                    self.__condition.wait()
+                if self.__closed:
+                    return
+                deadline = self.__first_time + self.window
+                while len(self.__pending) < self.max_size and not self.__closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(remaining)
+                if self.__closed:
+                    return
+                items, self.__pending = self.__pending, []
+            self.__flush(items)
+
+    def __flush(self, items: List[T]):
+        try:
+            self.__flush_callback(items)
+        except Exception as e:
+            self.__logger.exception('Failed to flush {} batched items: {}'.format(len(items), e))
+
+    def close(self):
+        """
+        Stop the batcher thread and flush the remaining items in the current thread
+        """
+        with self.__condition:
+            self.__closed = True
+            items, self.__pending = self.__pending, []
+            self.__condition.notify_all()
+        if len(items) > 0:
+            self.__flush(items)
@@ -0,0 +1,335 @@
+"""
+Codecs turning packets into the plaintext of a frame
+
+- Protocol v1: the json of the serialized packet, framed with a native-endian length header
+- Protocol v2: a compact binary layout with network byte order, framed with a network byte order length header
+
+Login packets are always exchanged with v1, during which the peers agree on the codec for the rest of the connection
+"""
+import copy
+import json
+import struct
+from typing import Type, TypeVar, Dict, List, Tuple, Any, Callable, Union
+
+from chat_bridge_universal.core.network.protocal import AbstractPacket, AbstractPayload, LoginPacket, LoginResultPacket, ChatPacket, \
+    ChatPayload, BatchPacket, PingPacket, PongPacket, ChannelPacket, TicketPacket, ChunkPacket
+
+T = TypeVar('T', bound=AbstractPacket)
+
+PROTOCOL_VERSION_JSON = 1
+PROTOCOL_VERSION_BINARY = 2
+LATEST_PROTOCOL_VERSION = PROTOCOL_VERSION_BINARY
+
+
+class AbstractCodec:
+    version: int
+    header: struct.Struct  # the frame length header
+
+    def encode(self, packet: AbstractPacket) -> bytes:
+        raise NotImplementedError()
+
+    def decode(self, data: bytes, packet_type: Type[T]) -> T:
+        """
+        :param data: the decrypted frame body, which might be followed by NUL paddings
+        :param packet_type: the expected packet type, a packet of other types results in a TypeError
+        """
+        raise NotImplementedError()
+
+
+class JsonCodec(AbstractCodec):
+    version = PROTOCOL_VERSION_JSON
+    header = struct.Struct('I')
+
+    def encode(self, packet: AbstractPacket) -> bytes:
+        return json.dumps(packet.serialize(), ensure_ascii=False).encode('utf8')
+
+    def decode(self, data: bytes, packet_type: Type[T]) -> T:
+        return packet_type.deserialize(json.loads(bytes(data).rstrip(b'\0').decode('utf8')))
+
+
+_U8 = struct.Struct('!B')
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+_I64 = struct.Struct('!q')
+_F64 = struct.Struct('!d')
+_BOOL = struct.Struct('!?')
+_BODY_HEADER = struct.Struct('!BBI')  # protocol version, packet type id, length of the field data
+_BATCH_TYPE_ID = 4
+
+_PAYLOAD_CHAT = 0  # a ChatPayload, stored as author and message
+_PAYLOAD_JSON = 1  # anything else, stored as json
+
+
+def _check_end(pos: int, end: int):
+    if pos > end:
+        raise ValueError('Unexpected end of packet')
+
+
+def _write_str(buffer: bytearray, value: str):
+    data = value.encode('utf8')
+    buffer += _U32.pack(len(data))
+    buffer += data
+
+
+def _read_str(data: bytes, pos: int, end: int) -> Tuple[str, int]:
+    _check_end(pos + _U32.size, end)
+    length = _U32.unpack_from(data, pos)[0]
+    pos += _U32.size
+    _check_end(pos + length, end)
+    return str(data[pos:pos + length], 'utf8'), pos + length
+
+
+def _write_str_list(buffer: bytearray, value: List[str]):
+    buffer += _U16.pack(len(value))
+    for element in value:
+        _write_str(buffer, element)
+
+
+def _read_str_list(data: bytes, pos: int, end: int) -> Tuple[List[str], int]:
+    _check_end(pos + _U16.size, end)
+    count = _U16.unpack_from(data, pos)[0]
+    pos += _U16.size
+    result = []
+    for _ in range(count):
+        element, pos = _read_str(data, pos, end)
+        result.append(element)
+    return result, pos
+
+
+def _write_bytes(buffer: bytearray, value: bytes):
+    buffer += _U32.pack(len(value))
+    buffer += value
+
+
+def _read_bytes(data: bytes, pos: int, end: int) -> Tuple[bytes, int]:
+    _check_end(pos + _U32.size, end)
+    length = _U32.unpack_from(data, pos)[0]
+    pos += _U32.size
+    _check_end(pos + length, end)
+    return bytes(data[pos:pos + length]), pos + length
+
+
+def _write_json(buffer: bytearray, value: Any):
+    _write_str(buffer, json.dumps(value, ensure_ascii=False))
+
+
+def _read_json(data: bytes, pos: int, end: int) -> Tuple[Any, int]:
+    value, pos = _read_str(data, pos, end)
+    return json.loads(value), pos
+
+
+def _write_payload(buffer: bytearray, value: Any):
+    if type(value) is ChatPayload and type(value.author) is str and type(value.message) is str:
+        author, message = value.author, value.message
+    else:
+        data = value.serialize() if isinstance(value, AbstractPayload) else value
+        if not (isinstance(data, dict) and data.keys() == {'author', 'message'} and all(isinstance(v, str) for v in data.values())):
+            buffer += _U8.pack(_PAYLOAD_JSON)
+            _write_json(buffer, data)
+            return
+        author, message = data['author'], data['message']
+    buffer += _U8.pack(_PAYLOAD_CHAT)
+    _write_str(buffer, author)
+    _write_str(buffer, message)
+
+
+def _read_payload(data: bytes, pos: int, end: int) -> Tuple[ChatPayload, int]:
+    _check_end(pos + _U8.size, end)
+    kind = data[pos]
+    pos += _U8.size
+    if kind == _PAYLOAD_CHAT:
+        payload = object.__new__(ChatPayload)
+        payload.author, pos = _read_str(data, pos, end)
+        payload.message, pos = _read_str(data, pos, end)
+        return payload, pos
+    elif kind == _PAYLOAD_JSON:
+        value, pos = _read_json(data, pos, end)
+        return ChatPayload.deserialize(value), pos
+    raise ValueError('Unknown payload kind {}'.format(kind))
+
+
+def _write_packets(buffer: bytearray, value: List[AbstractPacket]):
+    buffer += _U32.pack(len(value))
+    for packet in value:
+        if isinstance(packet, BatchPacket):
+            raise ValueError('Nested batch packet')
+        buffer += BINARY_CODEC.encode(packet)
+
+
+def _read_packets(data: bytes, pos: int, end: int) -> Tuple[List[AbstractPacket], int]:
+    _check_end(pos + _U32.size, end)
+    count = _U32.unpack_from(data, pos)[0]
+    pos += _U32.size
+    packets = []
+    for _ in range(count):
+        # a batch holds plain packets only, so a crafted frame cannot nest batches until the stack overflows
+        _check_end(pos + _BODY_HEADER.size, end)
+        if data[pos + 1] == _BATCH_TYPE_ID:
+            raise ValueError('Nested batch packet')
+        packet, pos = BINARY_CODEC.decode_from(data, pos, end, AbstractPacket)
+        packets.append(packet)
+    return packets, pos
+
+
+# field type -> fixed size struct, or the functions writing it to a buffer and reading it at a position
+FIELD_TYPES: Dict[str, Union[struct.Struct, Tuple[Callable[[bytearray, Any], None], Callable[[bytes, int, int], Tuple[Any, int]]]]] = {
+    'bool': _BOOL,
+    'int': _I64,
+    'float': _F64,
+    'str': (_write_str, _read_str),
+    'str_list': (_write_str_list, _read_str_list),
+    'bytes': (_write_bytes, _read_bytes),
+    'json': (_write_json, _read_json),
+    'payload': (_write_payload, _read_payload),
+    'packets': (_write_packets, _read_packets),
+}
+
+
+def _compile_packet_functions(version: int, type_id: int, packet_type: Type[AbstractPacket], fields: List[Tuple[str, str]]) -> Tuple[Callable, Callable]:
+    """
+    Generate the encoder and the decoder of a packet type, with every field written and read inline
+    :return: encode(packet) -> bytes, decode(data, pos, end) -> packet
+    """
+    defaults = packet_type._field_defaults
+    scope = {
+        '_BODY_HEADER': _BODY_HEADER, '_HEADER_SIZE': _BODY_HEADER.size, '_new': object.__new__, '_cls': packet_type,
+        '_copy': copy.copy, '_check_end': _check_end,
+    }
+    encode_body, decode_body = [], []
+    for i, (name, field_type) in enumerate(fields):
+        handler = FIELD_TYPES[field_type]
+        decode_body.append('if pos < end:')
+        if isinstance(handler, struct.Struct):
+            scope['_s{}'.format(i)] = handler
+            encode_body.append('b += _s{}.pack(packet.{})'.format(i, name))
+            decode_body.append('    _check_end(pos + {}, end)'.format(handler.size))
+            decode_body.append('    packet.{} = _s{}.unpack_from(data, pos)[0]'.format(name, i))
+            decode_body.append('    pos += {}'.format(handler.size))
+        else:
+            scope['_w{}'.format(i)], scope['_r{}'.format(i)] = handler
+            encode_body.append('_w{}(b, packet.{})'.format(i, name))
+            decode_body.append('    packet.{}, pos = _r{}(data, pos, end)'.format(name, i))
+        decode_body.append('else:')
+        decode_body.extend('    ' + line for line in _default_lines(scope, defaults, packet_type, name, 'f{}'.format(i)))
+    registered = {name for name, _ in fields}
+    for i, name in enumerate(packet_type.get_annotations_fields().keys()):
+        if name not in registered:
+            decode_body.extend(_default_lines(scope, defaults, packet_type, name, 'u{}'.format(i)))
+    source = '\n'.join([
+        'def encode(packet):',
+        '    b = bytearray(_HEADER_SIZE)',
+        *['    ' + line for line in encode_body],
+        '    _BODY_HEADER.pack_into(b, 0, {}, {}, len(b) - _HEADER_SIZE)'.format(version, type_id),
+        '    return bytes(b)',
+        '',
+        'def decode(data, pos, end):',
+        '    packet = _new(_cls)',
+        *['    ' + line for line in decode_body],
+        '    return packet',
+    ])
+    exec(compile(source, '<binary codec of {}>'.format(packet_type.__name__), 'exec'), scope)
+    return scope['encode'], scope['decode']
+
+
+def _default_lines(scope: dict, defaults: Dict[str, Any], packet_type: Type[AbstractPacket], name: str, key: str) -> List[str]:
+    """
+    Lines of generated code filling a field missing in the data with its default
+    """
+    if name not in defaults:
+        return ['raise ValueError("Missing field {} for packet {}")'.format(name, packet_type.__name__)]
+    scope['_d' + key] = defaults[name]
+    if isinstance(defaults[name], (type(None), bool, int, float, str)):
+        return ['packet.{} = _d{}'.format(name, key)]
+    return ['packet.{} = _copy(_d{})'.format(name, key)]
+
+
+class BinaryCodec(AbstractCodec):
+    """
+    Frame body layout: u8 protocol version, u8 packet type id, u32 field data length, field data
+
+    Fields are written in their registered order. New fields should only be appended to the end,
+    a decoder fills missing trailing fields with the class default and skips unknown trailing data,
+    so peers with different field sets can still talk to each other.
+    The encoder and decoder of each packet type are generated when it's registered
+    """
+    version = PROTOCOL_VERSION_BINARY
+    header = struct.Struct('!I')
+
+    __ENCODERS: Dict[Type[AbstractPacket], Callable[[AbstractPacket], bytes]] = {}
+    __DECODERS: Dict[int, Tuple[Type[AbstractPacket], Callable[[bytes, int, int], AbstractPacket]]] = {}
+
+    @classmethod
+    def register(cls, type_id: int, packet_type: Type[AbstractPacket], fields: List[Tuple[str, str]]):
+        """
+        :param fields: a list of (field name, field type), where field type is a key of FIELD_TYPES
+        """
+        if type_id in cls.__DECODERS:
+            raise KeyError('Duplicated packet type id {} for {}'.format(type_id, packet_type))
+        for _, field_type in fields:
+            if field_type not in FIELD_TYPES:
+                raise KeyError('Unknown field type {}'.format(field_type))
+        encoder, decoder = _compile_packet_functions(cls.version, type_id, packet_type, fields)
+        cls.__ENCODERS[packet_type] = encoder
+        cls.__DECODERS[type_id] = (packet_type, decoder)
+
+    @classmethod
+    def is_supported(cls, packet_type: Type[AbstractPacket]) -> bool:
+        return packet_type in cls.__ENCODERS
+
+    def encode(self, packet: AbstractPacket) -> bytes:
+        return self.__ENCODERS[type(packet)](packet)
+
+    def decode(self, data: bytes, packet_type: Type[T]) -> T:
+        return self.decode_from(data, 0, len(data), packet_type)[0]
+
+    def decode_from(self, data: bytes, offset: int, limit: int, packet_type: Type[T]) -> Tuple[T, int]:
+        """
+        Decode the packet starting at offset, which should end before limit
+        :return: the packet, and the offset where it ends
+        """
+        if offset + _BODY_HEADER.size > limit:
+            raise ValueError('Packet too short')
+        version, type_id, length = _BODY_HEADER.unpack_from(data, offset)
+        if version != self.version:
+            raise ValueError('Unexpected protocol version {}'.format(version))
+        entry = self.__DECODERS.get(type_id)
+        if entry is None:
+            raise ValueError('Unknown packet type id {}'.format(type_id))
+        actual_type, decoder = entry
+        if not issubclass(actual_type, packet_type):
+            raise TypeError('Expected packet {} but {} found'.format(packet_type.__name__, actual_type.__name__))
+        end = offset + _BODY_HEADER.size + length
+        if end > limit:
+            raise ValueError('Unexpected end of packet')
+        return decoder(data, offset + _BODY_HEADER.size, end), end
+
+
+BinaryCodec.register(1, LoginPacket, [('name', 'str'), ('password', 'str'), ('protocol_version', 'int'), ('ciphers', 'str_list'), ('compressions', 'str_list'), ('channels', 'str_list'), ('last_sequence', 'int'), ('ticket', 'str'), ('chunking', 'bool')])
+BinaryCodec.register(2, LoginResultPacket, [('success', 'bool'), ('message', 'str'), ('protocol_version', 'int'), ('cipher', 'str'), ('compression', 'str'), ('ticket', 'str'), ('ticket_lifetime', 'float'), ('chunking', 'bool')])
+BinaryCodec.register(3, ChatPacket, [('sender', 'str'), ('receivers', 'str_list'), ('payload', 'payload'), ('broadcast', 'bool'), ('channel', 'str'), ('path', 'str_list'), ('origin_id', 'int'), ('sequence', 'int')])
+BinaryCodec.register(_BATCH_TYPE_ID, BatchPacket, [('packets', 'packets')])
+BinaryCodec.register(5, PingPacket, [('timestamp', 'float')])
+BinaryCodec.register(6, PongPacket, [('timestamp', 'float')])
+BinaryCodec.register(7, ChannelPacket, [('join', 'str_list'), ('leave', 'str_list')])
+BinaryCodec.register(8, TicketPacket, [('ticket', 'str'), ('lifetime', 'float')])
+BinaryCodec.register(9, ChunkPacket, [('stream_id', 'int'), ('index', 'int'), ('total_size', 'int'), ('data', 'bytes')])
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+
+
+_CODECS: Dict[int, AbstractCodec] = {codec.version: codec for codec in (JSON_CODEC, BINARY_CODEC)}
+
+
+def get_codec(version: int) -> AbstractCodec:
+    codec = _CODECS.get(version)
+    if codec is None:
+        raise ValueError('Unsupported protocol version {}'.format(version))
+    return codec
+
+
+def negotiate_version(requested: int, supported: int) -> int:
+    """
+    The version both sides are able to speak
+    """
+    return max(PROTOCOL_VERSION_JSON, min(requested, supported, LATEST_PROTOCOL_VERSION))
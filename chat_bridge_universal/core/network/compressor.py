@@ -0,0 +1,125 @@
+import os
+import zlib
+from typing import Optional, List
+
+ZLIB = 'zlib'
+ZLIB_DICT_PREFIX = 'zlib-dict-'
+
+
+class Compressor:
+    """
+    Compress the plaintext of a frame before it's encrypted
+
+    A flag byte is prepended so frames below the threshold can still be sent uncompressed.
+    Every frame is compressed independently, so a frame can be shared by all recipients using the same compression
+    """
+    FLAG_RAW = 0
+    FLAG_ZLIB = 1
+
+    def __init__(self, name: str, *, threshold: int, level: int, max_size: int, dictionary: Optional[bytes] = None):
+        self.name = name
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size  # max decompressed size, against compression bombs
+        self.dictionary = dictionary
+        # statistic of compressed frames
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    @property
+    def ratio(self) -> float:
+        """
+        compressed size / raw size of the compressed frames, the smaller the better
+        """
+        return self.compressed_bytes / self.raw_bytes if self.raw_bytes > 0 else 1.0
+
+    def __compressobj(self):
+        if self.dictionary is not None:
+            return zlib.compressobj(self.level, zdict=self.dictionary)
+        return zlib.compressobj(self.level)
+
+    def __decompressobj(self):
+        if self.dictionary is not None:
+            return zlib.decompressobj(zdict=self.dictionary)
+        return zlib.decompressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        if len(data) >= self.threshold:
+            compressobj = self.__compressobj()
+            compressed = compressobj.compress(data) + compressobj.flush()
+            if len(compressed) < len(data):
+                self.raw_bytes += len(data)
+                self.compressed_bytes += len(compressed)
+                return bytes((self.FLAG_ZLIB,)) + compressed
+        return bytes((self.FLAG_RAW,)) + data
+
+    def decompress(self, data: bytes) -> bytes:
+        """
+        Trailing data after the compressed stream, e.g. cipher paddings, is ignored
+        """
+        if len(data) == 0:
+            raise ValueError('Empty compressed data')
+        flag = data[0]
+        if flag == self.FLAG_RAW:
+            return data[1:]
+        elif flag == self.FLAG_ZLIB:
+            decompressobj = self.__decompressobj()
+            try:
+                result = decompressobj.decompress(memoryview(data)[1:], self.max_size)
+            except zlib.error as e:
+                raise ValueError('Failed to decompress data: {}'.format(e)) from None
+            if decompressobj.unconsumed_tail:
+                raise ValueError('Decompressed data exceeds the limit {}'.format(self.max_size))
+            self.raw_bytes += len(result)
+            self.compressed_bytes += len(data) - 1
+            return result
+        raise ValueError('Unknown compression flag {}'.format(flag))
+
+
+def load_dictionary(path: str) -> Optional[bytes]:
+    if len(path) == 0:
+        return None
+    if not os.path.isfile(path):
+        raise FileNotFoundError('Compression dictionary {} not found'.format(path))
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def get_dictionary_compression_name(dictionary: bytes) -> str:
+    """
+    Peers agree on a dictionary compression only when their dictionary contents are the same
+    """
+    return ZLIB_DICT_PREFIX + '{:08x}'.format(zlib.crc32(dictionary))
+
+
+def get_supported_compressions(dictionary: Optional[bytes]) -> List[str]:
+    """
+    In preference order
+    """
+    if dictionary is not None:
+        return [get_dictionary_compression_name(dictionary), ZLIB]
+    return [ZLIB]
+
+
+def create_compressor(name: str, dictionary: Optional[bytes], *, threshold: int, level: int, max_size: int) -> Optional[Compressor]:
+    """
+    :param name: the negotiated compression name, an empty str for no compression
+    :param dictionary: the local shared dictionary
+    """
+    if name == '':
+        return None
+    if name == ZLIB:
+        return Compressor(name, threshold=threshold, level=level, max_size=max_size)
+    if dictionary is not None and name == get_dictionary_compression_name(dictionary):
+        return Compressor(name, threshold=threshold, level=level, max_size=max_size, dictionary=dictionary)
+    raise ValueError('Unsupported compression {}'.format(name))
+
+
+def negotiate_compression(requested: List[str], supported: List[str]) -> str:
+    """
+    :return: the first compression requested that is also supported, or an empty str for no compression
+    """
+    for name in requested:
+        if name in supported:
+            return name
+    return ''
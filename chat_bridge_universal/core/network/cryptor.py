@@ -1,15 +1,43 @@
 import hashlib
+import hmac
+import os
 from binascii import b2a_hex, a2b_hex
+from typing import Dict, Type, List, Optional
 
-from Crypto.Cipher import AES
+AES = None  # the Crypto.Cipher.AES module, imported when the first cryptor is created so the cli starts faster
+strxor = None  # Crypto.Util.strxor.strxor, imported along with AES
 
 
-class AESCryptor:
-	def __init__(self, key: str, mode=AES.MODE_CBC):
+def _load_aes():
+	global AES, strxor
+	if AES is None:
+		from Crypto.Cipher import AES as aes_module
+		from Crypto.Util.strxor import strxor as strxor_function
+		AES, strxor = aes_module, strxor_function
+
+
+class AbstractCryptor:
+	name: str  # the cipher name used in login negotiation
+
+	def encrypt_bytes(self, data: bytes) -> bytes:
+		raise NotImplementedError()
+
+	def decrypt_bytes(self, byte_data: bytes) -> bytes:
+		raise NotImplementedError()
+
+
+class AESCryptor(AbstractCryptor):
+	"""
+	AES-CBC with a fixed IV and NUL paddings, hex encoded. The only cipher v1 peers know, and the fallback of negotiation
+	"""
+	name = 'aes_cbc'
+
+	def __init__(self, key: str, mode: Optional[int] = None):
+		_load_aes()
 		self.key: bytes = self.__to_16_length_bytes(key)
 		self.__key_empty = len(key) == 0
 		self.__hashed_key = hashlib.sha256(self.key).digest()  # a 32-length bytes
-		self.mode = mode
+		self.mode = mode if mode is not None else AES.MODE_CBC
 
 	def get_cryptor(self):
 		return AES.new(self.__hashed_key, self.mode, self.__hashed_key[:16])
@@ -20,11 +48,110 @@ class AESCryptor:
 		return text_bytes + (b'\0' * ((16 - (len(text_bytes) % 16)) % 16))
 
 	def encrypt(self, text: str) -> bytes:
-		if self.__key_empty:
-			return text.encode('utf8')
-		return b2a_hex(self.get_cryptor().encrypt(self.__to_16_length_bytes(text)))
+		return self.encrypt_bytes(text.encode('utf8'))
 
 	def decrypt(self, byte_data: bytes) -> str:
+		return self.decrypt_bytes(byte_data).decode('utf8').rstrip('\0')
+
+	def encrypt_bytes(self, data: bytes) -> bytes:
+		if self.__key_empty:
+			return data
+		return b2a_hex(self.get_cryptor().encrypt(data + (b'\0' * ((16 - (len(data) % 16)) % 16))))
+
+	def decrypt_bytes(self, byte_data: bytes) -> bytes:
+		"""
+		The NUL paddings are kept, so the content should be able to tell where it ends
+		"""
 		if self.__key_empty:
-			return byte_data.decode('utf8')
-		return self.get_cryptor().decrypt(a2b_hex(byte_data)).decode('utf8').rstrip('\0')
+			return byte_data
+		return self.get_cryptor().decrypt(a2b_hex(byte_data))
+
+
+def _xor(a: bytes, b: bytes) -> bytes:
+	# xor as python ints is quicker on short data, strxor is quicker on long data
+	if len(a) <= 1024:
+		return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+	return strxor(a, b)
+
+
+class AESCTRCryptor(AbstractCryptor):
+	"""
+	AES-CTR with a random nonce for every message, authenticated with a truncated HMAC-SHA256 of the nonce and the ciphertext
+
+	Output: 12 bytes nonce + raw ciphertext + 16 bytes tag, no padding and no hex encoding.
+	The AES key schedule and the HMAC state are prepared once, so a message costs a single ECB call on its counter blocks
+	and an HMAC, instead of a new cipher object for every message. The counter blocks are the standard CTR ones,
+	12 bytes nonce followed by a 4 bytes big-endian counter from 0
+	"""
+	name = 'aes_ctr_hmac'
+	NONCE_SIZE = 12
+	TAG_SIZE = 16
+	__counters = b''  # counter blocks 0, 1, 2... without the nonce, shared by all instances and grown to the longest message
+
+	def __init__(self, key: str):
+		_load_aes()
+		self.__key_empty = len(key) == 0
+		digest = hashlib.sha512(key.encode('utf8')).digest()
+		self.__ecb = AES.new(digest[:32], AES.MODE_ECB)
+		self.__mac = hmac.new(digest[32:], digestmod=hashlib.sha256)
+
+	@classmethod
+	def __get_counters(cls, size: int) -> bytes:
+		counters = AESCTRCryptor.__counters
+		if len(counters) < size:
+			count = max((size + 15) // 16, len(counters) // 8)  # doubled at least
+			counters = AESCTRCryptor.__counters = b''.join(i.to_bytes(16, 'big') for i in range(count))
+		return counters[:size]
+
+	def __apply_keystream(self, nonce: bytes, data: bytes) -> bytes:
+		blocks = (len(data) + 15) // 16
+		stream = self.__ecb.encrypt(_xor(self.__get_counters(blocks * 16), (nonce + b'\0\0\0\0') * blocks))
+		return _xor(data, stream[:len(data)])
+
+	def __get_tag(self, nonce: bytes, ciphertext: bytes) -> bytes:
+		mac = self.__mac.copy()
+		mac.update(nonce)
+		mac.update(ciphertext)
+		return mac.digest()[:self.TAG_SIZE]
+
+	def encrypt_bytes(self, data: bytes) -> bytes:
+		if self.__key_empty:
+			return data
+		nonce = os.urandom(self.NONCE_SIZE)
+		ciphertext = self.__apply_keystream(nonce, data)
+		return nonce + ciphertext + self.__get_tag(nonce, ciphertext)
+
+	def decrypt_bytes(self, byte_data: bytes) -> bytes:
+		"""
+		Raises ValueError if the data has been tampered with or the key doesn't match
+		"""
+		if self.__key_empty:
+			return byte_data
+		if len(byte_data) < self.NONCE_SIZE + self.TAG_SIZE:
+			raise ValueError('Encrypted data too short')
+		nonce, ciphertext, tag = bytes(byte_data[:self.NONCE_SIZE]), byte_data[self.NONCE_SIZE:-self.TAG_SIZE], bytes(byte_data[-self.TAG_SIZE:])
+		if not hmac.compare_digest(self.__get_tag(nonce, ciphertext), tag):
+			raise ValueError('MAC check failed')
+		return self.__apply_keystream(nonce, ciphertext)
+
+
+CIPHERS: Dict[str, Type[AbstractCryptor]] = {cls.name: cls for cls in (AESCTRCryptor, AESCryptor)}
+DEFAULT_CIPHERS = list(CIPHERS.keys())  # in preference order, aes_cbc is kept as the fallback for v1 peers
+
+
+def create_cryptor(cipher: str, key: str) -> AbstractCryptor:
+	cryptor_class = CIPHERS.get(cipher)
+	if cryptor_class is None:
+		raise ValueError('Unsupported cipher {}'.format(cipher))
+	return cryptor_class(key)
+
+
+def negotiate_cipher(requested: List[str], supported: List[str]) -> str:
+	"""
+	The first cipher requested by the client that is also supported by the server.
+	Falls back to aes_cbc, which every peer speaks
+	"""
+	for cipher in requested:
+		if cipher in supported and cipher in CIPHERS:
+			return cipher
+	return AESCryptor.name
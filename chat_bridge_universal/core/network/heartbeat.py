@@ -0,0 +1,59 @@
+import socket
+import time
+from typing import Optional
+
+from chat_bridge_universal.core.network.protocal import PingPacket, PongPacket
+
+
+class HeartbeatTimeout(socket.error):
+    pass
+
+
+class Heartbeat:
+    """
+    Liveness and round trip time of a connection
+
+    A ping is sent every interval and the peer answers it with a pong carrying the same timestamp.
+    Any frame received counts as a sign of life, the peer is dead after max_missed intervals without one
+    """
+    def __init__(self, interval: float, max_missed: int):
+        self.interval = interval
+        self.max_missed = max(1, max_missed)
+        self.rtt: Optional[float] = None  # in seconds, None before the first pong
+        now = time.monotonic()
+        self.__last_received = now
+        self.__last_ping = now
+
+    @property
+    def poll_interval(self) -> float:
+        """
+        How often the receiving side should wake up to check the heartbeat
+        """
+        return self.interval / 2
+
+    def on_received(self):
+        self.__last_received = time.monotonic()
+
+    def on_pong(self, pong: PongPacket):
+        self.rtt = time.monotonic() - pong.timestamp
+
+    def is_dead(self) -> bool:
+        return time.monotonic() - self.__last_received > self.interval * self.max_missed
+
+    def check_dead(self):
+        if self.is_dead():
+            raise HeartbeatTimeout('No data received in {} heartbeat intervals'.format(self.max_missed))
+
+    def poll_ping(self) -> Optional[PingPacket]:
+        """
+        :return: the ping to send if it's time for one
+        """
+        now = time.monotonic()
+        if now - self.__last_ping >= self.interval:
+            self.__last_ping = now
+            return PingPacket(timestamp=now)
+        return None
+
+
+def create_heartbeat(interval: float, max_missed: int) -> Optional[Heartbeat]:
+    return Heartbeat(interval, max_missed) if interval > 0 else None
@@ -1,40 +1,207 @@
-import json
 import socket
 import struct
-from typing import Type, TypeVar
+import time
+from typing import Type, TypeVar, Optional, TYPE_CHECKING
 
-from chat_bridge_universal.core.network.cryptor import AESCryptor
+from chat_bridge_universal.core.metrics import REGISTRY
+from chat_bridge_universal.core.network.codec import AbstractCodec, JSON_CODEC
+from chat_bridge_universal.core.network.compressor import Compressor
+from chat_bridge_universal.core.network.cryptor import AbstractCryptor
 from chat_bridge_universal.core.network.protocal import AbstractPacket
 
+if TYPE_CHECKING:
+    import asyncio
+
 T = TypeVar('T', bound=AbstractPacket)
 
-RECEIVE_BUFFER_SIZE = 1024
+RECEIVE_BUFFER_SIZE = 64 * 1024
+RECEIVE_TIMEOUT = 15
+DEFAULT_MAX_FRAME_SIZE = 4 * 1024 * 1024
+HEADER = JSON_CODEC.header  # the header of frames before the protocol version is negotiated
+
+ENCRYPT_TIME = REGISTRY.histogram('cbu_encrypt_seconds', 'Time to encrypt a frame')
+DECRYPT_TIME = REGISTRY.histogram('cbu_decrypt_seconds', 'Time to decrypt a frame')
 
 
 class EmptyContent(socket.error):
     pass
 
 
-def send_packet(sock: socket.socket, cryptor: AESCryptor, packet: AbstractPacket):
-    encrypted_data = cryptor.encrypt(json.dumps(packet.serialize(), ensure_ascii=False))
-    packet_data = struct.pack('I', len(encrypted_data)) + encrypted_data
-    sock.sendall(packet_data)
+class FrameTooLarge(socket.error):
+    pass
+
+
+def check_frame_size(length: int, max_frame_size: int):
+    if length > max_frame_size:
+        raise FrameTooLarge('Frame length {} exceeds the limit {}'.format(length, max_frame_size))
+
+
+class FrameReader:
+    """
+    Read length-prefixed frames from a socket into a reusable buffer
+
+    Data is received with recv_into directly into the buffer, so a large frame costs no repeated concatenation,
+    and a single recv may yield several frames. A socket should have only one reader for its whole lifetime,
+    since the reader may have buffered the beginning of the next frame
+    The buffer grows for a frame larger than it, and shrinks back to buffer_size once the frame is read
+    """
+    def __init__(self, sock: socket.socket, *, timeout: Optional[float] = RECEIVE_TIMEOUT,
+                 max_frame_size: int = DEFAULT_MAX_FRAME_SIZE, buffer_size: int = RECEIVE_BUFFER_SIZE):
+        self.__sock = sock
+        self.__sock.settimeout(timeout)
+        self.max_frame_size = max_frame_size
+        self.header: struct.Struct = HEADER  # switched to the header of the negotiated codec after login
+        self.__buffer_size = buffer_size
+        self.__buffer = bytearray(buffer_size)
+        self.__start = 0  # start of the data not consumed yet
+        self.__end = 0  # end of the data received
+
+    def read_frame(self, deadline: Optional[float] = None) -> bytes:
+        """
+        Block until a whole frame is available and return its body
+        A socket.timeout can be raised, after which reading can be continued without losing data
+        :param deadline: a time.monotonic() time to raise socket.timeout at, however slowly the data trickles in.
+        The timeout of the socket is changed to the time left then, it's up to the caller to restore it
+        """
+        while True:
+            header = self.header
+            available = self.__end - self.__start
+            if available >= header.size:
+                length = header.unpack_from(self.__buffer, self.__start)[0]
+                check_frame_size(length, self.max_frame_size)
+                frame_end = self.__start + header.size + length
+                if frame_end <= self.__end:
+                    with memoryview(self.__buffer) as view:
+                        frame = bytes(view[self.__start + header.size:frame_end])
+                    self.__start = frame_end
+                    if self.__start == self.__end:
+                        self.__start = self.__end = 0
+                    if len(self.__buffer) > self.__buffer_size:
+                        self.__shrink()
+                    return frame
+                self.__reserve(header.size + length)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('Deadline exceeded')
+                self.__sock.settimeout(remaining)
+            self.__fill()
+
+    def __reserve(self, frame_size: int):
+        """
+        Make sure the current frame fits into the buffer
+        """
+        if self.__start + frame_size <= len(self.__buffer):
+            return
+        if self.__start > 0:
+            self.__buffer[:self.__end - self.__start] = self.__buffer[self.__start:self.__end]
+            self.__end -= self.__start
+            self.__start = 0
+        if frame_size > len(self.__buffer):
+            self.__buffer.extend(bytes(frame_size - len(self.__buffer)))
+
+    def __shrink(self):
+        """
+        Go back to a buffer of buffer_size after a large frame, if the data left fits in it
+        """
+        available = self.__end - self.__start
+        if available > self.__buffer_size:
+            return
+        buffer = bytearray(self.__buffer_size)
+        buffer[:available] = self.__buffer[self.__start:self.__end]
+        self.__buffer, self.__start, self.__end = buffer, 0, available
+
+    def __fill(self):
+        if self.__end == len(self.__buffer):
+            # moves the data left to the front, the buffer grows only if it's full of it
+            self.__reserve(self.__end - self.__start + 1)
+        with memoryview(self.__buffer) as view:
+            received = self.__sock.recv_into(view[self.__end:])
+        if received == 0:
+            raise EmptyContent('Empty content received')
+        self.__end += received
+
 
+def encode_packet(cryptor: AbstractCryptor, packet: AbstractPacket, codec: AbstractCodec = JSON_CODEC,
+                  compressor: Optional[Compressor] = None) -> bytes:
+    """
+    Serialize, compress, encrypt and frame the packet into the bytes to be written to the socket
+    """
+    return encode_data(cryptor, codec.encode(packet), codec, compressor)
 
-def receive_packet(sock: socket.socket, cryptor: AESCryptor, packet_type: Type[T], *, timeout: float = 15) -> T:
+
+def encode_data(cryptor: AbstractCryptor, data: bytes, codec: AbstractCodec = JSON_CODEC, compressor: Optional[Compressor] = None) -> bytes:
+    """
+    Compress, encrypt and frame a packet encoded by the codec already
+    """
+    if compressor is not None:
+        data = compressor.compress(data)
+    start = time.perf_counter()
+    encrypted_data = cryptor.encrypt_bytes(data)
+    ENCRYPT_TIME.observe(time.perf_counter() - start)
+    return codec.header.pack(len(encrypted_data)) + encrypted_data
+
+
+def decode_packet(cryptor: AbstractCryptor, encrypted_data: bytes, packet_type: Type[T], codec: AbstractCodec = JSON_CODEC,
+                  compressor: Optional[Compressor] = None) -> T:
+    """
+    Decrypt, decompress and deserialize the frame body, i.e. the bytes after the length header
+    """
+    start = time.perf_counter()
+    data = cryptor.decrypt_bytes(encrypted_data)
+    DECRYPT_TIME.observe(time.perf_counter() - start)
+    if compressor is not None:
+        data = compressor.decompress(data)
+    return codec.decode(data, packet_type)
+
+
+def send_packet(sock: socket.socket, cryptor: AbstractCryptor, packet: AbstractPacket, codec: AbstractCodec = JSON_CODEC,
+                compressor: Optional[Compressor] = None):
+    sock.sendall(encode_packet(cryptor, packet, codec, compressor))
+
+
+def receive_packet(sock: socket.socket, cryptor: AbstractCryptor, packet_type: Type[T], *, timeout: float = RECEIVE_TIMEOUT,
+                   max_frame_size: int = DEFAULT_MAX_FRAME_SIZE, codec: AbstractCodec = JSON_CODEC) -> T:
+    """
+    Receive exactly one packet without reading ahead
+    For a long-living connection use a FrameReader instead
+    """
     sock.settimeout(timeout)
-    header = sock.recv(4)
-    if len(header) < 4:
-        raise EmptyContent('Empty content received')
-    remaining_data_length = struct.unpack('I', header)[0]
-    encrypted_data = bytes()
-    while remaining_data_length > 0:
-        buf = sock.recv(min(remaining_data_length, RECEIVE_BUFFER_SIZE))
-        encrypted_data += buf
-        remaining_data_length -= len(buf)
-    data_str = cryptor.decrypt(encrypted_data)
+    header = _receive_exactly(sock, codec.header.size)
+    length = codec.header.unpack(header)[0]
+    check_frame_size(length, max_frame_size)
+    return decode_packet(cryptor, bytes(_receive_exactly(sock, length)), packet_type, codec)
+
+
+def _receive_exactly(sock: socket.socket, length: int) -> bytearray:
+    buffer = bytearray(length)
+    with memoryview(buffer) as view:
+        received = 0
+        while received < length:
+            n = sock.recv_into(view[received:])
+            if n == 0:
+                raise EmptyContent('Empty content received')
+            received += n
+    return buffer
+
+
+async def read_frame_async(reader: 'asyncio.StreamReader', header: struct.Struct, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE) -> bytes:
+    """
+    Read the body of a frame. Raises EmptyContent if the stream ends before a whole frame is read
+    """
     try:
-        packet = packet_type.deserialize(json.loads(data_str))
-        return packet
-    except TypeError:
-        raise
+        length = header.unpack(await reader.readexactly(header.size))[0]
+        check_frame_size(length, max_frame_size)
+        return await reader.readexactly(length)
+    except EOFError:  # asyncio.IncompleteReadError, asyncio is imported by the asyncio engine only
+        raise EmptyContent('Empty content received') from None
+
+
+async def receive_packet_async(reader: 'asyncio.StreamReader', cryptor: AbstractCryptor, packet_type: Type[T], *,
+                               max_frame_size: int = DEFAULT_MAX_FRAME_SIZE, codec: AbstractCodec = JSON_CODEC,
+                               compressor: Optional[Compressor] = None) -> T:
+    """
+    The asyncio version of receive_packet
+    """
+    encrypted_data = await read_frame_async(reader, codec.header, max_frame_size)
+    return decode_packet(cryptor, encrypted_data, packet_type, codec, compressor)
@@ -0,0 +1,156 @@
+import collections
+from enum import Enum, unique
+from threading import Condition
+from typing import Optional, Deque, List
+
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+
+@unique
+class OverflowPolicy(Enum):
+    drop_oldest = 'drop_oldest'  # discard the oldest queued frame to make room for the new one
+    drop_newest = 'drop_newest'  # discard the frame being queued
+    disconnect = 'disconnect'  # the peer is too slow, drop the connection
+
+
+class OutboundBuffer:
+    """
+    A bounded buffer of framed bytes waiting to be sent to a peer, applying the overflow policy when it's full,
+    i.e. a new frame would take it over max_size frames or max_bytes bytes. Something larger than the limits
+    is still taken into an empty buffer
+    Streams, i.e. the chunks of a large packet, are queued and dropped as a whole, since the peer discards
+    a stream missing a chunk. They are sent only when no other frame is waiting, and they are the oldest
+    to drop when it's full, except the one being sent. A stream is never queued by dropping other frames
+    Not thread safe
+    """
+    def __init__(self, max_size: int, policy: OverflowPolicy, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_size = max(1, max_size)
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.dropped = 0
+        self.size_bytes = 0
+        self._buffer: Deque[bytes] = collections.deque()
+        self._streams: Deque[Deque[bytes]] = collections.deque()
+        self.__stream_frames = 0
+        self.__sending_stream = False  # the first stream has been partly sent
+
+    def offer(self, data: bytes) -> bool:
+        """
+        :return: False if the peer should be disconnected according to the overflow policy
+        """
+        if not self.__make_room(1, len(data), False):
+            return self.policy != OverflowPolicy.disconnect
+        self._buffer.append(data)
+        self.size_bytes += len(data)
+        return True
+
+    def offer_stream(self, frames: List[bytes]) -> bool:
+        """
+        Queue all the chunk frames of a large packet, or none of them
+        :return: False if the peer should be disconnected according to the overflow policy
+        """
+        size = sum(map(len, frames))
+        if not self.__make_room(len(frames), size, True):
+            return self.policy != OverflowPolicy.disconnect
+        self._streams.append(collections.deque(frames))
+        self.__stream_frames += len(frames)
+        self.size_bytes += size
+        return True
+
+    def __make_room(self, count: int, size: int, stream: bool) -> bool:
+        """
+        :return: whether the frames can be queued, the ones not queued are counted as dropped
+        """
+        while len(self) > 0 and (len(self) + count > self.max_size or self.size_bytes + size > self.max_bytes):
+            if self.policy == OverflowPolicy.disconnect:
+                return False
+            if self.policy == OverflowPolicy.drop_oldest:
+                # the stream being sent is kept, dropping the rest of it would waste what was sent
+                if len(self._streams) > (1 if self.__sending_stream else 0):
+                    self.__drop_stream(1 if self.__sending_stream else 0)
+                    continue
+                if not stream and len(self._buffer) > 0:
+                    self.size_bytes -= len(self._buffer.popleft())
+                    self.dropped += 1
+                    continue
+                if not stream:
+                    break  # only the stream being sent is left, which is not kept waiting for
+            self.dropped += count
+            return False
+        return True
+
+    def __drop_stream(self, index: int):
+        frames = self._streams[index]
+        del self._streams[index]
+        self.__stream_frames -= len(frames)
+        self.size_bytes -= sum(map(len, frames))
+        self.dropped += len(frames)
+
+    def poll(self) -> Optional[bytes]:
+        if len(self._buffer) > 0:
+            data = self._buffer.popleft()
+        elif len(self._streams) > 0:
+            frames = self._streams[0]
+            data = frames.popleft()
+            self.__stream_frames -= 1
+            self.__sending_stream = len(frames) > 0
+            if not self.__sending_stream:
+                self._streams.popleft()
+        else:
+            return None
+        self.size_bytes -= len(data)
+        return data
+
+    def clear(self):
+        self._buffer.clear()
+        self._streams.clear()
+        self.__stream_frames = 0
+        self.__sending_stream = False
+        self.size_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._buffer) + self.__stream_frames
+
+
+class OutboundQueue(OutboundBuffer):
+    """
+    The thread safe version of OutboundBuffer, with a blocking get for the writer thread
+    """
+    def __init__(self, max_size: int, policy: OverflowPolicy, max_bytes: int = DEFAULT_MAX_BYTES):
+        super().__init__(max_size, policy, max_bytes)
+        self.__condition = Condition()
+        self.__closed = False
+
+    def offer(self, data: bytes) -> bool:
+        with self.__condition:
+            if self.__closed:
+                return True
+            result = super().offer(data)
+            self.__condition.notify()
+            return result
+
+    def offer_stream(self, frames: List[bytes]) -> bool:
+        with self.__condition:
+            if self.__closed:
+                return True
+            result = super().offer_stream(frames)
+            self.__condition.notify()
+            return result
+
+    def get(self) -> Optional[bytes]:
+        """
+        Block until there's data to send
+        :return: None if the queue is closed
+        """
+        with self.__condition:
+            while len(self) == 0 and not self.__closed:
+                self.__condition.wait()
+            if self.__closed:
+                return None
+            return self.poll()
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.clear()
+            self.__condition.notify_all()
@@ -1,9 +1,9 @@
 from typing import List
 
-from mcdreforged.utils.serializer import Serializable
+from chat_bridge_universal.utils.serializer import SlottedSerializable
 
 
-class AbstractPayload(Serializable):
+class AbstractPayload(SlottedSerializable):
     pass
 
 
@@ -19,18 +19,31 @@ class ChatPayload(AbstractPayload):
             return self.message
 
 
-class AbstractPacket(Serializable):
+class AbstractPacket(SlottedSerializable):
     pass
 
 
 class LoginPacket(AbstractPacket):
     name: str
     password: str
+    protocol_version: int = 1  # the highest protocol version the client supports, absent for v1 clients
+    ciphers: List[str] = ['aes_cbc']  # ciphers the client supports in preference order
+    compressions: List[str] = []  # frame compressions the client supports in preference order
+    channels: List[str] = []  # channels to join after login
+    last_sequence: int = 0  # of the latest chat received before reconnecting, to get the ones missed since then. 0 for none
+    ticket: str = ''  # a resumption ticket from the last login, accepted instead of the password while it's valid
+    chunking: bool = False  # whether the client takes packets in chunks
 
 
 class LoginResultPacket(AbstractPacket):
     success: bool
     message: str
+    protocol_version: int = 1  # the protocol version used after login, absent for v1 servers
+    cipher: str = 'aes_cbc'  # the cipher used after login
+    compression: str = ''  # the frame compression used after login, empty for none
+    ticket: str = ''  # a resumption ticket for the next login, empty if the server gives none
+    ticket_lifetime: float = 0  # seconds the ticket is valid
+    chunking: bool = False  # whether both sides take packets in chunks
 
 
 class ChatPacket(AbstractPacket):
@@ -38,4 +51,57 @@ class ChatPacket(AbstractPacket):
     receivers: List[str]
     payload: ChatPayload
     broadcast: bool
+    channel: str = ''  # if not empty, the packet goes to the members of the channel instead
+    # servers of a federation the packet has passed, starting from the one it entered the federation,
+    # and the id given there, so every server takes it once
+    path: List[str] = []
+    origin_id: int = 0
+    sequence: int = 0  # given by the server routing the packet, growing with every chat it routes
 
+
+class BatchPacket(AbstractPacket):
+    """
+    Several chat packets in a single frame. Protocol v2 only
+    """
+    packets: List[ChatPacket]
+
+
+class ChannelPacket(AbstractPacket):
+    """
+    Join or leave channels at runtime. Protocol v2 only
+    """
+    join: List[str] = []
+    leave: List[str] = []
+
+
+class PingPacket(AbstractPacket):
+    """
+    Protocol v2 only
+    """
+    timestamp: float  # monotonic time of the sender, echoed back in the pong
+
+
+class PongPacket(AbstractPacket):
+    """
+    Protocol v2 only
+    """
+    timestamp: float  # the timestamp of the ping answered
+
+
+class TicketPacket(AbstractPacket):
+    """
+    A client asks for a new resumption ticket with an empty one, and the server answers with it. Protocol v2 only
+    """
+    ticket: str = ''
+    lifetime: float = 0
+
+
+class ChunkPacket(AbstractPacket):
+    """
+    A piece of the encoded form of a large packet, so it's sent in frames of bounded size,
+    between which other frames can be sent. Protocol v2 only, if both sides agreed on chunking during login
+    """
+    stream_id: int  # the same for every chunk of a packet, unique for the sender
+    index: int  # chunks of a packet are sent in order, starting from 0
+    total_size: int  # of the encoded packet
+    data: bytes
@@ -0,0 +1,142 @@
+"""
+Large packets in chunks: the encoded packet is split into ChunkPackets of chunk_size bytes, each sent in a frame of its own,
+so frames stay small, other frames can be sent between the chunks, and the receiver buffers a packet piece by piece
+within the memory limits of the connection instead of taking a frame of any size
+"""
+import collections
+import itertools
+from typing import List, Optional, Dict, Type
+
+from chat_bridge_universal.core.metrics import REGISTRY
+from chat_bridge_universal.core.network import network_utils
+from chat_bridge_universal.core.network.codec import AbstractCodec, PROTOCOL_VERSION_BINARY
+from chat_bridge_universal.core.network.compressor import Compressor
+from chat_bridge_universal.core.network.cryptor import AbstractCryptor
+from chat_bridge_universal.core.network.protocal import AbstractPacket, ChunkPacket
+from chat_bridge_universal.utils.logger import CBULogger
+
+MAX_DROPPED_STREAMS = 1024
+_STREAM_IDS = itertools.count(1)
+
+
+def encode_frames(cryptor: AbstractCryptor, packet: AbstractPacket, codec: AbstractCodec, compressor: Optional[Compressor] = None,
+                  chunk_size: int = 0) -> List[bytes]:
+    """
+    Encode the packet into the frames to be written to the socket, a single one unless it's larger than chunk_size
+    :param chunk_size: 0 to never split the packet, which should be the case unless the peer agreed on chunking
+    """
+    data = codec.encode(packet)
+    if chunk_size <= 0 or len(data) <= chunk_size or codec.version < PROTOCOL_VERSION_BINARY:
+        return [network_utils.encode_data(cryptor, data, codec, compressor)]
+    stream_id = next(_STREAM_IDS)
+    with memoryview(data) as view:
+        return [
+            network_utils.encode_packet(cryptor, ChunkPacket(
+                stream_id=stream_id, index=index, total_size=len(data), data=bytes(view[start:start + chunk_size])
+            ), codec, compressor)
+            for index, start in enumerate(range(0, len(data), chunk_size))
+        ]
+
+
+class _Stream:
+    __slots__ = ('next_index', 'total_size', 'buffer')
+
+    def __init__(self, total_size: int):
+        self.next_index = 0
+        self.total_size = total_size
+        self.buffer = bytearray()
+
+
+class StreamAssembler:
+    """
+    Joins the chunks received from a connection back into packets
+
+    Every packet being received takes its announced size from max_memory when its first chunk arrives.
+    A packet larger than max_stream_size is dropped, and the oldest unfinished packets are dropped to make room
+    for a new one. A packet missing a chunk is dropped too, e.g. when the sender dropped it from a full queue.
+    The later chunks of a dropped packet are ignored
+    Not thread safe, it's used by the thread reading from the connection only
+    """
+    def __init__(self, max_stream_size: int, max_memory: int, logger: Optional[CBULogger] = None, labels: Optional[Dict[str, str]] = None):
+        self.max_stream_size = max_stream_size
+        self.max_memory = max_memory
+        self.logger = logger
+        self.labels = labels or {}
+        self.__streams: 'collections.OrderedDict[int, _Stream]' = collections.OrderedDict()
+        self.__dropped: 'collections.OrderedDict[int, None]' = collections.OrderedDict()
+        self.__reserved = 0
+        self.__completed = REGISTRY.counter('cbu_streams_completed_total', 'Packets received in chunks', self.labels)
+        REGISTRY.gauge('cbu_stream_reserved_bytes', 'Memory reserved for the packets being received in chunks', self.labels, self.get_reserved_size)
+
+    def get_reserved_size(self) -> int:
+        return self.__reserved
+
+    def reset(self):
+        """
+        Forget the unfinished packets, when the connection is lost
+        """
+        self.__streams.clear()
+        self.__dropped.clear()
+        self.__reserved = 0
+
+    def assemble(self, packet: AbstractPacket, codec: AbstractCodec, packet_type: Type[AbstractPacket]) -> Optional[AbstractPacket]:
+        """
+        :return: the packet itself if it's not a chunk, the packet joined if it's the last chunk of one, otherwise None
+        """
+        if not isinstance(packet, ChunkPacket):
+            return packet
+        data = self.feed(packet)
+        if data is None:
+            return None
+        result = codec.decode(data, packet_type)
+        if isinstance(result, ChunkPacket):
+            raise ValueError('Chunk packet {} is made of chunks'.format(packet.stream_id))
+        return result
+
+    def feed(self, chunk: ChunkPacket) -> Optional[bytes]:
+        """
+        :return: the encoded packet if the chunk is the last one of it, otherwise None
+        """
+        stream_id = chunk.stream_id
+        stream = self.__streams.get(stream_id)
+        if stream is None:
+            if chunk.index != 0:
+                if stream_id not in self.__dropped:  # sent before this connection was established
+                    self.__drop(stream_id, 'incomplete')
+                return None
+            self.__dropped.pop(stream_id, None)
+            if not 0 < chunk.total_size <= self.max_stream_size:
+                self.__drop(stream_id, 'too_large')
+                return None
+            while self.__reserved + chunk.total_size > self.max_memory and len(self.__streams) > 0:
+                self.__drop(next(iter(self.__streams)), 'memory')
+            if self.__reserved + chunk.total_size > self.max_memory:
+                self.__drop(stream_id, 'memory')
+                return None
+            stream = self.__streams[stream_id] = _Stream(chunk.total_size)
+            self.__reserved += chunk.total_size
+        elif chunk.index != stream.next_index:
+            self.__drop(stream_id, 'incomplete')
+            return None
+        if len(stream.buffer) + len(chunk.data) > stream.total_size:
+            self.__drop(stream_id, 'malformed')
+            return None
+        stream.buffer += chunk.data
+        stream.next_index += 1
+        if len(stream.buffer) < stream.total_size:
+            return None
+        del self.__streams[stream_id]
+        self.__reserved -= stream.total_size
+        self.__completed.inc()
+        return bytes(stream.buffer)
+
+    def __drop(self, stream_id: int, reason: str):
+        stream = self.__streams.pop(stream_id, None)
+        if stream is not None:
+            self.__reserved -= stream.total_size
+        self.__dropped[stream_id] = None
+        if len(self.__dropped) > MAX_DROPPED_STREAMS:
+            self.__dropped.popitem(last=False)
+        if self.logger is not None:
+            self.logger.warning('Dropped packet {} received in chunks: {}'.format(stream_id, reason))
+        REGISTRY.counter('cbu_streams_dropped_total', 'Packets received in chunks dropped by reason', {**self.labels, 'reason': reason}).inc()
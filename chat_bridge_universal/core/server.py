@@ -1,23 +1,85 @@
+import collections
+import logging
 import socket
+import time
 from enum import unique, auto
-from threading import Thread
-from typing import cast, Dict, List
+from threading import Lock
+from typing import cast, Dict, List, Optional, Tuple, Iterable, Set, Callable, Deque, NamedTuple, TYPE_CHECKING
 
+from chat_bridge_universal.core import auth
 from chat_bridge_universal.core.basic import CBUBase, Address
 from chat_bridge_universal.core.client import CBUClient, CBUClientConfig
-from chat_bridge_universal.core.config import CBUConfigBase, load_config, ClientMeta
-from chat_bridge_universal.core.network import network_utils
-from chat_bridge_universal.core.network.protocal import LoginPacket, LoginResultPacket, ChatPacket
+from chat_bridge_universal.core.config import CBUConfigBase, load_config, ClientMeta, PeerMeta
+from chat_bridge_universal.core.federation import PeerLink, SeenCache
+from chat_bridge_universal.core.history import History, HistoryLog
+from chat_bridge_universal.core.ingress import IngressLimiter, RateLimitPolicy
+from chat_bridge_universal.core.metrics import REGISTRY, start_http_server
+from chat_bridge_universal.core.network import network_utils, codec, cryptor, compressor, streaming
+from chat_bridge_universal.core.network.admission import AcceptRateLimiter, HandshakePool, MAX_LOGIN_FRAME_SIZE
+from chat_bridge_universal.core.network.codec import PROTOCOL_VERSION_BINARY
+from chat_bridge_universal.core.network.compressor import Compressor
+from chat_bridge_universal.core.network.outbound import OverflowPolicy, OutboundQueue
+from chat_bridge_universal.core.network.protocal import LoginPacket, LoginResultPacket, ChatPacket, AbstractPacket, \
+    BatchPacket, ChannelPacket, TicketPacket
 from chat_bridge_universal.core.state import CBUStateBase
+from chat_bridge_universal.utils.logger import CBULogger, Lazy, LOG_CATEGORY_CHAT
+
+if TYPE_CHECKING:
+    from chat_bridge_universal.core.cluster import RelayClient
 
 
 class CBUServerConfig(CBUConfigBase):
+    name: str = 'MyServerName'  # unique in a federation, used to log in to the peers
     hostname: str = 'localhost'
     port: int = 30001
 
     clients: List[ClientMeta] = [
         ClientMeta(name='MyClientName', password='MyClientPassword')
     ]
+    # servers to link to, see core/federation.py. Client names should be unique in the whole federation
+    peers: List[PeerMeta] = []
+
+    # max amount and total size of frames waiting to be sent to a single client, and what to do when it's full
+    outbound_queue_size: int = 1024
+    outbound_queue_bytes: int = 8 * 1024 * 1024
+    outbound_overflow_policy: OverflowPolicy = OverflowPolicy.drop_oldest
+
+    # serve metrics in the Prometheus text format at http://<metrics_hostname>:<metrics_port>/metrics, 0 port to disable
+    # with several workers, worker #i serves its own metrics at metrics_port + i
+    metrics_hostname: str = '127.0.0.1'
+    metrics_port: int = 0
+
+    # admission of new connections, so clients reconnecting all at once or sockets that never log in can't exhaust the server
+    listen_backlog: int = 128  # connections waiting for the server to accept them
+    login_timeout: float = 5  # seconds from accepting a connection to receiving its login packet
+    handshake_workers: int = 8  # threads receiving login packets, for the thread engine
+    # connections accepted but not logged in yet, more are closed at once. The thread engine can have handshake_workers more
+    max_pending_handshakes: int = 256
+    accept_rate_per_host: float = 0  # new connections per second from a single remote host, 0 for no limit
+    accept_burst_per_host: int = 20
+    # seconds a resumption ticket is valid, which a client presents instead of its password when reconnecting, 0 to disable
+    # online clients get a new one before it expires, so they can skip the password check when the server restarts
+    ticket_lifetime: float = 600
+
+    # chats over the chat_rate of a client are dropped, or delayed up to chat_max_delay seconds before the rest are dropped
+    chat_overflow_policy: RateLimitPolicy = RateLimitPolicy.drop
+    chat_max_delay: float = 1
+    # seconds a chat identical to one the client sent before is dropped, 0 to disable
+    duplicate_window: float = 0
+    duplicate_cache_size: int = 1024  # chats remembered for each client
+
+    # recent chats kept for clients catching up after reconnecting, 0 to disable. Several workers always run without it
+    history_size: int = 1024
+    history_replay_limit: int = 1000  # max chats sent to a client catching up, the latest ones are sent
+    # a directory to log every routed chat in, so clients can catch up with chats older than the ones kept in memory
+    # the log is split into segments of history_segment_size bytes, and only the latest history_segment_count ones are kept
+    history_log_dir: str = ''
+    history_segment_size: int = 16 * 1024 * 1024
+    history_segment_count: int = 8
+
+    # worker processes serving the port together, each with its own connections, see core/cluster.py
+    # more than 1 needs SO_REUSEPORT, which is available on linux and bsd, and no federation. The history is turned off
+    workers: int = 1
 
     @property
     def address(self) -> Address:
@@ -32,44 +94,230 @@ class CBUServerState(CBUStateBase):
     STOPPING = auto()
 
 
+class LoggedHistory(NamedTuple):
+    """
+    The chats for a client catching up read from the history log, those after the sequence after till the sequence until
+    """
+    after: int
+    until: int
+    packets: List[ChatPacket]
+
+
 class CBUServer(CBUBase):
-    def __init__(self, config_path: str):
+    def __init__(self, config_path: str, *, history: bool = True):
+        """
+        :param history: False to keep the history off whatever the config says, like cluster workers do
+        """
         super().__init__(load_config(config_path, CBUServerConfig))
         self.config: CBUServerConfig = cast(CBUServerConfig, self.config)
+        if not history:
+            self.config.history_size = 0
+            self.config.history_log_dir = ''
         self._state = CBUServerState.STOPPED
         self.__should_loop_console = True
-        self.__connections: Dict[str, ClientConnection] = {}
+        self.apply_log_config()
+        self._connections: Dict[str, ClientConnection] = {}
+        self.__fanout_compressors: Dict[str, Optional[Compressor]] = {}
+        self.__metrics_server = None
+        self.__last_stats: Optional[Tuple[float, float]] = None  # time, routed chat count
+        self.__relay: Optional['RelayClient'] = None
+        self._reuse_port = False  # set in cluster workers, which bind the same port
+        self._accept_limiter = AcceptRateLimiter(self.config.accept_rate_per_host, self.config.accept_burst_per_host)
+        self.__handshakes: Optional[HandshakePool] = None
+        REGISTRY.gauge('cbu_pending_handshakes', 'Connections accepted but not logged in yet', function=self._get_pending_handshake_count)
+        self.__chats_routed = REGISTRY.counter('cbu_chats_routed_total', 'Chats received and routed by the server')
+        self.__deliveries = REGISTRY.counter('cbu_deliveries_total', 'Chats sent to recipients by the server')
+        REGISTRY.gauge('cbu_log_dropped', 'Logs dropped because the async log queue is full', function=CBULogger.get_async_dropped_count)
+        REGISTRY.gauge('cbu_online_clients', 'Amount of online clients', function=lambda: len(self.__online))
+        # routing index, replaced instead of modified so routing threads can read it without locking
+        self.__routing_lock = Lock()
+        self.__online: Dict[str, ClientConnection] = {}
+        self.__channel_members: Dict[str, Dict[str, ClientConnection]] = {}
+        self.__memberships: Dict[str, Set[str]] = {}  # client name -> channels
+        self.__peers: Dict[str, ClientConnection] = {}  # online peers logged in to this server
+        # connections gone online through _update_routing, the only ones indexed, so none is routed to before catching up
+        self.__routable: Dict[str, ClientConnection] = {}
+        # sequences are given, chats are kept and their recipients are decided with the history lock held,
+        # so a client catching up gets every chat either from the history or routed, exactly once
+        self.__history_lock = Lock()
+        self.__history = History(self.config.history_size, HistoryLog(
+            self.config.history_log_dir, self.config.history_segment_size, self.config.history_segment_count, self.logger
+        ) if self.config.history_log_dir != '' else None)
+        self.__resume_sequences: Dict[str, int] = {}  # client name -> the last sequence in its login packet
+        self.__replayed = REGISTRY.counter('cbu_history_replayed_total', 'Chats sent from the history to clients catching up')
+        self.__ingress: Dict[str, IngressLimiter] = {}  # client name -> limits of the chats from it, for clients having some
         for client in self.config.clients:
-            self.__connections[client.name] = ClientConnection(self, client)
+            self._connections[client.name] = self._create_connection(client)
+            limiter = IngressLimiter(
+                client.chat_rate, client.chat_burst, self.config.chat_overflow_policy, self.config.chat_max_delay,
+                self.config.duplicate_window, self.config.duplicate_cache_size
+            )
+            if limiter.is_enabled():
+                self.__ingress[client.name] = limiter
+        # federation
+        self.__links: List[PeerLink] = [PeerLink(self, peer) for peer in self.config.peers]
+        self.__federated = len(self.__links) > 0 or any(client.peer for client in self.config.clients)
+        self.__seen = SeenCache()
+        self.__origin_id = time.time_ns()  # keeps growing after restarts, so peers don't take new chats as seen ones
+        self.__origin_id_lock = Lock()
+
+    def _create_connection(self, meta: ClientMeta) -> 'ClientConnection':
+        return ClientConnection(self, meta)
 
     def _get_logger_name(self):
         return 'Server'
 
+    def set_relay(self, relay: 'RelayClient'):
+        """
+        Exchange routed chats and online clients with the other workers of a cluster through the relay
+        """
+        self.__relay = relay
+
+    def _run_in_loop(self, function: Callable, *args):
+        """
+        Run the function where the connections can be used. Any thread is fine for the thread engine
+        """
+        function(*args)
+
     def _get_main_loop_thread_name(self):
         return 'ServerThread'
 
-    def __handle_connection(self, conn: socket.socket, address: Address):
-        # receive login packet, confirm identity
-        # get connection from self.__connection and call ClientConnection#open
-        login_packet = network_utils.receive_packet(conn, self._cryptor, LoginPacket)
-        if login_packet.name not in self.__connections:
+    def _check_login(self, login_packet: LoginPacket, address: Address) -> Tuple[Optional['ClientConnection'], Optional[LoginResultPacket]]:
+        """
+        Confirm the identity of a login request
+        :return: the connection to open if the login succeeded, and the result packet to reply.
+        The result packet is None if the client is unknown, where the socket should be simply closed
+        """
+        connection = self._connections.get(login_packet.name)
+        if connection is None:
             self.logger.warning('Unknown client: {} from {}'.format(login_packet.name, address))
+            self.__count_login('unknown_client')
+            return None, None
+        start = time.perf_counter()
+        credential = connection.config.password
+        if login_packet.ticket != '' and auth.verify_ticket(self.config.name, login_packet.name, credential, login_packet.ticket, self.config.ticket_lifetime):
+            login_result = 'resumed'
+        elif auth.verify_password(credential, login_packet.password):
+            login_result = 'success'
+        else:
+            login_result = 'wrong_password'
+        REGISTRY.histogram('cbu_login_check_seconds', 'Time to check the credential of a login', {'result': login_result}).observe(time.perf_counter() - start)
+        self.__count_login(login_result)
+        if login_result != 'wrong_password':
+            self.logger.info('Identification of {} confirmed: {}{}'.format(address, connection.config.name, ' (resumed)' if login_result == 'resumed' else ''))
+            meta = next(meta for meta in self.config.clients if meta.name == connection.config.name)
+            with self.__routing_lock:
+                self.__memberships[meta.name] = set(meta.channels) | set(login_packet.channels)
+                self.__resume_sequences[meta.name] = login_packet.last_sequence
+                self.__rebuild_routing_index()
+            ticket = self._issue_ticket(meta.name)
+            return connection, LoginResultPacket(
+                success=True, message='ok',
+                protocol_version=codec.negotiate_version(login_packet.protocol_version, self.config.protocol_version),
+                cipher=cryptor.negotiate_cipher(login_packet.ciphers, self.config.ciphers),
+                compression=compressor.negotiate_compression(login_packet.compressions, self._get_supported_compressions()),
+                ticket=ticket.ticket, ticket_lifetime=ticket.lifetime, chunking=login_packet.chunking
+            )
+        else:
+            self.logger.warning('Wrong password during login for client {} from {}'.format(connection.config.name, address))
+            return None, LoginResultPacket(success=False, message='Password incorrect')
+
+    def _is_login_check_slow(self, login_packet: LoginPacket) -> bool:
+        """
+        Whether checking the login may take a while, i.e. the password of the client is hashed
+        """
+        connection = self._connections.get(login_packet.name)
+        return connection is not None and auth.is_hashed(connection.config.password)
+
+    def _issue_ticket(self, name: str) -> TicketPacket:
+        """
+        A new resumption ticket for the client, empty if tickets are disabled
+        """
+        lifetime = self.config.ticket_lifetime
+        if lifetime <= 0:
+            return TicketPacket()
+        return TicketPacket(ticket=auth.issue_ticket(self.config.name, name, self._connections[name].config.password, lifetime), lifetime=lifetime)
+
+    @staticmethod
+    def __count_login(result: str):
+        REGISTRY.counter('cbu_logins_total', 'Login attempts by result', {'result': result}).inc()
+
+    def _start_metrics_server(self):
+        if self.config.metrics_port <= 0:
             return
-        connection = self.__connections.get(login_packet.name)
-        if connection.config.password == login_packet.password:
-            self.logger.info('Identification of {} confirmed: {}'.format(address, connection.config.name))
-            network_utils.send_packet(conn, self._cryptor, LoginResultPacket(success=True, message='ok'))
-            # self._send_packet(LoginResultPacket(success=True, message='ok'))
-            connection.open(conn)
+        try:
+            self.__metrics_server = start_http_server(self.config.metrics_hostname, self.config.metrics_port)
+        except OSError as e:
+            self.logger.error('Failed to start the metrics endpoint at {}:{}: {}'.format(self.config.metrics_hostname, self.config.metrics_port, e))
         else:
-            self.logger.warning('Wrong password during login for client {}: expected {} but received {}'.format(connection.config.name, connection.config.password, login_packet.password))
-            network_utils.send_packet(conn, self._cryptor, LoginResultPacket(success=False, message='Password incorrect'))
-            # self._send_packet(LoginResultPacket(success=False, message='Password incorrect'))
+            self.logger.info('Metrics served at http://{}:{}/metrics'.format(self.config.metrics_hostname, self.config.metrics_port))
+
+    @staticmethod
+    def _count_handshake(result: str):
+        REGISTRY.counter('cbu_handshakes_total', 'Connections accepted or refused before login by result', {'result': result}).inc()
+
+    def _get_pending_handshake_count(self) -> int:
+        handshakes = self.__handshakes
+        return handshakes.get_pending_count() if handshakes is not None else 0
+
+    def _admit(self, address: Address) -> bool:
+        """
+        Check the accept rate of the remote host of a new connection
+        """
+        if self._accept_limiter.allow(address.hostname):
+            return True
+        self.logger.debug('Refused connection from {}: accept rate exceeded'.format(address))
+        self._count_handshake('rate_limited')
+        return False
+
+    def __handle_connection(self, conn: socket.socket, address: Address, deadline: float):
+        # receive login packet before the deadline, confirm identity
+        # get connection from self._connections and call ClientConnection#open
+        if not self.is_running():
+            conn.close()
+            return
+        try:
+            reader = self._create_reader(conn)
+            reader.max_frame_size = min(self.config.max_frame_size, MAX_LOGIN_FRAME_SIZE)
+            login_packet = network_utils.decode_packet(self._cryptor, reader.read_frame(deadline), LoginPacket)
+            reader.max_frame_size = self.config.max_frame_size
+            conn.settimeout(network_utils.RECEIVE_TIMEOUT)
+        except socket.timeout:
+            self.logger.warning('Connection from {} sent no login packet in {}s'.format(address, self.config.login_timeout))
+            self._count_handshake('timeout')
+            conn.close()
+            return
+        except Exception as e:
+            self.logger.warning('Failed to receive login packet from {}: {}'.format(address, e))
+            self._count_handshake('error')
+            conn.close()
+            return
+        self._count_handshake('login')
+        try:
+            self.__login(conn, reader, login_packet, address)
+        except Exception as e:
+            self.logger.exception('Error handling login from {}: {}'.format(address, e))
+            conn.close()
+
+    def __login(self, conn: socket.socket, reader: network_utils.FrameReader, login_packet: LoginPacket, address: Address):
+        connection, result = self._check_login(login_packet, address)
+        if result is not None:
+            network_utils.send_packet(conn, self._cryptor, result)
+        if connection is not None:
+            try:
+                connection.open(conn, reader, result)
+            except RuntimeError as e:
+                self.logger.warning('Cannot open connection for {}: {}'.format(connection.config.name, e))
+                conn.close()
+        else:
+            conn.close()
 
     def _main_loop(self):
         self.assert_state(CBUServerState.STOPPED)
         self._set_state(CBUServerState.STARTING)
         try:
+            if self._reuse_port:
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self._sock.bind(self.config.address)
         except socket.error:
             self.logger.error('Failed to bind {}'.format(self.config.address))
@@ -77,27 +325,36 @@ class CBUServer(CBUBase):
             return
 
         try:
-            self._sock.listen(5)
+            self._sock.listen(self.config.listen_backlog)
             self._sock.settimeout(3)
             self.logger.info('Server started @ {}'.format(self.config.address))
             self.logger.info('Waiting for connections')
+            # login packets are received by a few threads, instead of a thread for each accepted connection
+            self.__handshakes = HandshakePool(self.config.handshake_workers, self.config.max_pending_handshakes, self.__handle_connection)
             self._set_state(CBUServerState.RUNNING)
+            self._start_metrics_server()
+            self._start_links()
             while self.is_running():
-                counter = 0
                 try:
                     try:
                         conn, addr = self._sock.accept()
                         address = Address(*addr)
-                        self.logger.info('New connection #{} from {}'.format(counter, address))
-                        Thread(name='Connection#{}'.format(counter), target=self.__handle_connection,
-                               args=(conn, address),
-                               daemon=True).start()
+                        if not self._admit(address):
+                            conn.close()
+                        elif not self.__handshakes.submit(conn, address, time.monotonic() + self.config.login_timeout):
+                            self.logger.debug('Refused connection from {}: too many pending handshakes'.format(address))
+                            self._count_handshake('busy')
+                            conn.close()
+                        else:
+                            self.logger.info('New connection from {}'.format(address))
                     except socket.timeout:
                         pass
                 except Exception as e:
                     if self.is_running():
                         self.logger.exception('Error ticking server: {}'.format(e))
         finally:
+            if self.__handshakes is not None:
+                self.__handshakes.stop()
             self._stop()
         self.logger.info('bye')
 
@@ -105,6 +362,15 @@ class CBUServer(CBUBase):
         return self.in_state(CBUServerState.RUNNING)
 
     def _stop(self):
+        metrics_server, self.__metrics_server = self.__metrics_server, None
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        for link in self.__links:
+            if link.is_running():
+                link.stop()
+        with self.__history_lock:
+            self.__history.close()
         super()._stop()
         self._set_state(CBUServerState.STOPPED)
         self.__should_loop_console = False
@@ -114,38 +380,452 @@ class CBUServer(CBUBase):
             input_ = input()
             if input_ == 'stop':
                 self.stop()
+            elif input_ == 'status':
+                self.show_status()
+            elif input_ == 'stats':
+                self.show_stats()
+
+    def show_status(self):
+        online = [connection for connection in self._connections.values() if connection.is_online()]
+        self.logger.info('Online clients: {}/{}'.format(len(online), len(self._connections)))
+        for connection in online:
+            connection_compressor = connection.get_compressor()
+            rtt = connection.get_rtt()
+            self.logger.info('- {}: rtt {}, outbound queue {}/{}, dropped {}, compression {}, channels {}'.format(
+                connection.config.name, '{:.1f}ms'.format(rtt * 1000) if rtt is not None else 'unknown', connection.get_outbound_queue_depth(),
+                self.config.outbound_queue_size, connection.get_outbound_dropped_count(),
+                '{} (inbound ratio {:.1%})'.format(connection_compressor.name, connection_compressor.ratio) if connection_compressor is not None else 'none',
+                ', '.join(self.get_channels(connection.config.name)) or 'none'
+            ))
+        for link in self.__links:
+            self.logger.info('- link to {} @ {}: {}, outbox {}'.format(
+                link.peer.name, link.config.server_address, 'online' if link.is_online() else 'offline', link.get_outbox_size()
+            ))
+        for name, fanout_compressor in self.__fanout_compressors.items():
+            if fanout_compressor is not None:
+                self.logger.info('Outbound compression ratio with {}: {:.1%}'.format(name, fanout_compressor.ratio))
+
+    def show_stats(self):
+        now, routed = time.monotonic(), self.__chats_routed.value
+        if self.__last_stats is not None:
+            last_time, last_routed = self.__last_stats
+            self.logger.info('Chats routed: {:.1f}/s since the last stats'.format((routed - last_routed) / max(now - last_time, 1e-9)))
+        self.__last_stats = (now, routed)
+        for line in REGISTRY.render_text('cbu_'):
+            self.logger.info(line)
 
     def start(self):
         super().start()
         self.console_loop()
 
+    def _check_ingress(self, name: str, packets: List[ChatPacket]) -> Tuple[List[ChatPacket], float]:
+        """
+        Apply the chat rate limit and the duplicate suppression of the client to the chats from it
+        :return: the chats to process, and seconds the connection should stop reading before processing them
+        """
+        limiter = self.__ingress.get(name)
+        if limiter is None:
+            return packets, 0
+        allowed, delay, rate_limited, duplicated = limiter.check(packets)
+        for reason, count in (('rate_limited', rate_limited), ('duplicate', duplicated)):
+            if count > 0:
+                self.logger.debug('Dropped {} chats from {}: {}'.format(count, name, reason))
+                REGISTRY.counter('cbu_ingress_dropped_total', 'Chats from clients dropped before routing by reason', {'name': name, 'reason': reason}).inc(count)
+        if delay > 0:
+            REGISTRY.counter('cbu_ingress_delayed_total', 'Times reading chats from a client is delayed by its rate limit', {'name': name}).inc()
+            REGISTRY.counter('cbu_ingress_delay_seconds_total', 'Time reading chats from a client is delayed by its rate limit', {'name': name}).inc(delay)
+        return allowed, delay
+
+    def _process_chats(self, name: str, packets: List[ChatPacket], peer: bool):
+        """
+        Route the chats a connection received in a frame, after _check_ingress
+        """
+        if peer:
+            for packet in packets:
+                self.process_federated(packet, name)
+        elif len(packets) == 1:
+            self.process_packet(packets[0])
+        elif len(packets) > 1:
+            self.process_batch(packets)
+
     def process_packet(self, packet: ChatPacket):
-        self.logger.info('Received chat from {}: {}'.format(packet.sender, packet.serialize()))
-        for connection in self.__connections.values():
+        self.logger.log_category(LOG_CATEGORY_CHAT, logging.INFO, Lazy(lambda: 'Received chat from {}: {}'.format(packet.sender, packet.serialize())))
+        self.__enter_federation(packet)
+        self._route_packet(packet)
+        if self.__relay is not None:
+            self.__relay.publish([packet])
+        self.__forward(packet)
+
+    def process_batch(self, packets: List[ChatPacket]):
+        """
+        Route chat packets that arrived together
+        """
+        for packet in packets:
+            self.logger.log_category(LOG_CATEGORY_CHAT, logging.INFO, Lazy(lambda: 'Received chat from {}: {}'.format(packet.sender, packet.serialize())))
+            self.__enter_federation(packet)
+        self._route_batch(packets)
+        if self.__relay is not None:
+            self.__relay.publish(packets)
+        for packet in packets:
+            self.__forward(packet)
+
+    def process_federated(self, packet: ChatPacket, peer: str):
+        """
+        Route a chat from a peer server to the clients here, and forward it to the other peers
+        """
+        if len(packet.path) == 0 or self.config.name in packet.path:
+            self.__count_federation_drop('loop')
+            return
+        if not self.__seen.add((packet.path[0], packet.origin_id)):
+            self.__count_federation_drop('duplicate')
+            return
+        self.logger.log_category(LOG_CATEGORY_CHAT, logging.INFO, Lazy(lambda: 'Received chat from {} via {}: {}'.format(packet.sender, peer, packet.serialize())))
+        packet.path = packet.path + [self.config.name]
+        self._route_packet(packet)
+        self.__forward(packet)
+
+    def __enter_federation(self, packet: ChatPacket):
+        if self.__federated:
+            with self.__origin_id_lock:
+                self.__origin_id += 1
+                packet.origin_id = self.__origin_id
+            packet.path = [self.config.name]
+            self.__seen.add((self.config.name, packet.origin_id))
+
+    def __forward(self, packet: ChatPacket):
+        """
+        Send the chat to the peers it has not been at
+        """
+        if not self.__federated:
+            return
+        frames: Dict[Tuple[int, str, str, int], List[bytes]] = {}
+        for name, connection in self.__peers.items():
+            if name not in packet.path:
+                connection.send_frames(self._encode_for(connection, packet, frames))
+        for link in self.__links:
+            if link.peer.name not in packet.path:
+                link.forward(packet)
+
+    @staticmethod
+    def __count_federation_drop(reason: str):
+        REGISTRY.counter('cbu_federation_dropped_total', 'Chats from peers dropped since they have been here', {'reason': reason}).inc()
+
+    def _start_links(self):
+        for link in self.__links:
+            link.start()
+
+    def process_relayed(self, packets: List[ChatPacket]):
+        """
+        Route chat packets received by another worker of the cluster to the clients of this one
+        """
+        if len(packets) == 1:
+            self._route_packet(packets[0])
+        else:
+            self._route_batch(packets)
+
+    def _route_packet(self, packet: ChatPacket):
+        # every recipient shares the same aes key, so the packet is encoded only once for each
+        # protocol version, cipher and compression, and the same frame is sent to all recipients using them
+        start = time.perf_counter()
+        frames: Dict[Tuple[int, str, str, int], List[bytes]] = {}
+        deliveries = 0
+        with self.__history_lock:
+            self.__history.append(packet)
+            recipients = list(self._get_recipients(packet))
+        for connection in recipients:
+            connection.send_frames(self._encode_for(connection, packet, frames))
+            deliveries += 1
+        self.__on_routed(packet.sender, 1, deliveries, time.perf_counter() - start)
+
+    def _route_batch(self, packets: List[ChatPacket]):
+        """
+        Each recipient gets its share of the packets in a single batch, and recipients sharing the same share get the same frame
+        """
+        start = time.perf_counter()
+        routes: Dict[str, Tuple[ClientConnection, List[int]]] = {}
+        with self.__history_lock:
+            for i, packet in enumerate(packets):
+                self.__history.append(packet)
+                for connection in self._get_recipients(packet):
+                    routes.setdefault(connection.config.name, (connection, []))[1].append(i)
+        packet_frames: Dict[int, Dict[Tuple[int, str, str, int], List[bytes]]] = {}
+        batch_frames: Dict[Tuple[int, ...], Dict[Tuple[int, str, str, int], List[bytes]]] = {}
+        for connection, indexes in routes.values():
+            if len(indexes) == 1 or connection.get_codec().version < PROTOCOL_VERSION_BINARY:
+                for i in indexes:
+                    connection.send_frames(self._encode_for(connection, packets[i], packet_frames.setdefault(i, {})))
+            else:
+                batch = BatchPacket(packets=[packets[i] for i in indexes])
+                connection.send_frames(self._encode_for(connection, batch, batch_frames.setdefault(tuple(indexes), {})))
+        if len(packets) > 0:
+            self.__on_routed(packets[0].sender, len(packets), sum(len(indexes) for _, indexes in routes.values()), time.perf_counter() - start)
+
+    def __on_routed(self, sender: str, chats: int, deliveries: int, cost: float):
+        self.__chats_routed.inc(chats)
+        self.__deliveries.inc(deliveries)
+        REGISTRY.histogram('cbu_fanout_seconds', 'Time to route the chats arriving together from a client', {'sender': sender}).observe(cost)
+
+    def _get_recipients(self, packet: ChatPacket) -> Iterable['ClientConnection']:
+        if packet.channel != '':
+            candidates = self.__channel_members.get(packet.channel, {}).values()
+        elif packet.broadcast:
+            candidates = self.__online.values()
+        else:
+            online = self.__online
+            candidates = (online[name] for name in dict.fromkeys(packet.receivers) if name in online)
+        for connection in candidates:
+            if connection.config.name != packet.sender and connection.is_online():  # do not send the message to the sender
+                yield connection
+
+    def _update_routing(self, connection: 'ClientConnection', logged: Optional['LoggedHistory'] = None):
+        """
+        Called when the connection goes online or offline
+        :param logged: the result of _read_logged_history, read here if it's not given
+        """
+        name = connection.config.name
+        if connection.is_online() and logged is None:
+            logged = self._read_logged_history(connection)
+        with self.__routing_lock:
+            online = connection.is_online()
+            if online == (self.__routable.get(name) is connection):
+                return
+            if online:
+                self.__routable[name] = connection
+                with self.__history_lock:
+                    self.__rebuild_routing_index()
+                    self.__catch_up(connection, self.__resume_sequences.pop(name, 0), logged)
+            else:
+                self.__routable.pop(name, None)
+                self.__rebuild_routing_index()
+            if self.__relay is not None:
+                self.__relay.announce(connection.config.name, online)
+
+    def _read_logged_history(self, connection: 'ClientConnection') -> Optional['LoggedHistory']:
+        """
+        Read the chats for the client catching up that are in the history log only, before routing to it starts,
+        so reading the files holds neither the routing lock nor the history lock
+        """
+        last_sequence = self.__resume_sequences.get(connection.config.name, 0)
+        if last_sequence <= 0:
+            return None
+        predicate = self.__get_catch_up_predicate(connection)
+        with self.__history_lock:
+            before = self.__history.get_oldest_sequence()
+            chats = self.__history.read_log(last_sequence, before, predicate, self.config.history_replay_limit)
+        return LoggedHistory(last_sequence, before - 1, list(chats))
+
+    def __get_catch_up_predicate(self, connection: 'ClientConnection') -> Callable[[ChatPacket], bool]:
+        name = connection.config.name
+        if connection.is_peer():
+            def predicate(packet: ChatPacket) -> bool:
+                return name not in packet.path
+        else:
+            channels = set(self.__memberships.get(name, ()))
+
+            def predicate(packet: ChatPacket) -> bool:
+                if packet.sender == name:
+                    return False
+                if packet.channel != '':
+                    return packet.channel in channels
+                return packet.broadcast or name in packet.receivers
+        return predicate
+
+    def __catch_up(self, connection: 'ClientConnection', last_sequence: int, logged: Optional['LoggedHistory']):
+        """
+        Send the chats for the client routed after the last sequence it received
+        """
+        if last_sequence <= 0:
+            return
+        name = connection.config.name
+        limit = self.config.history_replay_limit
+        packets: Deque[ChatPacket] = collections.deque(maxlen=max(0, limit))
+        read_until = last_sequence
+        if logged is not None and logged.after == last_sequence:
+            packets.extend(logged.packets)
+            read_until = max(last_sequence, logged.until)
+        # the chats dropped from the ring since the log was read are read from the log here, which are only a few
+        packets.extend(self.__history.since(read_until, self.__get_catch_up_predicate(connection), limit))
+        if len(packets) == 0:
+            return
+        packets = list(packets)
+        self.logger.info('Sending {} chats routed since {} to {}'.format(len(packets), last_sequence, name))
+        if connection.get_codec().version >= PROTOCOL_VERSION_BINARY:
+            step = CBUClientConfig.batch_max_size
+            for i in range(0, len(packets), step):
+                connection.send_frames(self._encode_for(connection, BatchPacket(packets=packets[i:i + step]), {}))
+        else:
+            for packet in packets:
+                connection.send_frames(self._encode_for(connection, packet, {}))
+        self.__replayed.inc(len(packets))
+
+    def get_last_sequence(self) -> int:
+        return self.__history.get_last_sequence()
+
+    def update_channels(self, name: str, join: List[str], leave: List[str]):
+        with self.__routing_lock:
+            channels = self.__memberships.setdefault(name, set())
+            channels.update(join)
+            channels.difference_update(leave)
+            self.__rebuild_routing_index()
+        self.logger.info('Channels of {}: {}'.format(name, ', '.join(sorted(channels)) or 'none'))
+
+    def get_channels(self, name: str) -> List[str]:
+        return sorted(self.__memberships.get(name, ()))
+
+    def __rebuild_routing_index(self):
+        online, peers = {}, {}
+        for name, connection in self.__routable.items():
             if connection.is_online():
-                if packet.broadcast or connection.config.name in packet.receivers:
-                    if connection.config.name != packet.sender:  # do not send the message to the sender
-                        connection.send_packet(packet)
+                (peers if connection.is_peer() else online)[name] = connection
+        channel_members: Dict[str, Dict[str, ClientConnection]] = {}
+        for name, connection in online.items():
+            for channel in self.__memberships.get(name, ()):
+                channel_members.setdefault(channel, {})[name] = connection
+        self.__online, self.__channel_members, self.__peers = online, channel_members, peers
+
+    def _encode_for(self, connection: 'ClientConnection', packet: AbstractPacket, frames: Dict[Tuple[int, str, str, int], List[bytes]]) -> List[bytes]:
+        """
+        Get the frames of the packet for the connection, reusing the ones in frames encoded for other connections
+        """
+        connection_codec, connection_cryptor, connection_compressor = connection.get_codec(), connection.get_cryptor(), connection.get_compressor()
+        compression = connection_compressor.name if connection_compressor is not None else ''
+        chunk_size = connection.get_chunk_size()
+        key = (connection_codec.version, connection_cryptor.name, compression, chunk_size)
+        data = frames.get(key)
+        if data is None:
+            if compression not in self.__fanout_compressors:
+                self.__fanout_compressors[compression] = self._create_compressor(compression)
+            data = frames[key] = streaming.encode_frames(connection_cryptor, packet, connection_codec, self.__fanout_compressors[compression], chunk_size)
+        return data
 
 
 class ClientConnection(CBUClient):
     def __init__(self, server: CBUServer, meta: ClientMeta):
         self.__meta = meta
         self.__server = server
-        super().__init__(CBUClientConfig(aes_key=server.config.aes_key, name=meta.name, password=meta.password,
-                                         server_hostname=server.config.hostname, server_port=server.config.port))
+        self.__outbound: Optional[OutboundQueue] = None
+        # the connection shares the network settings of the server
+        base_config = {key: getattr(server.config, key) for key in CBUConfigBase.__annotations__.keys()}
+        super().__init__(CBUClientConfig(name=meta.name, password=meta.password,
+                                         server_hostname=server.config.hostname, server_port=server.config.port, **base_config))
 
-    def open(self, conn: socket.socket):
+    def open(self, conn: socket.socket, reader: network_utils.FrameReader, login_result: LoginResultPacket):
+        if self.is_running():
+            raise RuntimeError('Already running')
         self._sock = conn
+        self._reader = reader
+        self._apply_login_result(login_result)
+        # frames to the client are sent by a dedicated writer thread,
+        # so a slow client never blocks the thread that routes the packet
+        self.__outbound = OutboundQueue(
+            self.__server.config.outbound_queue_size, self.__server.config.outbound_overflow_policy, self.__server.config.outbound_queue_bytes
+        )
+        self._start_thread(self.__writer_loop, self._get_main_loop_thread_name() + '.Writer', conn, self.__outbound)
         self.start()
 
-    def _on_packet(self, packet: ChatPacket):
-        super()._on_packet(packet)
-        self.__server.process_packet(packet)
+    def __writer_loop(self, conn: socket.socket, outbound: OutboundQueue):
+        while True:
+            data = outbound.get()
+            if data is None:
+                break
+            try:
+                conn.sendall(data)
+                self._on_frame_sent(len(data))
+            except socket.error as e:
+                self.logger.warning('Failed to send data: {}'.format(e))
+                self.__shutdown(conn)
+                break
+
+    @staticmethod
+    def __shutdown(conn: socket.socket):
+        """
+        Wake up the blocking recv in the MainLoop thread, so the connection gets cleaned up there
+        """
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def send_packet(self, packet: AbstractPacket):
+        self.send_frames(streaming.encode_frames(self._cryptor, packet, self._codec, self._compressor, self.get_chunk_size()))
+
+    def close(self):
+        """
+        Disconnect the client, the connection is cleaned up in its MainLoop thread
+        """
+        if self.is_online():
+            self.__shutdown(self._sock)
+
+    def send_data(self, data: bytes):
+        outbound = self.__outbound
+        if outbound is not None and not outbound.offer(data):
+            self.__on_outbound_full(outbound)
+
+    def send_frames(self, frames: List[bytes]):
+        """
+        Queue the frames of a packet, the chunks of a large packet are sent after the other frames queued meanwhile
+        """
+        if len(frames) == 1:
+            self.send_data(frames[0])
+            return
+        outbound = self.__outbound
+        if outbound is not None and not outbound.offer_stream(frames):
+            self.__on_outbound_full(outbound)
+
+    def __on_outbound_full(self, outbound: OutboundQueue):
+        self.logger.warning('Outbound queue is full ({} frames), disconnecting the slow client'.format(len(outbound)))
+        self.__shutdown(self._sock)
+
+    def _get_metrics_role(self) -> str:
+        return 'server'
+
+    def _register_metrics(self):
+        REGISTRY.gauge('cbu_outbound_queue_depth', 'Frames waiting to be sent to the client', self.metrics.labels, self.get_outbound_queue_depth)
+        REGISTRY.gauge('cbu_outbound_queue_bytes', 'Bytes of the frames waiting to be sent to the client', self.metrics.labels, self.get_outbound_queue_bytes)
+        REGISTRY.gauge('cbu_outbound_dropped', 'Frames dropped because the outbound queue is full', self.metrics.labels, self.get_outbound_dropped_count)
+
+    def get_outbound_queue_depth(self) -> int:
+        outbound = self.__outbound
+        return len(outbound) if outbound is not None else 0
+
+    def get_outbound_queue_bytes(self) -> int:
+        outbound = self.__outbound
+        return outbound.size_bytes if outbound is not None else 0
+
+    def get_outbound_dropped_count(self) -> int:
+        outbound = self.__outbound
+        return outbound.dropped if outbound is not None else 0
+
+    def is_peer(self) -> bool:
+        return self.__meta.peer
+
+    def _on_packet(self, packet: AbstractPacket):
+        if isinstance(packet, TicketPacket):
+            self.send_packet(self.__server._issue_ticket(self.__meta.name))
+        elif isinstance(packet, (ChatPacket, BatchPacket)):
+            chat_packets = [p for p in packet.packets if isinstance(p, ChatPacket)] if isinstance(packet, BatchPacket) else [packet]
+            chat_packets, delay = self.__server._check_ingress(self.__meta.name, chat_packets)
+            if delay > 0:
+                time.sleep(delay)  # not reading from the client meanwhile pushes it back through tcp
+            self.__server._process_chats(self.__meta.name, chat_packets, self.__meta.peer)
+        elif isinstance(packet, ChannelPacket) and not self.__meta.peer:
+            self.__server.update_channels(self.config.name, packet.join, packet.leave)
+
+    def _set_state(self, state: CBUStateBase):
+        super()._set_state(state)
+        self.__server._update_routing(self)
 
     def _connect_and_login(self):
         pass
 
+    def _should_reconnect(self) -> bool:
+        return False
+
+    def _stop(self):
+        if self.__outbound is not None:
+            self.__outbound.close()
+        super()._stop()
+
     def _get_logger_name(self) -> str:
         return 'Server.{}'.format(self.__meta.name)
 
@@ -1,11 +1,15 @@
+import logging
+
 from chat_bridge_universal.core.client import CBUClient, CBUClientConfig
 from chat_bridge_universal.core.config import load_config
 from chat_bridge_universal.core.network.protocal import ChatPayload
+from chat_bridge_universal.utils.logger import LOG_CATEGORY_CHAT
 
 
 class CliClient(CBUClient):
     def __init__(self, config_path: str):
         super().__init__(load_config(config_path, CBUClientConfig))
+        self.apply_log_config()
 
     def console_loop(self):
         while not self._is_stopped():
@@ -16,7 +20,7 @@ class CliClient(CBUClient):
                 self.send_chat(input_)
 
     def on_chat(self, sender: str, payload: ChatPayload):
-        self.logger.info('Received chat from {}: {}'.format(sender, payload.formatted_str))
+        self.logger.log_category(LOG_CATEGORY_CHAT, logging.INFO, 'Received chat from {}: {}'.format(sender, payload.formatted_str))
 
     def start(self):
         super().start()
@@ -1,3 +1,4 @@
+from logging import Handler
 from typing import cast
 
 from mcdreforged.minecraft.rtext import RText, RColor
@@ -7,6 +8,15 @@ from mcdreforged.utils.logger import SyncStdoutStreamHandler
 from chat_bridge_universal.core.client import CBUClient
 from chat_bridge_universal.core.network.protocal import ChatPayload
 from chat_bridge_universal.impl.mcdr.config import MCDRClientConfig
+from chat_bridge_universal.utils.logger import CBULogger
+
+
+class MCDRCBULogger(CBULogger):
+    @classmethod
+    def create_console_handler(cls) -> Handler:
+        handler = SyncStdoutStreamHandler()  # use MCDR's, so the concurrent output won't be messed up
+        handler.setFormatter(cls.create_formatter())
+        return handler
 
 
 class MCDRCBUClient(CBUClient):
@@ -14,11 +24,9 @@ class MCDRCBUClient(CBUClient):
         super().__init__(config)
         self.server = server
         self.config = cast(MCDRClientConfig, self.config)
-        prev_handler = self.logger.console_handler
-        new_handler = SyncStdoutStreamHandler()  # use MCDR's, so the concurrent output won't be messed up
-        new_handler.setFormatter(prev_handler.formatter)
-        self.logger.removeHandler(prev_handler)
-        self.logger.addHandler(new_handler)
+
+    def _create_logger(self) -> CBULogger:
+        return MCDRCBULogger(self._get_logger_name())
 
     def on_chat(self, sender: str, payload: ChatPayload):
         self.server.say(RText('[{}] {}'.format(sender, payload.formatted_str), RColor.gray))
@@ -3,3 +3,5 @@ from chat_bridge_universal.core.client import CBUClientConfig
 
 class MCDRClientConfig(CBUClientConfig):
     debug: bool = False
+    send_queue_size: int = 256  # chats waiting to be sent, new chats are dropped when it's full
+    unload_flush_timeout: float = 5  # seconds to wait for queued chats to be sent on plugin unload
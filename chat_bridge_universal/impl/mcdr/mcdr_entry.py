@@ -9,11 +9,14 @@ from mcdreforged.minecraft.rtext import RTextBase
 from mcdreforged.plugin.server_interface import ServerInterface, PluginServerInterface
 
 from chat_bridge_universal.impl.mcdr.client import MCDRCBUClient, MCDRClientConfig
+from chat_bridge_universal.impl.mcdr.messenger import ChatMessenger
+from chat_bridge_universal.utils.logger import CBULogger
 
 META = ServerInterface.get_instance().as_plugin_server_interface().get_self_metadata()
 PREFIX = '!!cbu'
 client: Optional[MCDRCBUClient] = None
 config: Optional[MCDRClientConfig] = None
+messenger: Optional[ChatMessenger] = None
 
 
 def tr(key: str, *args, **kwargs) -> RTextBase:
@@ -25,10 +28,19 @@ def display_help(source: CommandSource):
 
 
 def display_status(source: CommandSource):
-    if config is None or client is None:
+    if config is None or client is None or messenger is None:
         source.reply(tr('status.not_init'))
     else:
-        source.reply(tr('status.info', client.is_online()))
+        rtt = client.get_rtt()
+        source.reply(tr(
+            'status.info', client.is_online(),
+            messenger.get_queue_size(), messenger.max_size, messenger.queued, messenger.sent, messenger.dropped,
+            client.get_outbox_size(), client.config.outbox_size, client.outbox_dropped,
+            '{:.1f}ms'.format(rtt * 1000) if rtt is not None else 'N/A',
+            int(client.metrics.frames_sent.value), int(client.metrics.bytes_sent.value),
+            int(client.metrics.frames_received.value), int(client.metrics.bytes_received.value),
+            int(client.reconnects.value)
+        ))
 
 
 @new_thread('CBU-restart')
@@ -39,9 +51,12 @@ def restart_client(source: CommandSource):
 
 @new_thread('CBU-unload')
 def on_unload(server: PluginServerInterface):
+    if messenger is not None:
+        messenger.stop(config.unload_flush_timeout)
     if client is not None and client.is_running():
         server.logger.info('Stopping CBU client due to plugin unload')
         client.stop()
+    CBULogger.set_async_all(False)
 
 
 def register_commands(server: PluginServerInterface):
@@ -54,30 +69,29 @@ def register_commands(server: PluginServerInterface):
 
 
 def on_load(server: PluginServerInterface, old_module):
-    global config, client
+    global config, client, messenger
     config_path = os.path.join(server.get_data_folder(), 'config.json')
     config = server.load_config_simple(file_name=config_path, in_data_folder=False, target_class=MCDRClientConfig)
     client = MCDRCBUClient(config, server)
+    messenger = ChatMessenger(client, config.send_queue_size)
 
     server.register_help_message(PREFIX, tr('help_summary'))
     client.logger.set_debug_all(config.debug)
+    client.apply_log_config()
     register_commands(server)
 
     @new_thread('CBU-start')
     def start():
         server.logger.info('Starting CBU client')
         client.start()
+        messenger.start()
 
     start()
 
 
-@new_thread('CBU-messenger')
 def send_chat(message: str, *, author: str = ''):
-    if client is not None:
-        if not client.is_running():
-            client.start()
-        if client.is_online():
-            client.send_chat(message, author)
+    if messenger is not None:
+        messenger.send_chat(message, author)
 
 
 def on_user_info(server: PluginServerInterface, info: Info):
@@ -0,0 +1,80 @@
+import collections
+from threading import Condition, Thread
+from typing import Deque, Tuple
+
+from chat_bridge_universal.impl.mcdr.client import MCDRCBUClient
+
+
+class ChatMessenger:
+    """
+    A single long-living worker sending the chats of the plugin in order through a bounded queue
+    Chats are dropped when the queue is full, chats sent while the client is offline are kept in the outbox of the client
+    """
+    def __init__(self, client: MCDRCBUClient, max_size: int):
+        self.__client = client
+        self.max_size = max(1, max_size)
+        self.__queue: Deque[Tuple[str, str]] = collections.deque()
+        self.__condition = Condition()
+        self.__busy = False
+        self.__stopping = False
+        self.__thread = Thread(target=self.__loop, name='CBU-messenger', daemon=True)
+        # statistic
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def start(self):
+        self.__thread.start()
+
+    def get_queue_size(self) -> int:
+        return len(self.__queue)
+
+    def send_chat(self, message: str, author: str = ''):
+        with self.__condition:
+            if self.__stopping or len(self.__queue) >= self.max_size:
+                self.dropped += 1
+                return
+            self.__queue.append((message, author))
+            self.queued += 1
+            self.__condition.notify_all()
+
+    def __loop(self):
+        while True:
+            with self.__condition:
+                while len(self.__queue) == 0 and not self.__stopping:
+                    self.__condition.wait()
+                if len(self.__queue) == 0:
+                    return
+                message, author = self.__queue.popleft()
+                self.__busy = True
+            try:
+                self.__send(message, author)
+            except Exception as e:
+                self.dropped += 1
+                self.__client.logger.exception('Failed to send chat: {}'.format(e))
+            finally:
+                with self.__condition:
+                    self.__busy = False
+                    self.__condition.notify_all()
+
+    def __send(self, message: str, author: str):
+        if not self.__client.is_running():
+            self.__client.start()
+        self.__client.send_chat(message, author)
+        self.sent += 1
+
+    def stop(self, timeout: float):
+        """
+        Stop accepting new chats, send the queued ones and wait for the worker to exit
+        The chats still queued after timeout seconds are dropped, and the chat being sent then is waited for
+        up to timeout seconds more, so the client isn't stopped in the middle of sending it
+        """
+        with self.__condition:
+            self.__stopping = True
+            self.__condition.notify_all()
+            if not self.__condition.wait_for(lambda: len(self.__queue) == 0 and not self.__busy, timeout):
+                self.dropped += len(self.__queue)
+                self.__queue.clear()
+                self.__condition.wait_for(lambda: not self.__busy, timeout)
+        if self.__thread.is_alive():
+            self.__thread.join(timeout)
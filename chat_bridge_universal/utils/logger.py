@@ -1,11 +1,91 @@
+import atexit
+import queue
+import time
 import weakref
-from logging import Logger, StreamHandler, DEBUG, INFO
-from typing import Set
+from logging import Logger, StreamHandler, Handler, Formatter, LogRecord, DEBUG, INFO
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+from typing import Set, Dict, Callable, Any, Optional, Tuple, Union
 
 from colorlog import ColoredFormatter
 
+LOG_CATEGORY_CHAT = 'chat'  # a record for every chat message
+
+
+class Lazy:
+    """
+    A log message computed only when the record is actually emitted, i.e. not at all if its level is disabled
+    or its category is rate limited. It's resolved on the logging thread, even in async mode
+
+        logger.debug(Lazy(lambda: 'Received {}'.format(packet.serialize())))
+    """
+    __slots__ = ('function',)
+
+    def __init__(self, function: Callable[[], Any]):
+        self.function = function
+
+    def __str__(self):
+        return str(self.function())
+
+    def __format__(self, format_spec: str):
+        return format(self.function(), format_spec)
+
+
+class RateLimiter:
+    """
+    Token bucket allowing rate records per second on average and burst records at once
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.__tokens = self.burst
+        self.__last_time = time.monotonic()
+        self.__suppressed = 0
+        self.__lock = Lock()
+
+    def acquire(self) -> Tuple[bool, int]:
+        """
+        :return: whether the record can be logged, and the amount of records suppressed before it if so
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last_time) * self.rate)
+            self.__last_time = now
+            if self.__tokens < 1:
+                self.__suppressed += 1
+                return False, 0
+            self.__tokens -= 1
+            suppressed, self.__suppressed = self.__suppressed, 0
+            return True, suppressed
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    Never blocks the logging thread: records are dropped when the queue is full,
+    and they are written later by the listener thread instead of here
+    """
+    def __init__(self, record_queue: queue.Queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        # resolve a Lazy message now, the packet it reads may have changed by the time the listener gets to it
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
 
 class CBULogger(Logger):
+    """
+    Subclasses can override create_console_handler to write the console in their own way,
+    the process-wide settings are kept on CBULogger whichever class they're set through
+    """
     LOG_COLORS = {
         'DEBUG': 'blue',
         'INFO': 'green',
@@ -22,25 +102,108 @@ class CBULogger(Logger):
     }
     __DEBUG_SWITCH = False
     __REFS: Set['CBULogger'] = weakref.WeakSet()
+    __RATE_LIMITERS: Dict[str, RateLimiter] = {}
+    # shared by all loggers in async mode
+    __async_handler: Optional[_DroppingQueueHandler] = None
+    __async_listener: Optional[QueueListener] = None
+    __async_lock = Lock()
+    __atexit_registered = False
 
     @classmethod
     def set_debug_all(cls, value: bool):
-        cls.__DEBUG_SWITCH = value
+        CBULogger.__DEBUG_SWITCH = value
         for logger in cls.__REFS:
             logger.__refresh_debug_level()
 
-    def __init__(self, name: str):
-        super().__init__(name)
-        self.console_handler = StreamHandler()
-        self.console_handler.setFormatter(ColoredFormatter(
+    @classmethod
+    def set_async_all(cls, value: bool, queue_size: int = 10000):
+        """
+        In async mode records are put into a bounded queue and written to the console by a background thread,
+        so logging never blocks the network threads on the console. Records are dropped if the queue is full
+        The console handler of the background thread is created by the class it's called on, replacing
+        the console handlers of the loggers
+        """
+        with cls.__async_lock:
+            if value == (CBULogger.__async_handler is not None):
+                return
+            if value:
+                handler = _DroppingQueueHandler(queue.Queue(max(1, queue_size)))
+                listener = QueueListener(handler.queue, cls.create_console_handler())
+                listener.start()
+                if not CBULogger.__atexit_registered:
+                    atexit.register(CBULogger.set_async_all, False)  # flush the queued records on exit
+                    CBULogger.__atexit_registered = True
+                CBULogger.__async_handler, CBULogger.__async_listener = handler, listener
+            else:
+                handler, listener = CBULogger.__async_handler, CBULogger.__async_listener
+                CBULogger.__async_handler = CBULogger.__async_listener = None
+            for logger in cls.__REFS:
+                logger.__refresh_handler()
+            if not value:
+                listener.stop()  # flushes the queued records
+
+    @classmethod
+    def get_async_dropped_count(cls) -> int:
+        handler = CBULogger.__async_handler
+        return handler.dropped if handler is not None else 0
+
+    @classmethod
+    def set_rate_limit(cls, category: str, rate: float, burst: Optional[float] = None):
+        """
+        Limit records logged with log_category in the category to rate records per second, 0 rate for no limit
+        """
+        if rate > 0:
+            cls.__RATE_LIMITERS[category] = RateLimiter(rate, burst if burst is not None else rate)
+        else:
+            cls.__RATE_LIMITERS.pop(category, None)
+
+    @classmethod
+    def create_formatter(cls) -> Formatter:
+        return ColoredFormatter(
             f'[%(name)s] [%(asctime)s] [%(threadName)s/%(log_color)s%(levelname)s%(reset)s]: %(message_log_color)s%(message)s%(reset)s',
-            log_colors=self.LOG_COLORS,
-            secondary_log_colors=self.SECONDARY_LOG_COLORS,
+            log_colors=cls.LOG_COLORS,
+            secondary_log_colors=cls.SECONDARY_LOG_COLORS,
             datefmt='%H:%M:%S'
-        ))
-        self.addHandler(self.console_handler)
+        )
+
+    @classmethod
+    def create_console_handler(cls) -> Handler:
+        handler = StreamHandler()
+        handler.setFormatter(cls.create_formatter())
+        return handler
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.console_handler = self.create_console_handler()
+        self.__current_handler: Optional[Handler] = None
         self.__REFS.add(self)
+        self.__refresh_handler()
         self.__refresh_debug_level()
 
+    def log_category(self, category: str, level: int, msg: Union[str, Lazy]):
+        """
+        Log a record of a busy category, e.g. chat routing, which might be rate limited with set_rate_limit
+        """
+        if not self.isEnabledFor(level):
+            return
+        limiter = self.__RATE_LIMITERS.get(category)
+        if limiter is not None:
+            allowed, suppressed = limiter.acquire()
+            if not allowed:
+                return
+            if suppressed > 0:
+                msg = '{} ({} similar messages suppressed)'.format(msg, suppressed)
+        self._log(level, msg, ())
+
+    def __refresh_handler(self):
+        async_handler = CBULogger.__async_handler
+        handler = async_handler if async_handler is not None else self.console_handler
+        if handler is not self.__current_handler:
+            if self.__current_handler is not None:
+                self.removeHandler(self.__current_handler)
+            self.addHandler(handler)
+            self.__current_handler = handler
+
     def __refresh_debug_level(self):
         self.setLevel(DEBUG if self.__DEBUG_SWITCH else INFO)
+        self._cache.clear()  # not registered to the logging manager, so setLevel doesn't clear it
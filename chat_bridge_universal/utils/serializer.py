@@ -0,0 +1,293 @@
+"""
+The data model of packets and configs, compatible with the Serializable of MCDReforged
+so the MCDR plugin can hand the config classes to it, but without importing MCDReforged in the core
+
+Public fields are the annotated class attributes not starting with '_', the class attribute values are the defaults.
+Classes created once and used rarely, like configs, derive Serializable, which finds the fields by reflection.
+Classes created for every message, like packets, derive SlottedSerializable instead
+"""
+import base64
+import copy
+from enum import Enum
+from threading import Lock
+from typing import Union, TypeVar, List, Dict, Type, Any, get_type_hints, Tuple
+
+T = TypeVar('T')
+
+_BASIC_CLASSES = (type(None), bool, int, float, str, list, dict)
+_LIST_ORIGIN = getattr(List[int], '__origin__')
+_DICT_ORIGIN = getattr(Dict[int, int], '__origin__')
+
+
+def _get_type_hints(cls: Type) -> Dict[str, Type]:
+    try:
+        return get_type_hints(cls)
+    except Exception:
+        return get_type_hints(cls, globalns={})
+
+
+def serialize(obj) -> Union[None, int, float, str, list, dict]:
+    if type(obj) in (type(None), int, float, str, bool):
+        return obj
+    elif isinstance(obj, (list, tuple)):
+        return [serialize(element) for element in obj]
+    elif isinstance(obj, dict):
+        return {key: serialize(value) for key, value in obj.items()}
+    elif isinstance(obj, Enum):
+        return obj.name
+    elif isinstance(obj, bytes):
+        return base64.b64encode(obj).decode('ascii')
+    elif isinstance(obj, SlottedSerializable):
+        return obj.serialize()
+    try:
+        attributes = vars(obj)
+    except TypeError:
+        raise TypeError('Unsupported input type {}'.format(type(obj))) from None
+    return {key: serialize(value) for key, value in attributes.items() if not key.startswith('_')}
+
+
+def deserialize(data, cls: Type[T], *, error_at_missing: bool = False, error_at_redundancy: bool = False) -> T:
+    if cls is None:
+        cls = type(None)
+    origin = getattr(cls, '__origin__', None)
+    args = getattr(cls, '__args__', ())
+    if cls is Any:
+        return data
+    elif origin is Union:
+        for possible_cls in args:
+            try:
+                return deserialize(data, possible_cls, error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy)
+            except (TypeError, ValueError):
+                pass
+        raise TypeError('Data in type {} cannot match any candidate of target class {}'.format(type(data), cls))
+    elif cls in _BASIC_CLASSES and type(data) is cls:
+        return data
+    elif cls is float and type(data) is int:
+        return float(data)
+    elif cls is bytes and isinstance(data, str):
+        try:
+            return base64.b64decode(data, validate=True)
+        except ValueError:
+            raise ValueError('Invalid base64 data for bytes') from None
+    elif origin is _LIST_ORIGIN and isinstance(data, list):
+        return [deserialize(element, args[0], error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy) for element in data]
+    elif origin is _DICT_ORIGIN and isinstance(data, dict):
+        return {
+            deserialize(key, args[0], error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy):
+            deserialize(value, args[1], error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy)
+            for key, value in data.items()
+        }
+    elif isinstance(cls, type) and issubclass(cls, Enum) and isinstance(data, str):
+        try:
+            return cls[data]
+        except KeyError:
+            raise ValueError('Unknown {} name {}'.format(cls.__name__, data)) from None
+    elif isinstance(cls, type) and issubclass(cls, SlottedSerializable) and isinstance(data, dict):
+        return cls.deserialize(data)
+    elif isinstance(cls, type) and cls not in _BASIC_CLASSES and isinstance(data, dict):
+        try:
+            result = cls()
+        except Exception:
+            raise TypeError('Failed to construct instance of class {}'.format(cls))
+        fields = cls.get_annotations_fields() if issubclass(cls, Serializable) else {
+            name: field_type for name, field_type in _get_type_hints(cls).items() if not name.startswith('_')
+        }
+        for name, field_type in fields.items():
+            if name in data:
+                setattr(result, name, deserialize(data[name], field_type, error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy))
+            elif error_at_missing:
+                raise ValueError('Missing attribute {} for class {} in input object {}'.format(name, cls, data))
+            elif hasattr(cls, name):
+                setattr(result, name, copy.copy(getattr(cls, name)))
+        if error_at_redundancy:
+            redundancy = set(data.keys()) - set(fields.keys())
+            if len(redundancy) > 0:
+                raise ValueError('Redundancy attributes {} for class {} in input object {}'.format(redundancy, cls, data))
+        if isinstance(result, Serializable):
+            result.on_deserialization()
+        return result
+    else:
+        raise TypeError('Unsupported input type: expected class {} but found data with class {}'.format(cls, type(data)))
+
+
+class Serializable:
+    __slots__ = ()  # so the slots of SlottedSerializable subclasses are the only storage they have
+    __fields_lock = Lock()
+
+    def __init__(self, **kwargs):
+        fields = self.get_annotations_fields()
+        for key in kwargs.keys():
+            if key not in fields:
+                raise KeyError('Unknown key received in __init__ of class {}: {}'.format(self.__class__, key))
+        vars(self).update(kwargs)
+
+    @classmethod
+    def get_annotations_fields(cls) -> Dict[str, Type]:
+        """
+        The public fields and their types, cached in each class itself instead of in its base class
+        """
+        fields = cls.__dict__.get('_Serializable__fields')
+        if fields is None:
+            with Serializable.__fields_lock:
+                fields = {name: field_type for name, field_type in _get_type_hints(cls).items() if not name.startswith('_')}
+                cls.__fields = fields
+        return fields
+
+    def serialize(self) -> dict:
+        return serialize(self)
+
+    @classmethod
+    def deserialize(cls: Type[T], data: dict, **kwargs) -> T:
+        return deserialize(data, cls, **kwargs)
+
+    def update_from(self, data: dict):
+        vars(self).update(vars(self.deserialize(data)))
+
+    @classmethod
+    def get_default(cls: Type[T]) -> T:
+        return cls.deserialize({})
+
+    def on_deserialization(self):
+        """
+        Invoked after being deserialized
+        """
+        pass
+
+
+class _Missing:
+    def __repr__(self):
+        return '<missing>'
+
+
+_MISSING = _Missing()
+_IMMUTABLE_CLASSES = (type(None), bool, int, float, str, bytes, tuple, frozenset)
+
+
+class _SlottedSerializableMeta(type):
+    """
+    Turns the fields into slots, moving their defaults out of the class body since a slot can't have one,
+    and generates __init__, serialize and deserialize for the fields once the class is created
+    """
+    def __new__(mcs, name: str, bases: tuple, namespace: dict):
+        defaults = {}
+        fields = [field for field in namespace.get('__annotations__', {}).keys() if not field.startswith('_')]
+        for field in fields:
+            if field in namespace:
+                defaults[field] = namespace.pop(field)
+        namespace['__slots__'] = tuple(fields)
+        cls = super().__new__(mcs, name, bases, namespace)
+        for base in cls.__mro__[1:]:  # the closest base wins
+            defaults = {**base.__dict__.get('_field_defaults', {}), **defaults}
+        cls._field_defaults = defaults
+        if len(bases) > 0 and bases[0] is not Serializable:  # not SlottedSerializable itself
+            mcs.__generate(cls)
+        return cls
+
+    @staticmethod
+    def __generate(cls: type):
+        hints = cls.get_annotations_fields()
+        defaults: Dict[str, Any] = cls._field_defaults
+        scope = {
+            '_MISSING': _MISSING, '_new': object.__new__, '_serialize': serialize, '_deserialize': deserialize,
+            '_copy': copy.copy, '_Serializable': SlottedSerializable, '_fields': tuple(hints.keys()),
+        }
+        init_args, init_body, serialize_items, deserialize_body = [], [], [], []
+        for i, (field, hint) in enumerate(hints.items()):
+            scope['_t{}'.format(i)] = hint
+            value_expr = 'self.' + field
+            if field in defaults:
+                default = defaults[field]
+                scope['_d{}'.format(i)] = default
+                if isinstance(default, _IMMUTABLE_CLASSES) or isinstance(default, Enum):
+                    init_args.append('{}=_d{}'.format(field, i))
+                    init_body.append('self.{0} = {0}'.format(field))
+                    default_expr = '_d{}'.format(i)
+                else:
+                    init_args.append('{}=_MISSING'.format(field))
+                    init_body.append('self.{0} = _copy(_d{1}) if {0} is _MISSING else {0}'.format(field, i))
+                    default_expr = '_copy(_d{})'.format(i)
+            else:
+                # a required field is left unset if it's not given, like MCDR Serializable does
+                init_args.append('{}=_MISSING'.format(field))
+                init_body.append('if {0} is not _MISSING: self.{0} = {0}'.format(field))
+                default_expr = None
+            kind, element_type = _get_field_kind(hint)
+            if kind == 'basic':
+                serialize_items.append('{!r}: {}'.format(field, value_expr))
+                check = 'type(v) is not _t{}'.format(i)
+            elif kind == 'basic_list':
+                serialize_items.append('{!r}: list({})'.format(field, value_expr))
+                scope['_e{}'.format(i)] = element_type
+                check = 'type(v) is not list or not all(type(e) is _e{} for e in v)'.format(i)
+            elif kind == 'enum':
+                serialize_items.append('{!r}: {}.name'.format(field, value_expr))
+                check = 'True'
+            elif kind == 'object':
+                serialize_items.append('{!r}: {}.serialize() if isinstance({}, _Serializable) else _serialize({})'.format(field, value_expr, value_expr, value_expr))
+                check = 'True'
+            else:
+                serialize_items.append('{!r}: _serialize({})'.format(field, value_expr))
+                check = 'True'
+            deserialize_body.append('v = data.get({!r}, _MISSING)'.format(field))
+            if default_expr is not None:
+                deserialize_body.append('if v is _MISSING:')
+                deserialize_body.append('    self.{} = {}'.format(field, default_expr))
+                deserialize_body.append('else:')
+            else:
+                deserialize_body.append('if v is not _MISSING:')
+            if check != 'True':
+                deserialize_body.append('    if {}:'.format(check))
+                deserialize_body.append('        v = _deserialize(v, _t{})'.format(i))
+            else:
+                deserialize_body.append('    v = _deserialize(v, _t{})'.format(i))
+            deserialize_body.append('    self.{} = v'.format(field))
+        source = '\n'.join([
+            'def __init__(self, *, {}):'.format(', '.join(init_args)) if len(init_args) > 0 else 'def __init__(self):',
+            *(['    ' + line for line in init_body] or ['    pass']),
+            '',
+            'def serialize(self):',
+            '    try:',
+            '        return {{{}}}'.format(', '.join(serialize_items)),
+            '    except AttributeError:  # some required fields are unset',
+            '        return {name: _serialize(getattr(self, name)) for name in _fields if hasattr(self, name)}',
+            '',
+            'def deserialize(cls, data, **kwargs):',
+            '    if type(data) is not dict:',
+            '        raise TypeError("Unsupported input type: expected class {} but found data with class {{}}".format(type(data)))'.format(cls.__name__),
+            '    self = _new(cls)',
+            *['    ' + line for line in deserialize_body],
+            '    self.on_deserialization()',
+            '    return self',
+        ])
+        exec(compile(source, '<generated {}.{}>'.format(cls.__module__, cls.__qualname__), 'exec'), scope)
+        cls.__init__ = scope['__init__']
+        cls.serialize = scope['serialize']
+        cls.deserialize = classmethod(scope['deserialize'])
+
+
+def _get_field_kind(hint: Type) -> Tuple[str, Any]:
+    """
+    How a generated serializer handles a field of the type: basic, basic_list, enum, object or other
+    """
+    if hint in (bool, int, str):  # float takes ints too, which the generic deserialize converts
+        return 'basic', None
+    if getattr(hint, '__origin__', None) is _LIST_ORIGIN:
+        element_type = getattr(hint, '__args__', (Any,))[0]
+        if element_type in (bool, int, str):
+            return 'basic_list', element_type
+    if isinstance(hint, type) and issubclass(hint, Enum):
+        return 'enum', None
+    if isinstance(hint, type) and issubclass(hint, Serializable):
+        return 'object', None
+    return 'other', None
+
+
+class SlottedSerializable(Serializable, metaclass=_SlottedSerializableMeta):
+    """
+    A Serializable storing its fields in slots, with __init__, serialize and deserialize generated for its fields
+    when the class is created, so no reflection happens per instance
+
+    Fields can't be added to an instance besides the declared ones. A field default is copied for every instance
+    unless it's immutable, and like Serializable a required field not given to __init__ or missing in the data
+    to deserialize is left unset
+    """
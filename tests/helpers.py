@@ -0,0 +1,13 @@
+from typing import List
+
+from chat_bridge_universal.core.network.protocal import ChatPacket, ChatPayload
+
+
+def create_chat(message: str = 'hello', *, sender: str = 'a', receivers: List[str] = (), author: str = '', **kwargs) -> ChatPacket:
+    """
+    A chat packet broadcast by default, or sent to the given receivers
+    """
+    return ChatPacket(
+        sender=sender, receivers=list(receivers), broadcast=len(receivers) == 0,
+        payload=ChatPayload(author=author, message=message), **kwargs
+    )
@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+
+from chat_bridge_universal.core import auth
+
+
+class PasswordTest(unittest.TestCase):
+    def test_plain(self):
+        self.assertFalse(auth.is_hashed('secret'))
+        self.assertTrue(auth.verify_password('secret', 'secret'))
+        self.assertFalse(auth.verify_password('secret', 'Secret'))
+
+    def test_hashed(self):
+        credential = auth.hash_password('secret', iterations=1000)
+        self.assertTrue(auth.is_hashed(credential))
+        self.assertNotEqual(credential, auth.hash_password('secret', iterations=1000))  # salted
+        self.assertTrue(auth.verify_password(credential, 'secret'))
+        self.assertFalse(auth.verify_password(credential, 'wrong'))
+        self.assertFalse(auth.verify_password(credential, credential))
+
+    def test_malformed_hash(self):
+        self.assertFalse(auth.verify_password(auth.HASH_ALGORITHM + '$x$y$z', 'secret'))
+        self.assertFalse(auth.verify_password(auth.HASH_ALGORITHM + '$1000', 'secret'))
+
+
+class TicketTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1700000000.0
+        patcher = mock.patch('chat_bridge_universal.core.auth.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_issue_and_verify(self):
+        ticket = auth.issue_ticket('server', 'survival', 'secret', 600)
+        self.assertTrue(auth.verify_ticket('server', 'survival', 'secret', ticket, 600))
+
+    def test_bound_to_server_client_and_credential(self):
+        ticket = auth.issue_ticket('server', 'survival', 'secret', 600)
+        self.assertFalse(auth.verify_ticket('other', 'survival', 'secret', ticket, 600))
+        self.assertFalse(auth.verify_ticket('server', 'creative', 'secret', ticket, 600))
+        self.assertFalse(auth.verify_ticket('server', 'survival', 'changed', ticket, 600))
+
+    def test_expiry(self):
+        ticket = auth.issue_ticket('server', 'survival', 'secret', 600)
+        self.now += 600
+        self.assertTrue(auth.verify_ticket('server', 'survival', 'secret', ticket, 600))
+        self.now += 1
+        self.assertFalse(auth.verify_ticket('server', 'survival', 'secret', ticket, 600))
+
+    def test_shortened_lifetime(self):
+        ticket = auth.issue_ticket('server', 'survival', 'secret', 600)
+        self.assertFalse(auth.verify_ticket('server', 'survival', 'secret', ticket, 60))
+        self.now += 550
+        self.assertTrue(auth.verify_ticket('server', 'survival', 'secret', ticket, 60))
+
+    def test_tampered(self):
+        ticket = auth.issue_ticket('server', 'survival', 'secret', 600)
+        expiry, signature = ticket.split(':')
+        self.assertFalse(auth.verify_ticket('server', 'survival', 'secret', '{}:{}'.format(int(expiry) + 1, signature), 600))
+        self.assertFalse(auth.verify_ticket('server', 'survival', 'secret', expiry + ':' + '0' * len(signature), 600))
+        for malformed in ('', 'x', 'x:y', ticket + ':z'):
+            self.assertFalse(auth.verify_ticket('server', 'survival', 'secret', malformed, 600))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import struct
+import unittest
+
+from chat_bridge_universal.core.network.codec import BINARY_CODEC, JSON_CODEC, PROTOCOL_VERSION_BINARY, get_codec, negotiate_version
+from chat_bridge_universal.core.network.protocal import LoginPacket, LoginResultPacket, ChatPacket, BatchPacket, \
+    PingPacket, PongPacket, ChannelPacket, TicketPacket, ChunkPacket, AbstractPacket
+from tests.helpers import create_chat
+
+_BODY_HEADER = struct.Struct('!BBI')
+
+
+class BinaryCodecTest(unittest.TestCase):
+    def assert_round_trip(self, packet: AbstractPacket):
+        decoded = BINARY_CODEC.decode(BINARY_CODEC.encode(packet), AbstractPacket)
+        self.assertIs(type(decoded), type(packet))
+        self.assertEqual(BINARY_CODEC.encode(packet), BINARY_CODEC.encode(decoded))
+
+    def test_round_trip(self):
+        self.assert_round_trip(LoginPacket(
+            name='survival', password='secret', protocol_version=2, ciphers=['aes_ctr_hmac', 'aes_cbc'], compressions=['zlib'],
+            channels=['staff'], last_sequence=123456789012, ticket='1:abc', chunking=True
+        ))
+        self.assert_round_trip(LoginResultPacket(
+            success=True, message='ok', protocol_version=2, cipher='aes_cbc', compression='zlib', ticket='t', ticket_lifetime=1.5, chunking=True
+        ))
+        self.assert_round_trip(create_chat('unicode 你好 \0 {}', receivers=['creative'], author='Steve', channel='staff', path=['a', 'b'], origin_id=-1, sequence=2 ** 62))
+        self.assert_round_trip(BatchPacket(packets=[create_chat(str(i)) for i in range(3)]))
+        self.assert_round_trip(BatchPacket(packets=[]))
+        self.assert_round_trip(PingPacket(timestamp=12.25))
+        self.assert_round_trip(PongPacket(timestamp=0.0))
+        self.assert_round_trip(ChannelPacket(join=['a'], leave=['b', 'c']))
+        self.assert_round_trip(TicketPacket(ticket='t', lifetime=2.5))
+        self.assert_round_trip(ChunkPacket(stream_id=1, index=0, total_size=3, data=b'\0\xff\x01'))
+
+    def test_json_payload(self):
+        packet = create_chat()
+        packet.payload = {'author': 'Steve', 'message': 'hi', 'extra': 1}
+        decoded = BINARY_CODEC.decode(BINARY_CODEC.encode(packet), ChatPacket)
+        self.assertEqual('Steve', decoded.payload.author)
+        self.assertEqual('hi', decoded.payload.message)
+
+    def test_unknown_trailing_data_is_skipped(self):
+        data = BINARY_CODEC.encode(LoginResultPacket(success=True, message='ok'))
+        version, type_id, length = _BODY_HEADER.unpack_from(data)
+        data = _BODY_HEADER.pack(version, type_id, length + 3) + data[_BODY_HEADER.size:] + b'new'
+        self.assertEqual('ok', BINARY_CODEC.decode(data, LoginResultPacket).message)
+
+    def test_missing_trailing_fields_take_defaults(self):
+        # a login packet from a peer knowing the name and the password only
+        data = BINARY_CODEC.encode(LoginPacket(name='survival', password='secret', protocol_version=2))
+        body = data[_BODY_HEADER.size:]
+        cut = 4 + len('survival') + 4 + len('secret')
+        version, type_id, _ = _BODY_HEADER.unpack_from(data)
+        decoded = BINARY_CODEC.decode(_BODY_HEADER.pack(version, type_id, cut) + body[:cut], LoginPacket)
+        self.assertEqual('secret', decoded.password)
+        self.assertEqual(1, decoded.protocol_version)
+
+    def test_decoded_packets_of_the_same_type_do_not_share_defaults(self):
+        data = BINARY_CODEC.encode(ChannelPacket())
+        first, second = BINARY_CODEC.decode(data, ChannelPacket), BINARY_CODEC.decode(data, ChannelPacket)
+        first.join.append('a')
+        self.assertEqual([], second.join)
+
+    def test_unexpected_type(self):
+        with self.assertRaises(TypeError):
+            BINARY_CODEC.decode(BINARY_CODEC.encode(LoginResultPacket(success=True, message='ok')), ChatPacket)
+
+    def test_malformed(self):
+        data = BINARY_CODEC.encode(create_chat())
+        for length in (0, _BODY_HEADER.size - 1, len(data) - 1):
+            with self.assertRaises(ValueError):
+                BINARY_CODEC.decode(data[:length], ChatPacket)
+        with self.assertRaises(ValueError):
+            BINARY_CODEC.decode(bytes((PROTOCOL_VERSION_BINARY, 250)) + data[2:], AbstractPacket)
+        with self.assertRaises(ValueError):
+            BINARY_CODEC.decode(bytes((99,)) + data[1:], ChatPacket)
+
+
+    def test_nested_batch(self):
+        with self.assertRaises(ValueError):
+            BINARY_CODEC.encode(BatchPacket(packets=[BatchPacket(packets=[create_chat()])]))
+        inner = BINARY_CODEC.encode(BatchPacket(packets=[create_chat()]))
+        data = bytes(inner)
+        for _ in range(2000):  # deep enough to overflow the stack if batches were decoded recursively
+            body = struct.pack('!I', 1) + data
+            data = _BODY_HEADER.pack(PROTOCOL_VERSION_BINARY, inner[1], len(body)) + body
+        with self.assertRaises(ValueError):
+            BINARY_CODEC.decode(data, BatchPacket)
+
+
+class JsonCodecTest(unittest.TestCase):
+    def test_round_trip_with_paddings(self):
+        packet = create_chat('你好')
+        decoded = JSON_CODEC.decode(JSON_CODEC.encode(packet) + b'\0' * 5, ChatPacket)
+        self.assertEqual(BINARY_CODEC.encode(packet), BINARY_CODEC.encode(decoded))
+
+    def test_negotiation(self):
+        self.assertEqual(1, negotiate_version(1, 2))
+        self.assertEqual(2, negotiate_version(2, 2))
+        self.assertEqual(2, negotiate_version(99, 99))
+        self.assertEqual(1, negotiate_version(0, 2))
+        self.assertIs(BINARY_CODEC, get_codec(2))
+        with self.assertRaises(ValueError):
+            get_codec(99)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import hashlib
+import unittest
+
+from Crypto.Cipher import AES
+
+from chat_bridge_universal.core.network.cryptor import AESCryptor, AESCTRCryptor, DEFAULT_CIPHERS, create_cryptor, negotiate_cipher
+
+SIZES = (0, 1, 15, 16, 17, 1000, 1025, 70000)
+
+
+class AESCTRCryptorTest(unittest.TestCase):
+    def test_round_trip(self):
+        cryptor = AESCTRCryptor('key')
+        for size in SIZES:
+            data = bytes(i % 251 for i in range(size))
+            encrypted = cryptor.encrypt_bytes(data)
+            self.assertEqual(AESCTRCryptor.NONCE_SIZE + size + AESCTRCryptor.TAG_SIZE, len(encrypted))
+            self.assertEqual(data, AESCTRCryptor('key').decrypt_bytes(encrypted))
+            self.assertEqual(data, cryptor.decrypt_bytes(memoryview(encrypted)))
+
+    def test_standard_ctr(self):
+        data = bytes(range(256)) * 10
+        encrypted = AESCTRCryptor('key').encrypt_bytes(data)
+        nonce = encrypted[:AESCTRCryptor.NONCE_SIZE]
+        expected = AES.new(hashlib.sha512(b'key').digest()[:32], AES.MODE_CTR, nonce=nonce, initial_value=0).encrypt(data)
+        self.assertEqual(expected, encrypted[AESCTRCryptor.NONCE_SIZE:-AESCTRCryptor.TAG_SIZE])
+
+    def test_nonce_for_every_message(self):
+        cryptor = AESCTRCryptor('key')
+        self.assertNotEqual(cryptor.encrypt_bytes(b'hello'), cryptor.encrypt_bytes(b'hello'))
+
+    def test_tampered(self):
+        cryptor = AESCTRCryptor('key')
+        encrypted = cryptor.encrypt_bytes(b'hello')
+        for i in (0, AESCTRCryptor.NONCE_SIZE, len(encrypted) - 1):
+            tampered = bytearray(encrypted)
+            tampered[i] ^= 1
+            with self.assertRaises(ValueError):
+                cryptor.decrypt_bytes(bytes(tampered))
+        with self.assertRaises(ValueError):
+            AESCTRCryptor('other').decrypt_bytes(encrypted)
+        with self.assertRaises(ValueError):
+            cryptor.decrypt_bytes(encrypted[:AESCTRCryptor.NONCE_SIZE + AESCTRCryptor.TAG_SIZE - 1])
+
+    def test_empty_key(self):
+        self.assertEqual(b'hello', AESCTRCryptor('').encrypt_bytes(b'hello'))
+        self.assertEqual(b'hello', AESCTRCryptor('').decrypt_bytes(b'hello'))
+
+
+class AESCryptorTest(unittest.TestCase):
+    def test_round_trip_with_paddings(self):
+        cryptor = AESCryptor('key')
+        for size in SIZES:
+            data = b'x' * size
+            self.assertEqual(data, cryptor.decrypt_bytes(cryptor.encrypt_bytes(data)).rstrip(b'\0'))
+        self.assertEqual('你好', cryptor.decrypt(cryptor.encrypt('你好')))
+
+
+class NegotiationTest(unittest.TestCase):
+    def test_negotiate(self):
+        self.assertEqual(AESCTRCryptor.name, DEFAULT_CIPHERS[0])
+        self.assertEqual(AESCTRCryptor.name, negotiate_cipher(DEFAULT_CIPHERS, DEFAULT_CIPHERS))
+        self.assertEqual(AESCryptor.name, negotiate_cipher(DEFAULT_CIPHERS, [AESCryptor.name]))
+        self.assertEqual(AESCryptor.name, negotiate_cipher(['unknown'], DEFAULT_CIPHERS))
+        self.assertEqual(AESCryptor.name, negotiate_cipher([], DEFAULT_CIPHERS))
+        self.assertIsInstance(create_cryptor(AESCTRCryptor.name, 'key'), AESCTRCryptor)
+        with self.assertRaises(ValueError):
+            create_cryptor('unknown', 'key')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import unittest
+from typing import List
+
+from chat_bridge_universal.core.history import History, HistoryLog
+from chat_bridge_universal.core.network.protocal import ChatPacket
+from chat_bridge_universal.utils.logger import CBULogger
+from tests.helpers import create_chat
+
+
+def messages(packets: List[ChatPacket]) -> List[str]:
+    return [packet.payload.message for packet in packets]
+
+
+def accept_all(packet: ChatPacket) -> bool:
+    return True
+
+
+class HistoryTest(unittest.TestCase):
+    def test_sequences_grow(self):
+        history = History(4)
+        packets = [create_chat(str(i)) for i in range(10)]
+        for packet in packets:
+            history.append(packet)
+        sequences = [packet.sequence for packet in packets]
+        self.assertEqual(sorted(set(sequences)), sequences)
+        self.assertEqual(sequences[-1], history.get_last_sequence())
+
+    def test_since(self):
+        history = History(4)
+        packets = [create_chat(str(i), receivers=['b'] if i % 2 == 0 else ['c']) for i in range(6)]
+        for packet in packets:
+            history.append(packet)
+        self.assertEqual(['3', '4', '5'], messages(history.since(packets[2].sequence, accept_all, 10)))
+        self.assertEqual(['4', '5'], messages(history.since(packets[2].sequence, accept_all, 2)))
+        self.assertEqual(['4'], messages(history.since(packets[2].sequence, lambda packet: 'b' in packet.receivers, 10)))
+        self.assertEqual([], messages(history.since(packets[-1].sequence, accept_all, 10)))
+        # older than the ring without a log, only the chats kept are there
+        self.assertEqual(['2', '3', '4', '5'], messages(history.since(packets[0].sequence, accept_all, 10)))
+
+    def test_disabled(self):
+        history = History(0)
+        packet = create_chat('0')
+        history.append(packet)
+        self.assertGreater(packet.sequence, 0)
+        self.assertEqual([], history.since(1, accept_all, 10))
+
+
+class HistoryLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.logger = CBULogger('HistoryLogTest')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def create_log(self, segment_size: int = 200, segment_count: int = 100) -> HistoryLog:
+        return HistoryLog(self.directory, segment_size, segment_count, self.logger)
+
+    def test_since_reads_the_log_when_the_ring_does_not_reach_back(self):
+        history = History(3, self.create_log())
+        packets = [create_chat(str(i)) for i in range(10)]
+        for packet in packets:
+            history.append(packet)
+        self.assertEqual([str(i) for i in range(1, 10)], messages(history.since(packets[0].sequence, accept_all, 100)))
+        self.assertEqual(['8', '9'], messages(history.since(packets[0].sequence, accept_all, 2)))
+        self.assertGreater(len(os.listdir(self.directory)), 1)
+        history.close()
+
+    def test_restart_with_a_partly_filled_ring(self):
+        history = History(3, self.create_log())
+        packets = [create_chat(str(i)) for i in range(5)]
+        for packet in packets:
+            history.append(packet)
+        history.close()
+
+        history = History(3, self.create_log())
+        self.assertEqual(packets[-1].sequence, history.get_last_sequence())
+        fresh = create_chat('fresh')
+        history.append(fresh)
+        self.assertGreater(fresh.sequence, packets[-1].sequence)
+        # a client which received the first chat before the restart
+        self.assertEqual(['1', '2', '3', '4', 'fresh'], messages(history.since(packets[0].sequence, accept_all, 100)))
+        self.assertEqual(['fresh'], messages(history.since(packets[-1].sequence, accept_all, 100)))
+        history.close()
+
+    def test_read_without_the_lock(self):
+        history = History(1, self.create_log())
+        packets = [create_chat(str(i)) for i in range(5)]
+        for packet in packets:
+            history.append(packet)
+        chats = history.read_log(packets[0].sequence, history.get_oldest_sequence(), accept_all, 100)
+        for i in range(5, 10):  # appended while the chats are read
+            history.append(create_chat(str(i)))
+        self.assertEqual(['1', '2', '3'], messages(list(chats)))
+        history.close()
+
+    def test_read_from_the_newest_segment(self):
+        log = self.create_log(segment_size=100)
+        history = History(0, log)
+        packets = [create_chat(str(i)) for i in range(20)]
+        for packet in packets:
+            history.append(packet)
+        read = []
+
+        def predicate(packet: ChatPacket) -> bool:
+            read.append(packet.payload.message)
+            return int(packet.payload.message) % 2 == 0
+
+        self.assertEqual(['14', '16', '18'], messages(list(log.read(0, packets[19].sequence, predicate, 3))))
+        self.assertNotIn('0', read)  # the old segments are not read once enough chats are found
+        self.assertNotIn('19', read)  # nor the chats from before on
+        self.assertEqual(['2', '4'], messages(list(log.read(packets[1].sequence, packets[5].sequence, predicate, 100))))
+        self.assertEqual([], list(log.read(0, packets[19].sequence, predicate, 0)))
+        history.close()
+
+    def test_old_segments_are_deleted(self):
+        log = self.create_log(segment_size=100, segment_count=2)
+        history = History(0, log)
+        for i in range(20):
+            history.append(create_chat(str(i)))
+        self.assertEqual(2, len(os.listdir(self.directory)))
+        self.assertEqual('19', messages(list(log.read(0, history.get_last_sequence() + 1, accept_all, 100)))[-1])
+        history.close()
+
+    def test_incomplete_record_is_cut_off(self):
+        history = History(0, self.create_log(segment_size=10000))
+        packets = [create_chat(str(i)) for i in range(3)]
+        for packet in packets:
+            history.append(packet)
+        history.close()
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, 'ab') as file:
+            file.write(b'\0\0\0')  # the server died while writing a record
+        log = self.create_log(segment_size=10000)
+        self.assertEqual(packets[-1].sequence, log.last_sequence)
+        self.assertEqual(['0', '1', '2'], messages(list(log.read(0, log.last_sequence + 1, accept_all, 100))))
+        log.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+from unittest import mock
+
+from chat_bridge_universal.core.ingress import IngressLimiter, RateLimitPolicy, TokenBucket, DuplicateCache, get_duplicate_key
+from tests.helpers import create_chat
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class IngressTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('chat_bridge_universal.core.ingress.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TokenBucketTest(IngressTestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([0, 0, 0, None], [bucket.take() for _ in range(4)])
+        self.clock.now += 0.5
+        self.assertEqual(0, bucket.take())
+        self.assertIsNone(bucket.take())
+
+    def test_delay(self):
+        bucket = TokenBucket(rate=2, burst=1)
+        self.assertEqual(0, bucket.take(1))
+        self.assertAlmostEqual(0.5, bucket.take(1))
+        self.assertAlmostEqual(1.0, bucket.take(1))
+        self.assertIsNone(bucket.take(1))
+
+
+class DuplicateCacheTest(IngressTestCase):
+    def test_window(self):
+        cache = DuplicateCache(window=2)
+        self.assertTrue(cache.add('x'))
+        self.assertFalse(cache.add('x'))
+        self.clock.now += 1
+        self.assertFalse(cache.add('x'))  # remembered since the first time
+        self.clock.now += 1
+        self.assertTrue(cache.add('x'))
+
+    def test_size(self):
+        cache = DuplicateCache(window=100, size=2)
+        for key in 'abc':
+            self.assertTrue(cache.add(key))
+        self.assertTrue(cache.add('a'))  # the oldest one is forgotten
+        self.assertFalse(cache.add('c'))
+
+    def test_key(self):
+        self.assertEqual(get_duplicate_key(create_chat('hi')), get_duplicate_key(create_chat('hi')))
+        self.assertNotEqual(get_duplicate_key(create_chat('hi')), get_duplicate_key(create_chat('ho')))
+        self.assertNotEqual(get_duplicate_key(create_chat('hi')), get_duplicate_key(create_chat('hi', channel='staff')))
+        packet = create_chat('hi')
+        packet.payload = {'author': 'Steve', 'message': 'hi', 'extra': [1]}
+        self.assertEqual(get_duplicate_key(packet), get_duplicate_key(packet))
+
+
+class IngressLimiterTest(IngressTestCase):
+    def test_disabled(self):
+        limiter = IngressLimiter(0, 20, RateLimitPolicy.drop, 1, 0)
+        self.assertFalse(limiter.is_enabled())
+
+    def test_drop(self):
+        limiter = IngressLimiter(1, 2, RateLimitPolicy.drop, 5, 0)
+        allowed, delay, rate_limited, duplicated = limiter.check([create_chat(str(i)) for i in range(5)])
+        self.assertEqual(['0', '1'], [packet.payload.message for packet in allowed])
+        self.assertEqual((0, 3, 0), (delay, rate_limited, duplicated))
+
+    def test_delay(self):
+        limiter = IngressLimiter(2, 1, RateLimitPolicy.delay, 1, 0)
+        allowed, delay, rate_limited, duplicated = limiter.check([create_chat(str(i)) for i in range(5)])
+        self.assertEqual(3, len(allowed))
+        self.assertAlmostEqual(1.0, delay)
+        self.assertEqual((2, 0), (rate_limited, duplicated))
+
+    def test_duplicates(self):
+        limiter = IngressLimiter(0, 20, RateLimitPolicy.drop, 1, 10)
+        allowed, _, rate_limited, duplicated = limiter.check([create_chat('hi'), create_chat('hi'), create_chat('ho')])
+        self.assertEqual(['hi', 'ho'], [packet.payload.message for packet in allowed])
+        self.assertEqual((0, 1), (rate_limited, duplicated))
+        self.clock.now += 10
+        self.assertEqual(1, len(limiter.check([create_chat('hi')])[0]))
+
+    def test_rate_limited_chat_is_not_remembered(self):
+        limiter = IngressLimiter(1, 1, RateLimitPolicy.drop, 1, 10)
+        self.assertEqual(1, len(limiter.check([create_chat('a')])[0]))
+        allowed, _, rate_limited, duplicated = limiter.check([create_chat('b')])
+        self.assertEqual((0, 1, 0), (len(allowed), rate_limited, duplicated))
+        self.clock.now += 1
+        # sending it again is not taken as a duplicate, since it was dropped
+        allowed, _, rate_limited, duplicated = limiter.check([create_chat('b')])
+        self.assertEqual((1, 0, 0), (len(allowed), rate_limited, duplicated))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import logging
+import unittest
+from typing import List
+
+from chat_bridge_universal.utils.logger import CBULogger, Lazy
+
+
+class _RecordingLogger(CBULogger):
+    messages: List[str] = []
+
+    @classmethod
+    def create_console_handler(cls) -> logging.Handler:
+        class Handler(logging.Handler):
+            def emit(self, record: logging.LogRecord):
+                cls.messages.append(record.getMessage())
+        return Handler()
+
+
+class LoggerTest(unittest.TestCase):
+    def setUp(self):
+        _RecordingLogger.messages.clear()
+        self.logger = _RecordingLogger('Test')
+
+    def test_lazy_message_is_resolved_when_logged(self):
+        calls = []
+        self.logger.debug(Lazy(lambda: calls.append(1)))
+        self.assertEqual([], calls)
+        state = ['before']
+        _RecordingLogger.set_async_all(True)
+        try:
+            self.logger.info(Lazy(lambda: 'state {}'.format(state[0])))
+            state[0] = 'after'
+        finally:
+            _RecordingLogger.set_async_all(False)  # waits for the listener thread
+        self.assertEqual(['state before'], _RecordingLogger.messages)
+
+    def test_rate_limited_category(self):
+        calls = []
+        CBULogger.set_rate_limit('test', 1, 2)
+        self.addCleanup(CBULogger.set_rate_limit, 'test', 0)
+        for i in range(5):
+            self.logger.log_category('test', logging.INFO, Lazy(lambda: calls.append(i) or 'chat {}'.format(i)))
+        self.assertEqual([0, 1], calls)
+        self.assertEqual(['chat 0', 'chat 1'], _RecordingLogger.messages)
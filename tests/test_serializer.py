@@ -0,0 +1,85 @@
+import unittest
+from enum import Enum
+from typing import List, Dict
+
+from chat_bridge_universal.utils.serializer import SlottedSerializable, Serializable
+
+
+class Color(Enum):
+    red = 'red'
+    blue = 'blue'
+
+
+class Inner(SlottedSerializable):
+    value: int = 1
+
+
+class Sample(SlottedSerializable):
+    name: str
+    tags: List[str] = []
+    color: Color = Color.red
+    inner: Inner = Inner()
+    extra: Dict[str, int] = {}
+    ratio: float = 0.5
+
+
+class Child(Sample):
+    level: int = 3
+
+
+class LegacySample(Serializable):
+    name: str
+    tags: List[str] = []
+    color: Color = Color.red
+    inner: Inner = Inner()
+    extra: Dict[str, int] = {}
+    ratio: float = 0.5
+
+
+class SlottedSerializableTest(unittest.TestCase):
+    def test_round_trip(self):
+        sample = Sample(name='a', tags=['x'], color=Color.blue, inner=Inner(value=5), extra={'k': 1}, ratio=2.0)
+        data = sample.serialize()
+        self.assertEqual({'name': 'a', 'tags': ['x'], 'color': 'blue', 'inner': {'value': 5}, 'extra': {'k': 1}, 'ratio': 2.0}, data)
+        self.assertEqual(data, Sample.deserialize(data).serialize())
+
+    def test_same_as_serializable(self):
+        data = {'name': 'a', 'tags': ['x'], 'color': 'blue', 'inner': {'value': 5}, 'extra': {'k': 1}, 'ratio': 2}
+        self.assertEqual(LegacySample.deserialize(data).serialize(), Sample.deserialize(data).serialize())
+
+    def test_defaults_are_not_shared(self):
+        first, second = Sample(name='a'), Sample.deserialize({'name': 'b'})
+        first.tags.append('x')
+        first.inner.value = 9
+        self.assertEqual([], second.tags)
+        self.assertEqual(1, second.inner.value)
+        self.assertEqual([], Sample(name='c').tags)
+
+    def test_missing_required_field_is_unset(self):
+        sample = Sample.deserialize({'tags': ['x']})
+        self.assertFalse(hasattr(sample, 'name'))
+        self.assertEqual({'tags': ['x'], 'color': 'red', 'inner': {'value': 1}, 'extra': {}, 'ratio': 0.5}, sample.serialize())
+
+    def test_type_conversion(self):
+        self.assertEqual(Color.blue, Sample.deserialize({'name': 'a', 'color': 'blue'}).color)
+        self.assertIsInstance(Sample.deserialize({'name': 'a', 'ratio': 1}).ratio, float)
+        with self.assertRaises(TypeError):
+            Sample.deserialize({'name': 1})
+        with self.assertRaises(TypeError):
+            Sample.deserialize(['not', 'a', 'dict'])
+
+    def test_slots(self):
+        sample = Sample(name='a')
+        with self.assertRaises(AttributeError):
+            sample.unknown = 1
+        self.assertFalse(hasattr(sample, '__dict__'))
+
+    def test_inheritance(self):
+        child = Child(name='a', level=4)
+        self.assertEqual(4, child.serialize()['level'])
+        self.assertEqual('red', child.serialize()['color'])
+        self.assertEqual(3, Child.deserialize({'name': 'a'}).level)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+from typing import List
+
+from chat_bridge_universal.core.network import network_utils
+from chat_bridge_universal.core.network.codec import BINARY_CODEC, JSON_CODEC
+from chat_bridge_universal.core.network.cryptor import AESCryptor
+from chat_bridge_universal.core.network.outbound import OutboundBuffer, OverflowPolicy
+from chat_bridge_universal.core.network.protocal import ChunkPacket, AbstractPacket
+from chat_bridge_universal.core.network.streaming import StreamAssembler, encode_frames
+from tests.helpers import create_chat
+
+CRYPTOR = AESCryptor('key')
+
+
+def decode_frames(frames: List[bytes]) -> List[AbstractPacket]:
+    header = BINARY_CODEC.header
+    return [network_utils.decode_packet(CRYPTOR, frame[header.size:], AbstractPacket, BINARY_CODEC) for frame in frames]
+
+
+def create_chunks(stream_id: int, total_size: int, chunk_size: int) -> List[ChunkPacket]:
+    return [
+        ChunkPacket(stream_id=stream_id, index=index, total_size=total_size, data=b'x' * min(chunk_size, total_size - start))
+        for index, start in enumerate(range(0, total_size, chunk_size))
+    ]
+
+
+class EncodeFramesTest(unittest.TestCase):
+    def test_small_packet_is_a_single_frame(self):
+        packet = create_chat('x' * 10)
+        self.assertEqual([network_utils.encode_packet(CRYPTOR, packet, BINARY_CODEC)], encode_frames(CRYPTOR, packet, BINARY_CODEC, chunk_size=1000))
+        self.assertEqual(1, len(encode_frames(CRYPTOR, create_chat('x' * 5000), BINARY_CODEC, chunk_size=0)))
+        self.assertEqual(1, len(encode_frames(CRYPTOR, create_chat('x' * 5000), JSON_CODEC, chunk_size=1000)))  # v1 has no chunks
+
+    def test_round_trip(self):
+        packet = create_chat('x' * 5000)
+        chunks = decode_frames(encode_frames(CRYPTOR, packet, BINARY_CODEC, chunk_size=1000))
+        self.assertEqual(6, len(chunks))
+        self.assertTrue(all(isinstance(chunk, ChunkPacket) for chunk in chunks))
+        assembler = StreamAssembler(10000, 10000)
+        results = [assembler.assemble(chunk, BINARY_CODEC, AbstractPacket) for chunk in chunks]
+        self.assertEqual([None] * 5, results[:-1])
+        self.assertEqual(packet.serialize(), results[-1].serialize())
+        self.assertEqual(0, assembler.get_reserved_size())
+
+    def test_interleaved_streams(self):
+        first, second = create_chunks(1, 30, 10), create_chunks(2, 20, 10)
+        assembler = StreamAssembler(100, 100)
+        self.assertIsNone(assembler.feed(first[0]))
+        self.assertIsNone(assembler.feed(second[0]))
+        self.assertEqual(50, assembler.get_reserved_size())
+        self.assertIsNone(assembler.feed(first[1]))
+        self.assertEqual(b'x' * 20, assembler.feed(second[1]))
+        self.assertEqual(b'x' * 30, assembler.feed(first[2]))
+        self.assertEqual(0, assembler.get_reserved_size())
+
+    def test_non_chunk_passes_through(self):
+        packet = create_chat('x')
+        self.assertIs(packet, StreamAssembler(100, 100).assemble(packet, BINARY_CODEC, AbstractPacket))
+
+
+class StreamAssemblerDropTest(unittest.TestCase):
+    def test_too_large(self):
+        assembler = StreamAssembler(max_stream_size=25, max_memory=100)
+        chunks = create_chunks(1, 30, 10)
+        self.assertEqual([None] * 3, [assembler.feed(chunk) for chunk in chunks])  # the later chunks are ignored
+        self.assertEqual(0, assembler.get_reserved_size())
+        self.assertIsNone(assembler.feed(ChunkPacket(stream_id=2, index=0, total_size=0, data=b'')))
+
+    def test_memory_drops_the_oldest(self):
+        assembler = StreamAssembler(max_stream_size=100, max_memory=50)
+        first, second = create_chunks(1, 30, 10), create_chunks(2, 30, 10)
+        assembler.feed(first[0])
+        assembler.feed(second[0])  # takes the memory of the first one
+        self.assertEqual(30, assembler.get_reserved_size())
+        self.assertIsNone(assembler.feed(first[1]))
+        self.assertIsNone(assembler.feed(first[2]))
+        assembler.feed(second[1])
+        self.assertEqual(b'x' * 30, assembler.feed(second[2]))
+
+    def test_missing_chunk(self):
+        assembler = StreamAssembler(100, 100)
+        chunks = create_chunks(1, 30, 10)
+        assembler.feed(chunks[0])
+        self.assertIsNone(assembler.feed(chunks[2]))
+        self.assertEqual(0, assembler.get_reserved_size())
+        self.assertIsNone(assembler.feed(chunks[1]))
+        # a stream whose first chunk was never seen, e.g. sent before reconnecting
+        self.assertIsNone(assembler.feed(create_chunks(2, 30, 10)[1]))
+        self.assertEqual(0, assembler.get_reserved_size())
+
+    def test_malformed(self):
+        assembler = StreamAssembler(100, 100)
+        assembler.feed(ChunkPacket(stream_id=1, index=0, total_size=15, data=b'x' * 10))
+        self.assertIsNone(assembler.feed(ChunkPacket(stream_id=1, index=1, total_size=15, data=b'x' * 10)))
+        self.assertEqual(0, assembler.get_reserved_size())
+
+    def test_chunk_of_chunks(self):
+        inner = BINARY_CODEC.encode(ChunkPacket(stream_id=9, index=0, total_size=1, data=b'x'))
+        assembler = StreamAssembler(100, 100)
+        with self.assertRaises(ValueError):
+            assembler.assemble(ChunkPacket(stream_id=1, index=0, total_size=len(inner), data=inner), BINARY_CODEC, AbstractPacket)
+
+    def test_reset(self):
+        assembler = StreamAssembler(100, 100)
+        assembler.feed(create_chunks(1, 30, 10)[0])
+        assembler.reset()
+        self.assertEqual(0, assembler.get_reserved_size())
+
+
+class OutboundBufferTest(unittest.TestCase):
+    def test_streams_go_last(self):
+        buffer = OutboundBuffer(10, OverflowPolicy.drop_oldest)
+        buffer.offer_stream([b'c0', b'c1'])
+        buffer.offer(b'chat')
+        self.assertEqual(3, len(buffer))
+        self.assertEqual([b'chat', b'c0', b'c1', None], [buffer.poll() for _ in range(4)])
+        self.assertEqual(0, buffer.size_bytes)
+
+    def test_byte_budget_drops_whole_streams(self):
+        buffer = OutboundBuffer(100, OverflowPolicy.drop_oldest, max_bytes=10)
+        buffer.offer_stream([b'a0', b'a1'])
+        buffer.offer_stream([b'b0', b'b1'])
+        buffer.offer(b'chat')  # the oldest stream is dropped as a whole for a chat frame
+        self.assertEqual((3, 8, 2), (len(buffer), buffer.size_bytes, buffer.dropped))
+        self.assertEqual([b'chat', b'b0', b'b1', None], [buffer.poll() for _ in range(4)])
+
+    def test_stream_being_sent_is_kept(self):
+        buffer = OutboundBuffer(100, OverflowPolicy.drop_oldest, max_bytes=10)
+        buffer.offer_stream([b'a0', b'a1', b'a2'])
+        self.assertEqual(b'a0', buffer.poll())
+        buffer.offer_stream([b'b0', b'b1'])
+        buffer.offer(b'chat!!')  # b is dropped, and the rest of a stays although it's over the budget
+        self.assertEqual(2, buffer.dropped)
+        self.assertEqual([b'chat!!', b'a1', b'a2', None], [buffer.poll() for _ in range(4)])
+
+    def test_stream_never_drops_chat_frames(self):
+        buffer = OutboundBuffer(100, OverflowPolicy.drop_oldest, max_bytes=10)
+        buffer.offer(b'c' * 8)
+        self.assertTrue(buffer.offer_stream([b'x0', b'x1']))
+        self.assertEqual((1, 2), (len(buffer), buffer.dropped))
+        self.assertEqual(b'c' * 8, buffer.poll())
+        self.assertTrue(buffer.offer_stream([b'x0', b'x1']))
+        self.assertEqual(2, len(buffer))
+
+    def test_frame_count(self):
+        buffer = OutboundBuffer(3, OverflowPolicy.drop_oldest)
+        buffer.offer_stream([b'a0', b'a1'])
+        buffer.offer(b'x')
+        buffer.offer(b'y')  # the stream makes room
+        self.assertEqual([b'x', b'y', None], [buffer.poll() for _ in range(3)])
+        buffer.offer_stream([b'a0', b'a1', b'a2', b'a3'])  # larger than the limit, into an empty buffer
+        self.assertEqual(4, len(buffer))
+
+    def test_large_frame_into_an_empty_buffer(self):
+        buffer = OutboundBuffer(100, OverflowPolicy.drop_newest, max_bytes=10)
+        self.assertTrue(buffer.offer(b'x' * 50))
+        self.assertEqual(50, buffer.size_bytes)
+        self.assertTrue(buffer.offer(b'y'))
+        self.assertTrue(buffer.offer_stream([b'z0', b'z1']))
+        self.assertEqual(3, buffer.dropped)
+        self.assertEqual(b'x' * 50, buffer.poll())
+        self.assertEqual(0, buffer.size_bytes)
+
+    def test_disconnect(self):
+        buffer = OutboundBuffer(2, OverflowPolicy.disconnect)
+        self.assertTrue(buffer.offer(b'a'))
+        self.assertTrue(buffer.offer(b'b'))
+        self.assertFalse(buffer.offer(b'c'))
+        self.assertFalse(buffer.offer_stream([b'c0', b'c1']))
+
+if __name__ == '__main__':
+    unittest.main()